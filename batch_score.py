@@ -0,0 +1,295 @@
+import argparse
+import csv
+import functools
+import json
+import sys
+import time
+
+import numpy as np
+
+from constants import rss_aggressive, rss_conservative
+from metrics import enable_metrics, format_metrics, instrument_dataset
+from pairwise import PAIR_SCORE_KEYS, generate_pairwise_scores_for_scene
+from parallel_scoring import iter_scene_results, iter_score_tables_for_scenes
+from score_cache import SCORE_KEYS
+from score_table import ScoreTable
+
+OUTPUT_FIELDS = ['scene'] + SCORE_KEYS
+PAIRWISE_OUTPUT_FIELDS = ['scene'] + PAIR_SCORE_KEYS
+
+
+class JsonLinesWriter:
+    """
+    Writes one JSON object per score
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, scene_token, table):
+        for score in table.to_scores():
+            self.f.write(json.dumps(dict(scene=scene_token, **score)) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class CsvWriter:
+    """
+    Writes one CSV row per score, with empty cells for missing values
+    """
+
+    def __init__(self, f, fields=OUTPUT_FIELDS):
+        self.f = f
+        self.writer = csv.DictWriter(f, fieldnames=fields)
+        self.writer.writeheader()
+
+    def write(self, scene_token, table):
+        for score in table.to_scores():
+            self.writer.writerow(dict(scene=scene_token, **score))
+        self.f.flush()
+
+    def close(self):
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class NpzWriter:
+    """
+    Collects each scene's score table and writes them to a compressed NPZ file when closed, in the form
+    of ScoreTable.to_npz(). The scene of each score is stored in scene, as an index into scene_tokens
+    """
+
+    def __init__(self, path, fields=OUTPUT_FIELDS):
+        self.path = path
+        self.keys = [field for field in fields if field != 'scene']
+        self.scene_tokens = []
+        self.tables = []
+
+    def write(self, scene_token, table):
+        self.scene_tokens.append(scene_token)
+        self.tables.append(table)
+
+    def close(self):
+        table = ScoreTable.concatenate(self.tables, self.keys)
+        scenes = np.repeat(np.arange(len(self.tables), dtype=np.int32), [len(t) for t in self.tables])
+        table.to_npz(self.path, scene=scenes, scene_tokens=np.array(self.scene_tokens, dtype=str))
+
+
+class ParquetWriter:
+    """
+    Writes each scene's scores as a row group of a Parquet file. Requires pyarrow
+    """
+
+    def __init__(self, path, fields=OUTPUT_FIELDS):
+        self.fields = fields
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Parquet output requires pyarrow, install it with pip install pyarrow')
+        self.pyarrow = pyarrow
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema())
+
+    def schema(self):
+        # tokens and reasons are dictionary encoded, as given by ScoreTable.to_arrow()
+        pa = self.pyarrow
+        token = pa.dictionary(pa.int32(), pa.string())
+        types = {'scene': token, 'annotation': token, 'instance': token, 'other_annotation': token,
+                 'other_instance': token, 'reason': pa.dictionary(pa.int8(), pa.string()),
+                 'same_direction': pa.bool_()}
+        return pa.schema([(field, types.get(field, pa.float64())) for field in self.fields])
+
+    def write(self, scene_token, table):
+        pa = self.pyarrow
+        scene = pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(table), dtype=np.int32)), [scene_token])
+        arrow = table.to_arrow().append_column('scene', scene)
+        self.writer.write_table(arrow.select(self.fields))
+
+    def close(self):
+        self.writer.close()
+
+
+def open_writer(path, output_format, fields=OUTPUT_FIELDS):
+    """
+    Creates a writer for the output file
+
+    Args:
+        path: path of the output file, - for standard output
+        output_format: one of jsonl, csv, npz or parquet. Found from the file extension if None
+        fields: fields of each score written, in order, for the formats with a fixed set of columns
+
+    Returns: writer object with write(scene_token, table) and close() methods, taking each scene's ScoreTable
+
+    """
+
+    if output_format is None:
+        output_format = path.rsplit('.', 1)[-1] if '.' in path else 'jsonl'
+
+    if output_format in ['jsonl', 'csv']:
+        f = sys.stdout if path == '-' else open(path, 'w', newline='')
+        return JsonLinesWriter(f) if output_format == 'jsonl' else CsvWriter(f, fields)
+    if path == '-':
+        raise SystemExit('%s output cannot be written to standard output' % output_format)
+    if output_format == 'npz':
+        return NpzWriter(path, fields)
+    if output_format == 'parquet':
+        return ParquetWriter(path, fields)
+    raise SystemExit('Unknown output format: %s' % output_format)
+
+
+def load_params(name):
+    """
+    Finds the RSS parameter set to use
+
+    Args:
+        name: aggressive, conservative or the path of a JSON file containing a parameter dictionary
+
+    Returns: parameter dictionary
+
+    """
+
+    if name == 'aggressive':
+        return rss_aggressive
+    if name == 'conservative':
+        return rss_conservative
+    with open(name) as f:
+        params = json.load(f)
+    missing = set(rss_aggressive) - set(params)
+    if missing:
+        raise SystemExit('Parameter file %s is missing %s' % (name, ', '.join(sorted(missing))))
+    return params
+
+
+def score_scene_pairs(nusc, scene_token, params):
+    """
+    Scores every pair of vehicles in a scene, see generate_pairwise_scores_for_scene()
+
+    Args:
+        nusc: NuScenes object
+        scene_token: token of scene
+        params: RSS parameter dictionary
+
+    Returns: ScoreTable with the keys of PAIR_SCORE_KEYS
+
+    """
+
+    return ScoreTable.from_scores(generate_pairwise_scores_for_scene(nusc, scene_token, params=params),
+                                  PAIR_SCORE_KEYS)
+
+
+def find_scene_tokens(nusc, scenes):
+    """
+    Finds the tokens of the scenes to score
+
+    Args:
+        nusc: NuScenes object
+        scenes: list of scene tokens or names, e.g. scene-0061. All scenes if empty
+
+    Returns: list of scene tokens, each once in the order first given
+
+    """
+
+    if not scenes:
+        return [scene['token'] for scene in nusc.scene]
+
+    by_name = {scene['name']: scene['token'] for scene in nusc.scene}
+    by_token = {scene['token'] for scene in nusc.scene}
+    tokens = []
+    for scene in scenes:
+        if scene in by_token:
+            tokens.append(scene)
+        elif scene in by_name:
+            tokens.append(by_name[scene])
+        else:
+            raise SystemExit('Unknown scene: %s' % scene)
+    # a scene given twice, e.g. by name and by token, would be scored and written twice
+    return list(dict.fromkeys(tokens))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Scores scenes of a nuScenes dataset without the web UI, '
+                                                 'writing results as each scene finishes.')
+    parser.add_argument('dataroot', help='root directory of the dataset, e.g. data/sets/nuscenes')
+    parser.add_argument('version', help='dataset version, e.g. v1.0-mini')
+    parser.add_argument('-o', '--output', default='-', help='output file, - for standard output (default)')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv', 'npz', 'parquet'],
+                        help='output format, found from the output file extension if not given')
+    parser.add_argument('-p', '--params', default='aggressive',
+                        help='aggressive (default), conservative or a JSON file with a parameter dictionary')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('-s', '--scenes', nargs='*', default=[],
+                        help='scene tokens or names to score, defaults to the whole dataset')
+    parser.add_argument('--pairwise', action='store_true',
+                        help='score every pair of vehicles against each other rather than each vehicle against '
+                             'the ego. Pairs are written with the other vehicle\'s annotation and instance, and '
+                             'the score cache is not used')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the score cache')
+    parser.add_argument('--cache-root', default=None,
+                        help='directory of the score cache, defaults to score_cache in the dataset root')
+    parser.add_argument('--store', action='store_true',
+                        help='read the dataset from its metadata store, converting it on first use, which '
+                             'starts much faster than loading the JSON tables')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record how long each scoring stage takes and print a summary at the end')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not show progress')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs a batch scoring job from the command line
+
+    """
+
+    args = parse_args(argv)
+    params = load_params(args.params)
+    if args.metrics:
+        enable_metrics()
+
+    start_time = time.time()
+    if args.store:
+        from metadata_store import open_metadata_store
+        nusc = open_metadata_store(args.dataroot, args.version, verbose=not args.quiet)
+    else:
+        from nuscenes.nuscenes import NuScenes
+        nusc = NuScenes(version=args.version, dataroot=args.dataroot, verbose=not args.quiet)
+    instrument_dataset(nusc)
+
+    scene_tokens = find_scene_tokens(nusc, args.scenes)
+    if args.pairwise:
+        writer = open_writer(args.output, args.format, PAIRWISE_OUTPUT_FIELDS)
+        results = iter_scene_results(nusc, functools.partial(score_scene_pairs, params=params), scene_tokens,
+                                     workers=args.workers, progress=not args.quiet)
+    else:
+        writer = open_writer(args.output, args.format)
+        results = iter_score_tables_for_scenes(nusc, scene_tokens, params=params, workers=args.workers,
+                                               use_cache=not args.no_cache, cache_root=args.cache_root,
+                                               progress=not args.quiet)
+
+    num_scores = 0
+    num_flagged = 0
+    try:
+        for scene_token, table in results:
+            writer.write(scene_token, table)
+            num_scores += len(table)
+            num_flagged += np.count_nonzero(table['score'] < 1)
+    finally:
+        writer.close()
+
+    if not args.quiet:
+        if args.pairwise:
+            print('Scored %d scenes, %d pairs of vehicles with non-perfect scores in %.1f seconds'
+                  % (len(scene_tokens), num_flagged, time.time() - start_time), file=sys.stderr)
+        else:
+            print('Scored %d scenes, %d instances, %d with non-perfect scores in %.1f seconds'
+                  % (len(scene_tokens), num_scores, num_flagged, time.time() - start_time), file=sys.stderr)
+    if args.metrics:
+        print(format_metrics(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARKS = ['startup', 'startup_store', 'annotation', 'scene', 'dataset']
+
+# metrics are compared by their suffix: lower is better for times and memory, higher for throughput
+LOWER_IS_BETTER = ('_seconds', '_mb')
+HIGHER_IS_BETTER = ('_per_second',)
+
+
+def get_peak_memory_mb(who=resource.RUSAGE_SELF):
+    """
+    Finds the peak resident memory of this process (or of its finished children)
+
+    Args:
+        who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+
+    Returns: peak memory in megabytes
+
+    """
+
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def load_dataset(dataroot, version):
+    from nuscenes.nuscenes import NuScenes
+    return NuScenes(version=version, dataroot=dataroot, verbose=False)
+
+
+def benchmark_startup(dataroot, version, repeat, workers):
+    """
+    Time taken to load the dataset's JSON tables
+    """
+
+    start_time = time.perf_counter()
+    load_dataset(dataroot, version)
+    return {'load_seconds': time.perf_counter() - start_time}
+
+
+def benchmark_startup_store(dataroot, version, repeat, workers):
+    """
+    Time taken to open the dataset's metadata store, which is converted beforehand
+    """
+
+    from metadata_store import MetadataStore
+    start_time = time.perf_counter()
+    MetadataStore(version=version, dataroot=dataroot)
+    return {'load_seconds': time.perf_counter() - start_time}
+
+
+def benchmark_annotation(dataroot, version, repeat, workers):
+    """
+    Scoring throughput for single annotations, with the ego states of each scene found beforehand
+    """
+
+    from my_nuscenes_functions import build_ego_state_table, build_instance_tracks, get_annotation_masks, \
+        get_scene_sample_tokens
+    from scoring import get_params, iter_scores_for_track
+
+    nusc = load_dataset(dataroot, version)
+    params = get_params()
+    is_vehicle = get_annotation_masks(nusc)['is_vehicle']
+
+    scenes = []
+    for scene in nusc.scene:
+        sample_tokens = get_scene_sample_tokens(nusc, scene['token'])
+        tracks = [track for track in build_instance_tracks(nusc, sample_tokens).values() if is_vehicle[track[0]]]
+        scenes.append((build_ego_state_table(nusc, sample_tokens), tracks))
+    num_annotations = sum(len(track) for _, tracks in scenes for track in tracks)
+
+    best = np.inf
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for ego_states, tracks in scenes:
+            for track in tracks:
+                for _ in iter_scores_for_track(nusc, track, params, ego_states):
+                    pass
+        best = min(best, time.perf_counter() - start_time)
+
+    return {'annotations': num_annotations, 'annotations_per_second': num_annotations / best,
+            'per_annotation_seconds': best / num_annotations}
+
+
+def benchmark_scene(dataroot, version, repeat, workers):
+    """
+    Scoring throughput for whole scenes in one process, as used by the scene page
+    """
+
+    from scoring import generate_scores_for_scene
+
+    nusc = load_dataset(dataroot, version)
+    scene_tokens = [scene['token'] for scene in nusc.scene]
+
+    best = np.inf
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for scene_token in scene_tokens:
+            generate_scores_for_scene(nusc, scene_token)
+        best = min(best, time.perf_counter() - start_time)
+
+    return {'scenes': len(scene_tokens), 'scenes_per_second': len(scene_tokens) / best,
+            'per_scene_seconds': best / len(scene_tokens)}
+
+
+def benchmark_dataset(dataroot, version, repeat, workers):
+    """
+    Time taken to score the whole dataset with the worker pool, without the score cache
+    """
+
+    from parallel_scoring import generate_scores_for_scenes
+
+    nusc = load_dataset(dataroot, version)
+
+    best = np.inf
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        generate_scores_for_scenes(nusc, workers=workers, use_cache=False, progress=False)
+        best = min(best, time.perf_counter() - start_time)
+
+    return {'workers': workers or os.cpu_count() or 1, 'total_seconds': best,
+            'scenes_per_second': len(nusc.scene) / best,
+            'worker_peak_memory_mb': get_peak_memory_mb(resource.RUSAGE_CHILDREN)}
+
+
+def run_benchmark(name, dataroot, version, repeat=3, workers=None):
+    """
+    Runs one benchmark in a new Python process, so that startup time and peak memory are not affected by
+    earlier benchmarks
+
+    Args:
+        name: name of the benchmark, one of BENCHMARKS
+        dataroot: dataset root directory
+        version: dataset version
+        repeat: number of times to repeat the timed part, the fastest time is kept
+        workers: number of worker processes for the dataset benchmark
+
+    Returns: dictionary of metrics
+
+    """
+
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--dataroot', dataroot,
+               '--version', version, '--repeat', str(repeat)]
+    if workers:
+        command += ['--workers', str(workers)]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run_child(name, dataroot, version, repeat, workers):
+    metrics = globals()['benchmark_' + name](dataroot, version, repeat, workers)
+    metrics['peak_memory_mb'] = get_peak_memory_mb()
+    print(json.dumps(metrics))
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compares benchmark results with a baseline
+
+    Args:
+        results: results dictionary, as saved by main()
+        baseline: results dictionary of the baseline
+        tolerance: fraction a metric may be worse than the baseline before it counts as a regression
+
+    Returns: list of (benchmark, metric, baseline value, value, change, is regression) tuples
+
+    """
+
+    comparison = []
+    for name, metrics in results['results'].items():
+        for metric, value in metrics.items():
+            base = baseline['results'].get(name, {}).get(metric)
+            if not base:
+                continue
+            change = (value - base) / base
+            if metric.endswith(LOWER_IS_BETTER):
+                regression = change > tolerance
+            elif metric.endswith(HIGHER_IS_BETTER):
+                regression = change < -tolerance
+            else:
+                continue
+            comparison.append((name, metric, base, value, change, regression))
+    return comparison
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Measures scoring speed, startup time and peak memory on a '
+                                                 'synthetic dataset (or a given one), and compares the results '
+                                                 'with a saved baseline.')
+    parser.add_argument('benchmarks', nargs='*', default=[],
+                        help='benchmarks to run, from %s. Defaults to all' % ', '.join(BENCHMARKS))
+    parser.add_argument('--dataroot', default=None,
+                        help='dataset root directory. A synthetic dataset is generated there if it has no '
+                             'tables, or in a temporary directory if not given')
+    parser.add_argument('--version', default='v1.0-synthetic', help='dataset version (default v1.0-synthetic)')
+    parser.add_argument('--scenes', type=int, default=4, help='scenes in the synthetic dataset (default 4)')
+    parser.add_argument('--samples', type=int, default=40, help='samples per synthetic scene (default 40)')
+    parser.add_argument('--vehicles', type=int, default=20, help='vehicles per synthetic sample (default 20)')
+    parser.add_argument('--repeat', type=int, default=3, help='repeats of each timed part, the fastest is kept')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='worker processes for the dataset benchmark, defaults to the number of CPUs')
+    parser.add_argument('-o', '--output', default=None, help='JSON file to save the results to')
+    parser.add_argument('-c', '--compare', default=None, help='JSON file of baseline results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a metric may be worse than the baseline before it is reported as a '
+                             'regression (default 0.2)')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    """
+    Runs the benchmarks from the command line. Exits with status 1 if any metric regressed compared with
+    the baseline
+
+    """
+
+    args = parse_args(argv)
+    if args.child:
+        run_child(args.child, args.dataroot, args.version, args.repeat, args.workers)
+        return
+
+    temp_dir = None
+    dataroot = args.dataroot
+    if dataroot is None:
+        temp_dir = dataroot = tempfile.mkdtemp(prefix='rss-benchmark-')
+    dataset = {'version': args.version, 'generated': False}
+
+    try:
+        if not os.path.exists(os.path.join(dataroot, args.version, 'sample.json')):
+            from synthetic_dataset import generate_synthetic_dataset
+            generate_synthetic_dataset(dataroot, args.version, args.scenes, args.samples, args.vehicles)
+            dataset.update(generated=True, scenes=args.scenes, samples=args.samples, vehicles=args.vehicles)
+
+        benchmarks = args.benchmarks or BENCHMARKS
+        if 'startup_store' in benchmarks:
+            from metadata_store import open_metadata_store
+            open_metadata_store(dataroot, args.version, verbose=False)
+
+        results = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'dataset': dataset,
+            'results': {},
+        }
+        for name in benchmarks:
+            print('Running %s' % name, file=sys.stderr)
+            results['results'][name] = run_benchmark(name, dataroot, args.version, args.repeat, args.workers)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    for name, metrics in results['results'].items():
+        print('%s: %s' % (name, ', '.join('%s=%.4g' % item for item in metrics.items())))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = 0
+        for name, metric, base, value, change, regression in compare_results(results, baseline, args.tolerance):
+            regressions += regression
+            print('%-14s %-24s %10.4g -> %10.4g %+7.1f%%%s'
+                  % (name, metric, base, value, change * 100, '  REGRESSION' if regression else ''))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,3 +26,6 @@ renault_zoe_dims = {
     'length': 4.084,
     'width': 1.730
 }
+
+# Reasons given for non-perfect scores, in the order used to encode them as integers
+score_reasons = [None, 'Too close', 'Longitudinally too close', 'Laterally too close', 'Unknown']
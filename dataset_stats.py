@@ -0,0 +1,391 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from matplotlib import patches
+from matplotlib.figure import Figure
+
+import constants
+
+STATS_DIR = 'static/dataset_stats'
+
+# Bins of the score histograms, and of the heatmap of other vehicles' positions as
+# [longitudinal, lateral] in metres
+SCORE_BINS = 10
+HEATMAP_BINS = [25, 10]
+HEATMAP_RANGE = [[-5, 50], [-10, 10]]
+
+# Names of the figures saved by render_dataset_figures(), each as SVG and PDF
+FIGURE_NAMES = ['dataset', 'dataset_pie', 'dataset_danger', 'dataset_reasons', 'dataset_heatmap']
+
+
+class DatasetStats:
+    """
+    Aggregates of the scores over a whole dataset which the dataset figures are drawn from, updated a
+    table of scores at a time so that the scores themselves are never all held. Updates and reads are
+    locked, so the aggregates can be read while a background job is still adding scenes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scenes = 0
+        self.count = 0
+        self.score_histogram = np.zeros(SCORE_BINS, dtype=np.int64)
+        self.flagged_histogram = np.zeros(SCORE_BINS, dtype=np.int64)
+        self.reasons = np.zeros(len(constants.score_reasons), dtype=np.int64)
+        # longitudinal reasons split by whether the vehicles travel in the same direction, as [same, opposite]
+        self.longitudinal_directions = np.zeros(2, dtype=np.int64)
+        self.heatmap = np.zeros(HEATMAP_BINS, dtype=np.int64)
+
+    def add(self, table):
+        """
+        Adds the scores of a scene
+
+        Args:
+            table: ScoreTable of the scene's scores
+
+        """
+
+        score = table['score']
+        flagged = score < 1
+        reason = table['reason'][flagged]
+        same_direction = table['same_direction'][flagged]
+        longitudinal = reason == constants.score_reasons.index('Longitudinally too close')
+        long_distance = table['long_distance'][flagged]
+        lat_distance = table['lat_distance'][flagged]
+        located = np.isfinite(long_distance) & np.isfinite(lat_distance)
+
+        with self.lock:
+            self.scenes += 1
+            self.count += len(score)
+            self.score_histogram += np.histogram(score, SCORE_BINS, range=(0, 1))[0]
+            self.flagged_histogram += np.histogram(score[flagged], SCORE_BINS, range=(0, 1))[0]
+            self.reasons += np.bincount(reason, minlength=len(self.reasons))
+            self.longitudinal_directions += [np.count_nonzero(longitudinal & (same_direction == 1)),
+                                             np.count_nonzero(longitudinal & (same_direction == 0))]
+            self.heatmap += np.histogram2d(long_distance[located], lat_distance[located], HEATMAP_BINS,
+                                           range=HEATMAP_RANGE)[0].astype(np.int64)
+
+    @property
+    def flagged(self):
+        return int(self.flagged_histogram.sum())
+
+    def to_dict(self):
+        """
+        Describes the aggregates
+
+        Returns: dictionary which can be returned as JSON
+
+        """
+
+        with self.lock:
+            return {
+                'scenes': self.scenes,
+                'count': self.count,
+                'flagged': self.flagged,
+                'score_bins': np.linspace(0, 1, SCORE_BINS + 1).tolist(),
+                'score_histogram': self.score_histogram.tolist(),
+                'flagged_histogram': self.flagged_histogram.tolist(),
+                'reasons': {reason: int(count) for reason, count in zip(constants.score_reasons, self.reasons)
+                            if reason is not None},
+                'longitudinal_same_direction': int(self.longitudinal_directions[0]),
+                'longitudinal_opposite_direction': int(self.longitudinal_directions[1]),
+                'heatmap_range': HEATMAP_RANGE,
+                'heatmap': self.heatmap.tolist(),
+            }
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Restores aggregates described by to_dict()
+
+        Args:
+            values: dictionary from to_dict()
+
+        Returns: DatasetStats
+
+        """
+
+        stats = cls()
+        stats.scenes = values['scenes']
+        stats.count = values['count']
+        stats.score_histogram[:] = values['score_histogram']
+        stats.flagged_histogram[:] = values['flagged_histogram']
+        stats.reasons[:] = [values['reasons'].get(reason, 0) for reason in constants.score_reasons]
+        stats.longitudinal_directions[:] = [values['longitudinal_same_direction'],
+                                            values['longitudinal_opposite_direction']]
+        stats.heatmap[:] = values['heatmap']
+        return stats
+
+    def digest(self):
+        """
+        Finds a hash of the aggregates, which changes whenever the figures would
+
+        Returns: hex digest
+
+        """
+
+        values = self.to_dict()
+        # the figures do not show how many scenes the scores came from
+        del values['scenes']
+        return hashlib.sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+
+def get_stats_dir(version, params_hash, code_version):
+    """
+    Finds the directory the aggregates and figures of a dataset and parameter set are saved in
+
+    Args:
+        version: dataset version, e.g. v1.0-mini
+        params_hash: hash of the parameter set, see score_cache.get_params_hash()
+        code_version: hash of the scoring code, see score_cache.CODE_VERSION
+
+    Returns: path relative to the current directory, under STATS_DIR
+
+    """
+
+    return os.path.join(STATS_DIR, version, code_version[:16] + '-' + params_hash[:16])
+
+
+def is_process_running(pid):
+    """
+    Checks whether a process exists, for finding claims left by server processes which have stopped
+
+    Args:
+        pid: process ID
+
+    Returns: True if the process is running, or if that cannot be found on this platform
+
+    """
+
+    if not hasattr(os, 'fork'):
+        # os.kill() would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def claim_stats_job(out_dir):
+    """
+    Claims the analysis of a dataset and parameter set for the current process, so that when the UI is served
+    by several processes only one of them analyses the dataset. Claims of processes which have stopped are
+    taken over
+
+    Args:
+        out_dir: directory the aggregates and figures are saved to, see get_stats_dir()
+
+    Returns: True if the current process holds the claim, False if another process does
+
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, 'job.pid')
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(path) as f:
+                    pid = f.read().strip()
+                age = time.time() - os.path.getmtime(path)
+            except OSError:
+                continue
+            # an empty file is a claim which is still being written, unless it was left long ago
+            if pid == str(os.getpid()) or (pid and is_process_running(int(pid))) or (not pid and age < 10):
+                return pid == str(os.getpid())
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+    return False
+
+
+def release_stats_job(out_dir):
+    """
+    Releases a claim made by claim_stats_job(), and removes the progress it reported
+
+    Args:
+        out_dir: directory the aggregates and figures are saved to
+
+    """
+
+    for name in ['progress.json', 'job.pid']:
+        try:
+            os.remove(os.path.join(out_dir, name))
+        except OSError:
+            pass
+
+
+def write_stats_progress(out_dir, status):
+    """
+    Reports the progress of an analysis to other processes, see read_stats_progress()
+
+    Args:
+        out_dir: directory the aggregates and figures are saved to
+        status: job status dictionary, see jobs.Job.status()
+
+    """
+
+    path = os.path.join(out_dir, 'progress.json')
+    temp_path = path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(temp_path, path)
+
+
+def read_stats_progress(out_dir):
+    """
+    Reads the progress of an analysis running in another process
+
+    Args:
+        out_dir: directory the aggregates and figures are saved to
+
+    Returns: job status dictionary, or None if no progress has been reported
+
+    """
+
+    try:
+        with open(os.path.join(out_dir, 'progress.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_dataset_stats(out_dir):
+    """
+    Reads the aggregates saved by save_dataset_figures(), if their figures were all saved too
+
+    Args:
+        out_dir: directory the figures were saved to
+
+    Returns: DatasetStats, or None if there are no complete results
+
+    """
+
+    path = os.path.join(out_dir, 'stats.json')
+    if not all(os.path.exists(os.path.join(out_dir, name + '.svg')) for name in FIGURE_NAMES):
+        return None
+    try:
+        with open(path) as f:
+            return DatasetStats.from_dict(json.load(f)['stats'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_dataset_figures(stats, out_dir):
+    """
+    Saves the figures of the aggregates along with the aggregates, unless figures of the same aggregates
+    have already been saved there
+
+    Args:
+        stats: DatasetStats
+        out_dir: directory to save to
+
+    Returns: True if the figures were drawn, False if they were up to date
+
+    """
+
+    path = os.path.join(out_dir, 'stats.json')
+    digest = stats.digest()
+    saved = load_dataset_stats(out_dir)
+    if saved is not None and saved.digest() == digest:
+        return False
+
+    render_dataset_figures(stats, out_dir)
+    temp_path = path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'w') as f:
+        json.dump({'digest': digest, 'stats': stats.to_dict()}, f)
+    os.replace(temp_path, path)
+    return True
+
+
+def render_dataset_figures(stats, out_dir):
+    """
+    Saves graphs of the scores over the entire dataset as SVG and PDF files
+
+    Figures are created without pyplot, so that they can be drawn outside the main thread
+
+    Args:
+        stats: DatasetStats of every scene
+        out_dir: directory to save graphs to
+
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    edges = np.linspace(0, 1, SCORE_BINS + 1)
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.hist(edges[:-1], edges, weights=stats.score_histogram)
+    ax.set_title('Distribution of scores over entire dataset')
+    ax.set_xlabel('Score')
+    ax.set_ylabel('Number of occurrences')
+    fig.savefig(os.path.join(out_dir, 'dataset.svg'))
+    fig.savefig(os.path.join(out_dir, 'dataset.pdf'))
+
+    fig = Figure(figsize=(6.4, 3))
+    ax = fig.subplots()
+    labels = ['Perfect score', 'Non-perfect score']
+    values = [stats.count - stats.flagged, stats.flagged]
+    ax.pie(values, autopct=lambda x: int(x*stats.count/100), labels=labels)
+    ax.set_title('Proportion of perfect to non-perfect scores')
+    fig.subplots_adjust(bottom=0.0)
+    fig.savefig(os.path.join(out_dir, 'dataset_pie.svg'))
+    fig.savefig(os.path.join(out_dir, 'dataset_pie.pdf'))
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.hist(edges[:-1], edges, weights=stats.flagged_histogram)
+    ax.set_title('Distribution of non-perfect scores over entire dataset')
+    ax.set_xlabel('Score')
+    ax.set_ylabel('Number of occurrences')
+    fig.savefig(os.path.join(out_dir, 'dataset_danger.svg'))
+    fig.savefig(os.path.join(out_dir, 'dataset_danger.pdf'))
+
+    fig = Figure()
+    ax = fig.subplots()
+    lat = stats.reasons[constants.score_reasons.index('Laterally too close')]
+    other = stats.reasons[constants.score_reasons.index('Too close')]
+    reasons = ['Longitudinally\ntoo close\n(same\ndirection)',
+               'Longitudinally\ntoo close\n(opposite\ndirection)',
+               'Laterally\ntoo close', 'Too close']
+    values = [stats.longitudinal_directions[0], stats.longitudinal_directions[1], lat, other]
+    ax.bar(reasons, values)
+    ax.set_title('Reasons given for non-perfect scores')
+    ax.set_xlabel('Reason for score')
+    ax.set_ylabel('Number of occurrences')
+    fig.subplots_adjust(bottom=0.2)
+    fig.savefig(os.path.join(out_dir, 'dataset_reasons.svg'))
+    fig.savefig(os.path.join(out_dir, 'dataset_reasons.pdf'))
+
+    # Create another graph. A heatmap. It will show the locations of other vehicles in relation to the ego
+    # where an unsafe score has been given
+
+    fig = Figure(figsize=(6.4, 3))
+    ax = fig.subplots()
+    long_edges = np.linspace(*HEATMAP_RANGE[0], HEATMAP_BINS[0] + 1)
+    lat_edges = np.linspace(*HEATMAP_RANGE[1], HEATMAP_BINS[1] + 1)
+    ax.pcolormesh(long_edges, lat_edges, stats.heatmap.T)
+    l = constants.renault_zoe_dims['length']
+    w = constants.renault_zoe_dims['width']
+    rect = patches.Rectangle((-l, -w/2), l, w, linewidth=1, edgecolor='r', facecolor='w', label='Ego')
+    ax.add_patch(rect)
+    ax.set_aspect('equal')
+    ax.set_xlabel('Longitudinal distance (m)')
+    ax.set_ylabel('Lateral distance (m)')
+    ax.set_title('Relative translations of other vehicles in unsafe situations')
+    ax.legend()
+    fig.savefig(os.path.join(out_dir, 'dataset_heatmap.svg'))
+    fig.savefig(os.path.join(out_dir, 'dataset_heatmap.pdf'))
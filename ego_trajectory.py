@@ -0,0 +1,207 @@
+import numpy as np
+
+from metrics import timed
+
+# Poses further apart than this, in seconds, belong to different stretches of driving (e.g. two scenes of a
+# log), and velocities are not found across the gap between them
+MAX_GAP = 1.0
+
+# Time over which the ego velocity is found, in seconds, centred on the query time. Similar to the spacing
+# of the CAM_FRONT sweeps either side of a keyframe which were used before
+VELOCITY_WINDOW = 0.2
+
+# Velocity components smaller than this, in m/s, are rounding noise from interpolating positions, e.g. while
+# the ego is stopped, and are returned as exactly zero so that they cannot flip the direction-dependent
+# branches of the RSS distances
+VELOCITY_EPSILON = 1e-6
+
+
+class EgoTrajectory:
+    """
+    Poses of the ego over one log, sorted by time, so that its position, heading and velocity can be found at
+    any timestamp by binary search and linear interpolation. Every query accepts a single timestamp or an
+    array of timestamps, in microseconds as in nuScenes records.
+
+    Queries before the first or after the last pose are held at the end poses.
+    """
+
+    def __init__(self, timestamps, translations, yaws, max_gap=MAX_GAP):
+        """
+        Args:
+            timestamps: (N,) times of the poses in microseconds, in any order
+            translations: (N, 3) positions of the ego
+            yaws: (N,) yaws of the ego anti-clockwise from the x-axis
+            max_gap: poses further apart than this, in seconds, are in separate stretches of driving
+        """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        order = np.argsort(timestamps, kind='stable')
+        # several sensors can share a pose time, keep the first pose at each time
+        keep = np.concatenate([[True], np.diff(timestamps[order]) > 0]) if len(order) else np.zeros(0, bool)
+        order = order[keep]
+
+        self.timestamps = timestamps[order]
+        self.translations = np.asarray(translations, dtype=np.float64).reshape(-1, 3)[order]
+        # unwrapped so that interpolating between poses either side of +-pi turns the short way
+        self.yaws = np.unwrap(np.asarray(yaws, dtype=np.float64)[order])
+
+        gaps = np.diff(self.timestamps) > max_gap * 1e6
+        self.segments = np.concatenate([[0], np.cumsum(gaps)]).astype(np.int64)
+        starts = np.flatnonzero(np.concatenate([[True], gaps]))
+        ends = np.concatenate([starts[1:] - 1, [len(self.timestamps) - 1]])
+        self.segment_starts = self.timestamps[starts]
+        self.segment_ends = self.timestamps[ends]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _locate(self, timestamps):
+        """
+        Finds the poses either side of each timestamp and the interpolation weight of the later pose
+        """
+        t = np.asarray(timestamps, dtype=np.int64)
+        n = len(self.timestamps)
+        if n == 0:
+            raise ValueError('Ego trajectory has no poses')
+        after = np.clip(np.searchsorted(self.timestamps, t, side='right'), 1, max(n - 1, 1))
+        before = np.minimum(after - 1, n - 1)
+        after = np.minimum(after, n - 1)
+        span = (self.timestamps[after] - self.timestamps[before]).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(span > 0, (t - self.timestamps[before]) / span, 0.0)
+        return before, after, np.clip(weight, 0.0, 1.0)
+
+    def position(self, timestamps):
+        """
+        Finds the position of the ego
+
+        Args:
+            timestamps: time or array of times in microseconds
+
+        Returns: (..., 3) positions
+
+        """
+        before, after, weight = self._locate(timestamps)
+        weight = weight[..., None]
+        # in this form a timestamp at a pose gives exactly that pose
+        return (1 - weight) * self.translations[before] + weight * self.translations[after]
+
+    def yaw(self, timestamps):
+        """
+        Finds the yaw of the ego
+
+        Args:
+            timestamps: time or array of times in microseconds
+
+        Returns: yaws in radians anti-clockwise from the x-axis, unwrapped along the trajectory
+
+        """
+        before, after, weight = self._locate(timestamps)
+        return (1 - weight) * self.yaws[before] + weight * self.yaws[after]
+
+    def heading(self, timestamps):
+        """
+        Finds the heading of the ego, in the form given by get_ego_heading()
+
+        Args:
+            timestamps: time or array of times in microseconds
+
+        Returns: headings in radians anti-clockwise from the y-axis, in [0, 2pi)
+
+        """
+        return (self.yaw(timestamps) - (np.pi / 2)) % (2 * np.pi)
+
+    def velocity(self, timestamps, window=VELOCITY_WINDOW):
+        """
+        Finds the velocity of the ego by a centred difference of its positions over a short window, which
+        is cut short at either end of the stretch of driving containing the timestamp
+
+        Args:
+            timestamps: time or array of times in microseconds
+            window: time between the positions used for the difference, in seconds
+
+        Returns: (..., 3) velocities, NaN where there is only one pose to use. Components smaller than
+                 VELOCITY_EPSILON are zero
+
+        """
+        t = np.asarray(timestamps, dtype=np.int64)
+        segment = self.segments[np.clip(np.searchsorted(self.timestamps, t, side='right') - 1, 0,
+                                        len(self.timestamps) - 1)]
+        start = self.segment_starts[segment]
+        end = self.segment_ends[segment]
+        t = np.clip(t, start, end)
+        half = int(window * 1e6 / 2)
+        first = np.maximum(t - half, start)
+        last = np.minimum(t + half, end)
+        time_diff = (last - first) * 1e-6
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            velocity = (self.position(last) - self.position(first)) / time_diff[..., None]
+        velocity[np.abs(velocity) < VELOCITY_EPSILON] = 0
+        return np.where((time_diff > 0)[..., None], velocity, np.nan)
+
+
+def get_yaws(rotations):
+    """
+    Finds the rotation around the z-axis of many nuScenes rotations at once, in closed form rather than
+    by building a SciPy Rotation for each. Gives the same angle as Rotation.as_euler('xyz')[2]
+
+    Args:
+        rotations: (N, 4) rotation quaternions in nuScenes order [w, x, y, z], need not be normalised
+
+    Returns: (N,) yaws in radians, anti-clockwise from the x-axis
+
+    """
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 4)
+    w, x, y, z = rotations.T
+    # atan2 of the first column of the rotation matrix, which is scaled by the squared norm of the quaternion
+    return np.arctan2(2 * (w * z + x * y), w * w + x * x - y * y - z * z)
+
+
+@timed('build_ego_trajectories')
+def build_ego_trajectories(nusc):
+    """
+    Builds the trajectory of the ego in every log from all of its ego poses. Poses are assigned to logs
+    through the sample_data records which refer to them.
+
+    Args:
+        nusc: NuScenes object
+
+    Returns: dict mapping log token to EgoTrajectory
+
+    """
+    sample_log = {}
+    for scene in nusc.scene:
+        sample_token = scene['first_sample_token']
+        while sample_token:
+            sample_log[sample_token] = scene['log_token']
+            sample_token = nusc.get('sample', sample_token)['next']
+
+    poses = {}
+    for sample_data in nusc.sample_data:
+        log_token = sample_log.get(sample_data['sample_token'])
+        if log_token is not None:
+            poses.setdefault(log_token, set()).add(sample_data['ego_pose_token'])
+
+    trajectories = {}
+    for log_token, pose_tokens in poses.items():
+        records = [nusc.get('ego_pose', token) for token in sorted(pose_tokens)]
+        trajectories[log_token] = EgoTrajectory([r['timestamp'] for r in records],
+                                                [r['translation'] for r in records],
+                                                get_yaws([r['rotation'] for r in records]))
+    return trajectories
+
+
+def get_ego_trajectories(nusc):
+    """
+    Finds the ego trajectory of every log. The trajectories are built on first use and stored on the
+    NuScenes object, a metadata store provides them from its stored columns.
+
+    Args:
+        nusc: NuScenes object
+
+    Returns: dict mapping log token to EgoTrajectory
+
+    """
+    if getattr(nusc, 'ego_trajectories', None) is None:
+        nusc.ego_trajectories = build_ego_trajectories(nusc)
+    return nusc.ego_trajectories
@@ -0,0 +1,140 @@
+import threading
+import time
+import traceback
+import uuid
+
+# All jobs started by this process, by id and by key
+_jobs = {}
+_jobs_by_key = {}
+_lock = threading.Lock()
+
+
+class Job:
+    """
+    Long running work which is run on a background thread, so that request threads never wait for it.
+
+    The target function is called with the job as its only argument. It can report progress with
+    set_progress() and its return value is stored as the job's result. Jobs given a queue lock are queued
+    until they hold it, so that only one job sharing the lock runs at a time.
+    """
+
+    def __init__(self, key, target, queue=None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.target = target
+        self.queue = queue
+        self.state = 'queued' if queue is not None else 'running'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.start_time = time.time()
+        self.end_time = None
+        self.thread = threading.Thread(target=self.run, name='job-' + self.id, daemon=True)
+
+    def run(self):
+        if self.queue is None:
+            self.run_target()
+            return
+        with self.queue:
+            self.state = 'running'
+            self.start_time = time.time()
+            self.run_target()
+
+    def run_target(self):
+        try:
+            self.result = self.target(self)
+            self.state = 'done'
+        except Exception:
+            self.error = traceback.format_exc()
+            self.state = 'failed'
+        self.end_time = time.time()
+
+    def set_progress(self, done, total):
+        """
+        Records how much of the job has been completed
+
+        Args:
+            done: number of units of work completed
+            total: total number of units of work
+
+        """
+
+        self.done = done
+        self.total = total
+
+    def status(self):
+        """
+        Describes the progress of the job
+
+        Returns: dictionary which can be returned as JSON
+
+        """
+
+        elapsed = (self.end_time or time.time()) - self.start_time
+        eta = None
+        if self.state == 'running' and self.total and self.done:
+            eta = elapsed / self.done * (self.total - self.done)
+        return {
+            'id': self.id,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'elapsed': elapsed,
+            'eta': eta,
+            'error': self.error,
+        }
+
+
+def start_job(key, target, queue=None):
+    """
+    Starts a job, unless one with the same key is already queued, running or has finished successfully, in
+    which case that job is returned instead
+
+    Args:
+        key: hashable description of the work, e.g. the endpoint and parameter set
+        target: function to run, called with the job
+        queue: lock which the job holds while it runs, so that jobs sharing it run one at a time
+
+    Returns: Job object
+
+    """
+
+    with _lock:
+        job = _jobs_by_key.get(key)
+        if job is not None and job.state != 'failed':
+            return job
+
+        job = Job(key, target, queue)
+        _jobs[job.id] = job
+        _jobs_by_key[key] = job
+        job.thread.start()
+        return job
+
+
+def get_job(job_id):
+    """
+    Finds a job by id
+
+    Args:
+        job_id: id of the job
+
+    Returns: Job object, or None if there is no such job
+
+    """
+
+    return _jobs.get(job_id)
+
+
+def find_job(key):
+    """
+    Finds the most recent job started with a key
+
+    Args:
+        key: key the job was started with, see start_job()
+
+    Returns: Job object, or None if no job has been started with the key
+
+    """
+
+    return _jobs_by_key.get(key)
@@ -0,0 +1,483 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from nuscenes.utils.data_classes import Box
+from pyquaternion import Quaternion
+
+from ego_trajectory import EgoTrajectory, build_ego_trajectories, get_yaws
+
+# Fields kept for each table, with how they are stored:
+#   token: fixed width bytes, empty for no token
+#   str: unicode string
+#   int, bool: integer or boolean
+#   vector: fixed length list of floats, stored as a 2-D array
+#   token_list: variable length list of tokens, stored as values and offsets arrays
+# data.<channel> fields of sample are combined into the sample's data dictionary
+SCHEMA = {
+    'category': [('token', 'token'), ('name', 'str'), ('description', 'str')],
+    'attribute': [('token', 'token'), ('name', 'str'), ('description', 'str')],
+    'log': [('token', 'token'), ('logfile', 'str'), ('vehicle', 'str'), ('date_captured', 'str'),
+            ('location', 'str')],
+    'scene': [('token', 'token'), ('name', 'str'), ('description', 'str'), ('log_token', 'token'),
+              ('nbr_samples', 'int'), ('first_sample_token', 'token'), ('last_sample_token', 'token')],
+    'instance': [('token', 'token'), ('category_token', 'token'), ('nbr_annotations', 'int'),
+                 ('first_annotation_token', 'token'), ('last_annotation_token', 'token')],
+    'calibrated_sensor': [('token', 'token'), ('sensor_token', 'token'), ('translation', 'vector'),
+                          ('rotation', 'vector')],
+    'ego_pose': [('token', 'token'), ('timestamp', 'int'), ('translation', 'vector'), ('rotation', 'vector')],
+    'sample': [('token', 'token'), ('timestamp', 'int'), ('scene_token', 'token'), ('prev', 'token'),
+               ('next', 'token'), ('data.CAM_FRONT', 'token'), ('data.RADAR_FRONT', 'token'),
+               ('anns', 'token_list')],
+    'sample_data': [('token', 'token'), ('sample_token', 'token'), ('ego_pose_token', 'token'),
+                    ('calibrated_sensor_token', 'token'), ('timestamp', 'int'), ('is_key_frame', 'bool'),
+                    ('channel', 'str'), ('prev', 'token'), ('next', 'token')],
+    'sample_annotation': [('token', 'token'), ('sample_token', 'token'), ('instance_token', 'token'),
+                          ('attribute_tokens', 'token_list'), ('translation', 'vector'), ('size', 'vector'),
+                          ('rotation', 'vector'), ('prev', 'token'), ('next', 'token'),
+                          ('category_name', 'str')],
+}
+
+# Channels of sample_data used by the scorer
+CHANNELS = ['CAM_FRONT', 'RADAR_FRONT']
+
+# JSON tables the store is converted from, used to tell when the store is out of date
+SOURCE_TABLES = ['category', 'attribute', 'log', 'scene', 'instance', 'calibrated_sensor', 'ego_pose',
+                 'sample', 'sample_data', 'sample_annotation', 'sensor']
+
+TOKEN_DTYPE = 'S32'
+STORE_FORMAT = 2
+
+# Columns of the stored ego trajectories, see build_ego_trajectories(). Poses of all logs are concatenated in
+# the order of the log table, with offsets giving where each log starts
+TRAJECTORY_COLUMNS = ['timestamp', 'translation', 'yaw', 'offsets']
+
+
+class Table:
+    """
+    A table of the store. Columns are numpy arrays, usually memory-mapped, with one row per record.
+    Rows are returned as dictionaries in the same form as NuScenes records, but only with the fields
+    in SCHEMA.
+    """
+
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+        self.fields = SCHEMA[name]
+        self.tokens = columns['token']
+        self.sorted_tokens = columns['token.sorted']
+        self.sorted_rows = columns['token.rows']
+        self.readers = [(field, self._reader(field, kind)) for field, kind in self.fields]
+
+    def _reader(self, field, kind):
+        """
+        Makes a function which reads a field of a row as the type used by NuScenes records
+        """
+
+        if kind == 'token_list':
+            values = self.columns[field + '.values']
+            offsets = self.columns[field + '.offsets']
+            return lambda row: [t.decode() for t in values[offsets[row]:offsets[row + 1]].tolist()]
+
+        column = self.columns[field]
+        if kind == 'token':
+            return lambda row: column[row].decode()
+        if kind == 'str':
+            return lambda row: str(column[row])
+        if kind == 'int':
+            return lambda row: int(column[row])
+        if kind == 'bool':
+            return lambda row: bool(column[row])
+        return lambda row: column[row].tolist()
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, row):
+        record = {}
+        data = {}
+        for field, read in self.readers:
+            if field.startswith('data.'):
+                value = read(row)
+                if value:
+                    data[field[5:]] = value
+            else:
+                record[field] = read(row)
+        if data:
+            record['data'] = data
+        return record
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def index(self, token):
+        """
+        Finds the row of a record
+
+        Args:
+            token: token of the record
+
+        Returns: row of the record
+
+        """
+
+        key = token.encode()
+        i = np.searchsorted(self.sorted_tokens, key)
+        if i >= len(self.sorted_tokens) or self.sorted_tokens[i] != key:
+            raise KeyError(token)
+        return int(self.sorted_rows[i])
+
+
+class MetadataStore:
+    """
+    Compact, memory-mapped copy of the parts of a nuScenes dataset used by the scorer.
+
+    It provides the subset of the NuScenes API the scoring functions use (get(), getind(), box_velocity(),
+    get_box() and the table attributes), so that scoring can run on it in place of a NuScenes object.
+    Only sample_data records for the CAM_FRONT and RADAR_FRONT keyframes and their neighbouring camera
+    sweeps are kept, with their ego poses, but the ego trajectory of each log is stored whole. Opening the
+    store only maps the files, so it takes a fraction of a second and processes opening the same store
+    share its pages.
+    """
+
+    def __init__(self, version='v1.0-mini', dataroot='/data/sets/nuscenes', verbose=False):
+        self.version = version
+        self.dataroot = dataroot
+        self.verbose = verbose
+        self.store_root = get_store_root(dataroot, version)
+
+        start_time = time.time()
+        with open(os.path.join(self.store_root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['format'] != STORE_FORMAT:
+            raise ValueError('Metadata store at %s has an unsupported format, convert the dataset again'
+                             % self.store_root)
+
+        self.tables = {}
+        for name in SCHEMA:
+            # plain array views of the memory maps, indexing np.memmap objects is several times slower
+            columns = {column: np.load(os.path.join(self.store_root, '%s.%s.npy' % (name, column)),
+                                       mmap_mode='r').view(np.ndarray)
+                       for column in self.meta['columns'][name]}
+            self.tables[name] = Table(name, columns)
+        self.table_names = list(SCHEMA)
+        self.trajectory_columns = {column: np.load(os.path.join(self.store_root, 'ego_trajectory.%s.npy' % column),
+                                                   mmap_mode='r').view(np.ndarray)
+                                   for column in TRAJECTORY_COLUMNS}
+
+        # small tables are kept as lists of records, as in NuScenes
+        self.category = list(self.tables['category'])
+        self.attribute = list(self.tables['attribute'])
+        self.log = list(self.tables['log'])
+        self.scene = list(self.tables['scene'])
+        self.calibrated_sensor = list(self.tables['calibrated_sensor'])
+        self.instance = self.tables['instance']
+        self.ego_pose = self.tables['ego_pose']
+        self.sample = self.tables['sample']
+        self.sample_data = self.tables['sample_data']
+        self.sample_annotation = self.tables['sample_annotation']
+
+        self._annotation_masks = None
+        self._ego_trajectories = None
+        self._annotation_yaws = None
+
+        if verbose:
+            print('Opened metadata store for version %s in %.3f seconds' % (version, time.time() - start_time))
+
+    def get(self, table_name, token):
+        """
+        Returns a record from a table, see NuScenes.get()
+        """
+        table = self.tables[table_name]
+        return table[table.index(token)]
+
+    def getind(self, table_name, token):
+        """
+        Returns the index of a record in a table, see NuScenes.getind()
+        """
+        return self.tables[table_name].index(token)
+
+    def box_velocity(self, sample_annotation_token, max_time_diff=1.5):
+        """
+        Estimates the velocity of an annotation in the same way as NuScenes.box_velocity(), reading the
+        columns directly rather than building records
+        """
+
+        annotations = self.sample_annotation
+        row = annotations.index(sample_annotation_token)
+        prev_token = annotations.columns['prev'][row]
+        next_token = annotations.columns['next'][row]
+        has_prev = prev_token != b''
+        has_next = next_token != b''
+
+        # Cannot estimate velocity for a single annotation.
+        if not has_prev and not has_next:
+            return np.array([np.nan, np.nan, np.nan])
+
+        first = annotations.index(prev_token.decode()) if has_prev else row
+        last = annotations.index(next_token.decode()) if has_next else row
+
+        translations = annotations.columns['translation']
+        pos_diff = np.array(translations[last].tolist()) - np.array(translations[first].tolist())
+
+        sample_tokens = annotations.columns['sample_token']
+        timestamps = self.sample.columns['timestamp']
+        time_last = 1e-6 * int(timestamps[self.sample.index(sample_tokens[last].decode())])
+        time_first = 1e-6 * int(timestamps[self.sample.index(sample_tokens[first].decode())])
+        time_diff = time_last - time_first
+
+        if has_next and has_prev:
+            # If doing centered difference, allow for up to double the max_time_diff.
+            max_time_diff *= 2
+
+        if time_diff > max_time_diff:
+            return np.array([np.nan, np.nan, np.nan])
+        return pos_diff / time_diff
+
+    def get_box(self, sample_annotation_token):
+        """
+        Returns the Box of an annotation, see NuScenes.get_box()
+        """
+        record = self.get('sample_annotation', sample_annotation_token)
+        return Box(record['translation'], record['size'], Quaternion(record['rotation']),
+                   name=record['category_name'], token=record['token'])
+
+    @property
+    def annotation_masks(self):
+        """
+        Category and attribute masks for every annotation, see get_annotation_masks(). Found from the
+        stored row indexes rather than record by record
+        """
+
+        if self._annotation_masks is None:
+            columns = self.sample_annotation.columns
+            is_vehicle_category = np.array(['vehicle' in c['name'] for c in self.category], dtype=bool)
+            annotation_category = self.instance.columns['category_row'][columns['instance_row']]
+
+            excluded = np.array([a['name'] in ['vehicle.parked', 'cycle.without_rider'] for a in self.attribute],
+                                dtype=bool)
+            offsets = columns['attribute_tokens.offsets']
+            counts = np.cumsum(np.concatenate([[0], excluded[columns['attribute_rows']]]))
+            is_parked_or_riderless = (counts[offsets[1:]] - counts[offsets[:-1]]) > 0
+
+            self._annotation_masks = {
+                'category': annotation_category,
+                'is_vehicle': is_vehicle_category[annotation_category],
+                'is_parked_or_riderless': is_parked_or_riderless,
+            }
+        return self._annotation_masks
+
+    @property
+    def annotation_yaws(self):
+        """
+        Yaw of every annotation, see get_annotation_yaws(). Found from the stored rotation column in one pass
+        """
+
+        if self._annotation_yaws is None:
+            self._annotation_yaws = get_yaws(self.sample_annotation.columns['rotation'])
+        return self._annotation_yaws
+
+    @property
+    def ego_trajectories(self):
+        """
+        Ego trajectory of every log, see get_ego_trajectories(). Built from the stored trajectory columns
+        """
+
+        if self._ego_trajectories is None:
+            columns = self.trajectory_columns
+            offsets = columns['offsets']
+            self._ego_trajectories = {
+                log['token']: EgoTrajectory(columns['timestamp'][start:end], columns['translation'][start:end],
+                                            columns['yaw'][start:end])
+                for log, start, end in zip(self.log, offsets[:-1], offsets[1:]) if end > start
+            }
+        return self._ego_trajectories
+
+
+def get_store_root(dataroot, version):
+    """
+    Finds the directory a dataset's metadata store is kept in
+
+    Args:
+        dataroot: dataset root directory
+        version: dataset version
+
+    Returns: path of the directory
+
+    """
+
+    return os.path.join(dataroot, 'columnar', version)
+
+
+def get_source_stamp(dataroot, version):
+    """
+    Describes the JSON tables of a dataset so that changes to them can be detected
+
+    Args:
+        dataroot: dataset root directory
+        version: dataset version
+
+    Returns: dictionary of table name to [size, modification time]
+
+    """
+
+    stamp = {}
+    for name in SOURCE_TABLES:
+        path = os.path.join(dataroot, version, name + '.json')
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stamp[name] = [stat.st_size, int(stat.st_mtime)]
+    return stamp
+
+
+def convert_to_metadata_store(nusc):
+    """
+    Writes the metadata store for a loaded dataset
+
+    Args:
+        nusc: NuScenes object
+
+    Returns: path of the store directory
+
+    """
+
+    store_root = get_store_root(nusc.dataroot, nusc.version)
+    os.makedirs(store_root, exist_ok=True)
+
+    # keep the keyframes of the channels used by the scorer, and the camera sweeps either side of them
+    # which are used to find the ego velocity
+    kept_sample_data = set()
+    for sample in nusc.sample:
+        for channel in CHANNELS:
+            if channel in sample['data']:
+                sample_data = nusc.get('sample_data', sample['data'][channel])
+                kept_sample_data.add(sample_data['token'])
+                if channel == 'CAM_FRONT':
+                    kept_sample_data.update(t for t in [sample_data['prev'], sample_data['next']] if t)
+    sample_data_records = [r for r in nusc.sample_data if r['token'] in kept_sample_data]
+    kept_ego_poses = {r['ego_pose_token'] for r in sample_data_records}
+
+    records = {
+        'category': nusc.category,
+        'attribute': nusc.attribute,
+        'log': nusc.log,
+        'scene': nusc.scene,
+        'instance': nusc.instance,
+        'calibrated_sensor': nusc.calibrated_sensor,
+        'ego_pose': [r for r in nusc.ego_pose if r['token'] in kept_ego_poses],
+        'sample': [dict(r, **{'data.' + c: r['data'].get(c, '') for c in CHANNELS}) for r in nusc.sample],
+        'sample_data': sample_data_records,
+        'sample_annotation': nusc.sample_annotation,
+    }
+
+    columns = {}
+    for name, fields in SCHEMA.items():
+        table = {}
+        for field, kind in fields:
+            values = [r[field] for r in records[name]]
+            if kind == 'token':
+                table[field] = _encode_tokens(values)
+            elif kind == 'str':
+                table[field] = np.array(values, dtype=str)
+            elif kind == 'int':
+                table[field] = np.array(values, dtype=np.int64)
+            elif kind == 'bool':
+                table[field] = np.array(values, dtype=bool)
+            elif kind == 'vector':
+                table[field] = np.array(values, dtype=np.float64).reshape(len(values), -1)
+            else:
+                table[field + '.values'] = _encode_tokens([t for v in values for t in v])
+                table[field + '.offsets'] = np.cumsum([0] + [len(v) for v in values]).astype(np.int64)
+        order = np.argsort(table['token'], kind='stable')
+        table['token.sorted'] = table['token'][order]
+        table['token.rows'] = order.astype(np.int64)
+        columns[name] = table
+
+    # row indexes used to find the annotation masks without token lookups
+    columns['instance']['category_row'] = np.array([nusc.getind('category', t) for t in
+                                                    (r['category_token'] for r in nusc.instance)], dtype=np.int64)
+    columns['sample_annotation']['instance_row'] = np.array([nusc.getind('instance', r['instance_token'])
+                                                             for r in nusc.sample_annotation], dtype=np.int64)
+    columns['sample_annotation']['attribute_rows'] = np.array(
+        [nusc.getind('attribute', t) for r in nusc.sample_annotation for t in r['attribute_tokens']], dtype=np.int64)
+
+    # the trajectories are kept whole, rather than only the ego poses of the kept sample_data
+    trajectories = build_ego_trajectories(nusc)
+    log_trajectories = [trajectories[log['token']] for log in nusc.log if log['token'] in trajectories]
+    columns['ego_trajectory'] = {
+        'timestamp': np.concatenate([t.timestamps for t in log_trajectories] + [np.zeros(0, np.int64)]),
+        'translation': np.concatenate([t.translations for t in log_trajectories] + [np.zeros((0, 3))]),
+        'yaw': np.concatenate([t.yaws for t in log_trajectories] + [np.zeros(0)]),
+        'offsets': np.cumsum([0] + [len(trajectories[log['token']]) if log['token'] in trajectories else 0
+                                    for log in nusc.log]).astype(np.int64),
+    }
+
+    for name, table in columns.items():
+        for column, values in table.items():
+            np.save(os.path.join(store_root, '%s.%s.npy' % (name, column)), values)
+
+    meta = {
+        'format': STORE_FORMAT,
+        'version': nusc.version,
+        'source': get_source_stamp(nusc.dataroot, nusc.version),
+        'columns': {name: list(table) for name, table in columns.items()},
+    }
+    with open(os.path.join(store_root, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    return store_root
+
+
+def _encode_tokens(tokens):
+    encoded = np.array(tokens, dtype=TOKEN_DTYPE) if tokens else np.zeros(0, dtype=TOKEN_DTYPE)
+    if any(len(t) > 32 for t in tokens):
+        raise ValueError('Tokens longer than 32 characters cannot be stored')
+    return encoded
+
+
+def is_store_up_to_date(dataroot, version):
+    """
+    Checks whether a dataset has a metadata store which matches its JSON tables
+
+    Args:
+        dataroot: dataset root directory
+        version: dataset version
+
+    Returns: True if the store exists and is up to date
+
+    """
+
+    meta_path = os.path.join(get_store_root(dataroot, version), 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta['format'] == STORE_FORMAT and meta['source'] == get_source_stamp(dataroot, version)
+
+
+def open_metadata_store(dataroot, version, verbose=True):
+    """
+    Opens the metadata store for a dataset, converting the dataset first if there is no up to date store
+
+    Args:
+        dataroot: dataset root directory
+        version: dataset version
+        verbose: whether to print status messages
+
+    Returns: MetadataStore object
+
+    """
+
+    if not is_store_up_to_date(dataroot, version):
+        from nuscenes.nuscenes import NuScenes
+        if verbose:
+            print('Converting %s to a metadata store, this only needs to be done once' % version)
+        convert_to_metadata_store(NuScenes(version=version, dataroot=dataroot, verbose=verbose))
+    return MetadataStore(version=version, dataroot=dataroot, verbose=verbose)
+
+
+if __name__ == '__main__':
+    open_metadata_store(sys.argv[1], sys.argv[2])
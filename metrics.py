@@ -0,0 +1,244 @@
+import functools
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+# Maximum number of latencies kept for each stage. Counts and totals are exact, percentiles are found from a
+# uniform sample of the calls once a stage has been called more often than this
+MAX_SAMPLES = 4096
+
+# NuScenes methods timed as stages by instrument_dataset(), lookups are counted by table instead
+DATASET_STAGES = ['get_box', 'box_velocity']
+
+_enabled = os.environ.get('RSS_METRICS', '') not in ['', '0']
+_stages = {}
+_lookups = {}
+_lock = threading.Lock()
+
+
+class Stage:
+    """
+    Call count, total time and a sample of latencies for one stage
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(seconds)
+        else:
+            # reservoir sampling, so that the samples stay uniform over all calls
+            i = random.randrange(self.count)
+            if i < MAX_SAMPLES:
+                self.samples[i] = seconds
+
+    def merge(self, other):
+        if len(self.samples) + len(other.samples) > MAX_SAMPLES:
+            # keep the samples in proportion to the number of calls each side represents
+            keep = round(MAX_SAMPLES * self.count / (self.count + other.count))
+            samples = random.sample(self.samples, min(keep, len(self.samples)))
+            samples += random.sample(other.samples, min(MAX_SAMPLES - len(samples), len(other.samples)))
+            self.samples = samples
+        else:
+            self.samples = self.samples + other.samples
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        p50, p90, p99 = np.percentile(self.samples, [50, 90, 99]) if self.samples else (0, 0, 0)
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0,
+            'p50_ms': 1000 * p50,
+            'p90_ms': 1000 * p90,
+            'p99_ms': 1000 * p99,
+            'max_ms': 1000 * self.max,
+        }
+
+
+def enable_metrics(enabled=True):
+    """
+    Switches recording on or off. Recording is off unless the RSS_METRICS environment variable is set
+
+    Args:
+        enabled: whether stages should be recorded
+
+    """
+
+    global _enabled
+    _enabled = enabled
+
+
+def metrics_enabled():
+    return _enabled
+
+
+def reset_metrics():
+    """
+    Discards everything recorded so far
+    """
+
+    with _lock:
+        _stages.clear()
+        _lookups.clear()
+
+
+def record(stage, seconds):
+    """
+    Records one call of a stage
+
+    Args:
+        stage: name of the stage
+        seconds: time taken by the call
+
+    """
+
+    with _lock:
+        if stage not in _stages:
+            _stages[stage] = Stage()
+        _stages[stage].add(seconds)
+
+
+def count_lookup(table):
+    with _lock:
+        _lookups[table] = _lookups.get(table, 0) + 1
+
+
+def timed(stage):
+    """
+    Decorator which records the time taken by each call of a function as a stage. When recording is off
+    the function is called directly, at the cost of one flag check
+
+    Args:
+        stage: name of the stage
+
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start_time)
+        return wrapper
+    return decorator
+
+
+def instrument_dataset(nusc):
+    """
+    Counts the record lookups made through nusc.get() and nusc.getind() by table, and times the
+    NuScenes methods in DATASET_STAGES. Only the given object is changed, and only if recording is on
+
+    Args:
+        nusc: NuScenes object
+
+    """
+
+    if not _enabled or getattr(nusc, 'instrumented', False):
+        return
+
+    def counted(method):
+        @functools.wraps(method)
+        def wrapper(table_name, token):
+            if _enabled:
+                count_lookup(table_name)
+            return method(table_name, token)
+        return wrapper
+
+    nusc.get = counted(nusc.get)
+    nusc.getind = counted(nusc.getind)
+    for name in DATASET_STAGES:
+        setattr(nusc, name, timed('nusc.' + name)(getattr(nusc, name)))
+    nusc.instrumented = True
+
+
+def take_metrics_state():
+    """
+    Returns everything recorded so far and resets the records, so that worker processes can send their
+    records to the parent, see merge_metrics_state()
+
+    Returns: tuple of (stages, lookups) which can be pickled
+
+    """
+
+    with _lock:
+        state = (dict(_stages), dict(_lookups))
+        _stages.clear()
+        _lookups.clear()
+    return state
+
+
+def merge_metrics_state(state):
+    """
+    Adds records taken from another process with take_metrics_state() to this process's records
+
+    Args:
+        state: tuple of (stages, lookups)
+
+    """
+
+    stages, lookups = state
+    with _lock:
+        for name, stage in stages.items():
+            if name in _stages:
+                _stages[name].merge(stage)
+            else:
+                _stages[name] = stage
+        for table, count in lookups.items():
+            _lookups[table] = _lookups.get(table, 0) + count
+
+
+def get_metrics():
+    """
+    Summarises everything recorded so far
+
+    Returns: dictionary which can be returned as JSON, with stages ordered by total time
+
+    """
+
+    with _lock:
+        stages = {name: stage.summary() for name, stage in _stages.items()}
+        lookups = dict(_lookups)
+    stages = dict(sorted(stages.items(), key=lambda item: -item[1]['total_seconds']))
+    return {'enabled': _enabled, 'stages': stages, 'lookups': lookups, 'total_lookups': sum(lookups.values())}
+
+
+def format_metrics(metrics=None):
+    """
+    Formats a summary of the records as a table
+
+    Args:
+        metrics: summary from get_metrics(), found if not given
+
+    Returns: string
+
+    """
+
+    metrics = metrics or get_metrics()
+    lines = ['%-40s %10s %10s %9s %9s %9s %9s' % ('stage', 'calls', 'total s', 'mean ms', 'p50 ms', 'p90 ms',
+                                                   'p99 ms')]
+    for name, stage in metrics['stages'].items():
+        lines.append('%-40s %10d %10.3f %9.3f %9.3f %9.3f %9.3f'
+                     % (name, stage['count'], stage['total_seconds'], stage['mean_ms'], stage['p50_ms'],
+                        stage['p90_ms'], stage['p99_ms']))
+    lines.append('')
+    lines.append('nusc.get lookups: %d (%s)' % (metrics['total_lookups'],
+                                                ', '.join('%s %d' % item for item in sorted(
+                                                    metrics['lookups'].items(), key=lambda item: -item[1]))))
+    return '\n'.join(lines)
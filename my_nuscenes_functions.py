@@ -1,53 +1,28 @@
 import numpy as np
 from constants import *
-from scipy.spatial.transform import Rotation
+from ego_trajectory import get_ego_trajectories, get_yaws
+from metrics import timed
 
 
+@timed('get_ego_velocity')
 def get_ego_velocity(nusc, sample_token):
     """
-    Finds the velocity of the ego in a given sample
-
-    Adapted from NuScenes SDK method NuScenes.box_velocity() (https://github.com/nutonomy/nuscenes-devkit/blob/master/python-sdk/nuscenes/nuscenes.py)
+    Finds the velocity of the ego in a given sample, from the ego trajectory of its log at the
+    sample's timestamp (see EgoTrajectory.velocity())
 
         Parameters:
             nusc: NuScenes object
             sample_token (str): sample_token to calculate velocity for
         Returns:
-            velocity: velocity of ego
+            velocity: velocity of ego, NaN if the log has only one ego pose
 
     """
-    velocity = np.zeros(3)
-
-    sample_data_token = nusc.get('sample', sample_token)['data']['CAM_FRONT']
-    sample_data = nusc.get('sample_data', sample_data_token)
-    sample_data_token_prev = sample_data['prev']
-    sample_data_token_next = sample_data['next']
-
-    # cannot calculate velocity if there are no adjacent samples
-    if not (sample_data_token_prev or sample_data_token_next):
-        velocity[:] = np.nan
-        return velocity
-
-    # use this sample if only one adjacent sample
-    if not sample_data_token_prev:
-        sample_data_token_prev = sample_data_token
-    if not sample_data_token_next:
-        sample_data_token_next = sample_data_token
-
-    sample_data_prev = nusc.get('sample_data', sample_data_token_prev)
-    sample_data_next = nusc.get('sample_data', sample_data_token_next)
-
-    ego_pose_prev = nusc.get('ego_pose', sample_data_prev['ego_pose_token'])
-    ego_pose_next = nusc.get('ego_pose', sample_data_next['ego_pose_token'])
-
-    delta_translation = np.array(ego_pose_next['translation']) - np.array(ego_pose_prev['translation'])
-    delta_time = (ego_pose_next['timestamp'] - ego_pose_prev['timestamp']) * 1e-6
-    velocity = delta_translation / delta_time
-
-    return velocity
+    sample = nusc.get('sample', sample_token)
+    return get_sample_trajectory(nusc, sample).velocity(sample['timestamp'])
 
 
-def get_delta_translation(nusc, annotation, heading_angle):
+@timed('get_delta_translation')
+def get_delta_translation(nusc, annotation, heading_angle, ego_bb=None, ann_bb=None):
     """
     Takes an annotation dictionary and finds the translation between it and the ego.
 
@@ -57,26 +32,35 @@ def get_delta_translation(nusc, annotation, heading_angle):
             heading_angle: Heading of ego anti-clockwise from north
             nusc: NuScenes object
             annotation: dictionary annotation
+            ego_bb: bounding box of the ego, e.g. from an ego state table. Found from the
+                    ego trajectory at the annotation's sample if not given
+            ann_bb: corners of the annotation on the ground, e.g. from get_annotation_footprints().
+                    Found from the annotation's yaw if not given
         Returns:
             translation: numpy array in form [x,y]
     """
-    sample = nusc.get('sample', annotation['sample_token'])
-    sample_data_token = sample['data']['RADAR_FRONT']
-    sample_data = nusc.get('sample_data', sample_data_token)
-    ego_pose = nusc.get('ego_pose', sample_data['ego_pose_token'])
-    ego_trans = np.array(ego_pose['translation'])[0:2]
+    if ego_bb is None:
+        ego_bb = build_ego_state_table(nusc, [annotation['sample_token']])['bounding_box'][0]
 
-    w = renault_zoe_dims['width']
-    l = renault_zoe_dims['length']
+    if ann_bb is None:
+        ann_bb = get_annotation_footprints(nusc, [nusc.getind('sample_annotation', annotation['token'])])[0]
 
-    r = ego_pose['rotation']
-    r = [r[1], r[2], r[3], r[0]]  # convert to scalar last as required by SciPy
-    r = Rotation.from_quat(r)
-    angle = r.as_euler('xyz')[2]  # lowercase xyz for extrinsic, take the rotation around z axis
+    return find_translation(ego_bb, ann_bb, heading_angle)
 
-    # find offset to front of car
-    calibrated_sensor = nusc.get('calibrated_sensor', sample_data['calibrated_sensor_token'])
-    offset = calibrated_sensor['translation'][0]
+
+def get_ego_bounding_box(ego_trans, angle, offset):
+    """
+    Finds the corners of the ego's bounding box
+
+        Parameters:
+            ego_trans: position of the ego pose in form [x,y]
+            angle: yaw of the ego pose in radians
+            offset: longitudinal distance from the ego pose to the front of the car
+        Returns:
+            ego_bb: numpy array of corners in order front-right, front-left, back-left, back-right
+    """
+    w = renault_zoe_dims['width']
+    l = renault_zoe_dims['length']
 
     front_right = rotation(angle, np.array([offset, -w / 2]))
     front_left = rotation(angle, np.array([offset, w / 2]))
@@ -88,12 +72,270 @@ def get_delta_translation(nusc, annotation, heading_angle):
               ego_trans + back_left,  # back-left
               ego_trans + back_right]  # back-right
 
-    ego_bb = np.array(ego_bb)
+    return np.array(ego_bb)
 
-    ann_bb = nusc.get_box(annotation['token']).bottom_corners()[0:2]
-    ann_bb = np.array(list(zip(ann_bb[0], ann_bb[1])))
 
-    return find_translation(ego_bb, ann_bb, heading_angle)
+@timed('build_ego_state_table')
+def build_ego_state_table(nusc, sample_tokens):
+    """
+    Precomputes the state of the ego for each of the given samples, so that annotations in the same
+    sample can share it rather than each looking up the ego's pose again.
+
+    Position, yaw and velocity are all found from the ego trajectory of the sample's log at the sample's
+    timestamp, the time the annotations are for, so they are consistent with each other and with the
+    annotations. The samples of each log are looked up in one batch.
+
+        Parameters:
+            nusc: NuScenes object
+            sample_tokens: tokens of the samples to include, e.g. from get_scene_sample_tokens()
+        Returns:
+            ego_states: dict of contiguous arrays with one row per sample
+                index: dict mapping sample token to row
+                translation: (N, 2) position of the ego
+                yaw: (N,) yaw of the ego anti-clockwise from the x-axis
+                heading: (N,) heading of the ego as given by get_ego_heading()
+                velocity: (N, 3) velocity of the ego as given by get_ego_velocity()
+                long_velocity: (N,) velocity of the ego along its heading, negative when reversing
+                radar_offset: (N,) longitudinal offset of RADAR_FRONT, taken as the front of the car
+                bounding_box: (N, 4, 2) corners of the ego as given by get_ego_bounding_box()
+    """
+    n = len(sample_tokens)
+    ego_states = {
+        'index': {},
+        'translation': np.zeros((n, 2)),
+        'yaw': np.zeros(n),
+        'heading': np.zeros(n),
+        'velocity': np.zeros((n, 3)),
+        'long_velocity': np.zeros(n),
+        'radar_offset': np.zeros(n),
+        'bounding_box': np.zeros((n, 4, 2)),
+    }
+
+    timestamps = np.zeros(n, dtype=np.int64)
+    log_rows = {}
+    for i, sample_token in enumerate(sample_tokens):
+        sample = nusc.get('sample', sample_token)
+        sample_data = nusc.get('sample_data', sample['data']['RADAR_FRONT'])
+        calibrated_sensor = nusc.get('calibrated_sensor', sample_data['calibrated_sensor_token'])
+
+        ego_states['index'][sample_token] = i
+        ego_states['radar_offset'][i] = calibrated_sensor['translation'][0]
+        timestamps[i] = sample['timestamp']
+        log_rows.setdefault(nusc.get('scene', sample['scene_token'])['log_token'], []).append(i)
+
+    trajectories = get_ego_trajectories(nusc)
+    for log_token, rows in log_rows.items():
+        trajectory = trajectories[log_token]
+        ego_states['translation'][rows] = trajectory.position(timestamps[rows])[:, 0:2]
+        ego_states['yaw'][rows] = trajectory.yaw(timestamps[rows])
+        ego_states['velocity'][rows] = trajectory.velocity(timestamps[rows])
+    ego_states['heading'] = (ego_states['yaw'] - (np.pi / 2)) % (2 * np.pi)
+
+    for i in range(n):
+        ego_states['long_velocity'][i] = rotation(-ego_states['heading'][i], ego_states['velocity'][i])[1]
+        ego_states['bounding_box'][i] = get_ego_bounding_box(ego_states['translation'][i], ego_states['yaw'][i],
+                                                             ego_states['radar_offset'][i])
+
+    return ego_states
+
+
+def get_sample_trajectory(nusc, sample):
+    """
+    Finds the ego trajectory of the log a sample was recorded in
+
+    Args:
+        nusc: NuScenes object
+        sample: sample dictionary
+
+    Returns: EgoTrajectory
+
+    """
+    return get_ego_trajectories(nusc)[nusc.get('scene', sample['scene_token'])['log_token']]
+
+
+def get_scene_sample_tokens(nusc, scene_token):
+    """
+    Finds the tokens of every sample in a scene, in order
+
+    Args:
+        nusc: NuScenes object
+        scene_token: token of scene
+
+    Returns: list of sample tokens
+
+    """
+    sample_tokens = []
+    sample_token = nusc.get('scene', scene_token)['first_sample_token']
+    while sample_token:
+        sample_tokens.append(sample_token)
+        sample_token = nusc.get('sample', sample_token)['next']
+    return sample_tokens
+
+
+@timed('build_instance_tracks')
+def build_instance_tracks(nusc, sample_tokens):
+    """
+    Groups the annotations in the given samples by instance
+
+    Args:
+        nusc: NuScenes object
+        sample_tokens: tokens of samples, in order, e.g. from get_scene_sample_tokens()
+
+    Returns: dict mapping instance token to the indexes of its annotations in nusc.sample_annotation,
+             in sample order. Instances are in order of their first appearance
+
+    """
+    tracks = {}
+    for sample_token in sample_tokens:
+        for ann in nusc.get('sample', sample_token)['anns']:
+            index = nusc.getind('sample_annotation', ann)
+            tracks.setdefault(nusc.sample_annotation[index]['instance_token'], []).append(index)
+    return tracks
+
+
+@timed('get_track_velocities')
+def get_track_velocities(nusc, track, max_time_diff=1.5):
+    """
+    Finds the velocity of every annotation of an instance at once, by finite differences over the whole
+    track, rather than walking to each annotation's neighbours as NuScenes.box_velocity() does.
+
+    Gives the same values as NuScenes.box_velocity(): a centred difference where an annotation has both
+    neighbours, a one-sided difference at either end, and NaN for an annotation on its own or where the
+    neighbours are more than max_time_diff apart (doubled for centred differences). Annotations whose
+    neighbours in the track are not their prev/next annotations fall back to NuScenes.box_velocity().
+
+    Args:
+        nusc: NuScenes object
+        track: indexes of the instance's annotations in nusc.sample_annotation, in order,
+               e.g. from build_instance_tracks()
+        max_time_diff: maximum time between the annotations used for the difference, in seconds
+
+    Returns: (N, 3) array of velocities, one row per annotation in track
+
+    """
+    annotations = [nusc.sample_annotation[index] for index in track]
+    n = len(annotations)
+    velocities = np.full((n, 3), np.nan)
+    if n == 0:
+        return velocities
+
+    translations = np.array([annotation['translation'] for annotation in annotations], dtype=np.float64)
+    times = 1e-6 * np.array([nusc.get('sample', annotation['sample_token'])['timestamp']
+                             for annotation in annotations], dtype=np.int64)
+
+    has_prev = np.array([annotation['prev'] != '' for annotation in annotations], dtype=bool)
+    has_next = np.array([annotation['next'] != '' for annotation in annotations], dtype=bool)
+
+    # neighbours within the track, an annotation is its own neighbour at either end
+    first = np.where(has_prev, np.arange(n) - 1, np.arange(n))
+    last = np.where(has_next, np.arange(n) + 1, np.arange(n))
+
+    # the track must follow the prev/next links, otherwise the neighbours are found by the devkit
+    linked = np.ones(n, dtype=bool)
+    for i, annotation in enumerate(annotations):
+        if has_prev[i] and (i == 0 or annotations[i - 1]['token'] != annotation['prev']):
+            linked[i] = False
+        if has_next[i] and (i == n - 1 or annotations[i + 1]['token'] != annotation['next']):
+            linked[i] = False
+    first[~linked] = 0
+    last[~linked] = 0
+
+    time_diff = times[last] - times[first]
+    limit = np.where(has_prev & has_next, 2 * max_time_diff, max_time_diff)
+    valid = linked & (has_prev | has_next) & ~(time_diff > limit)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocities[valid] = (translations[last] - translations[first])[valid] / time_diff[valid, None]
+
+    for i in np.flatnonzero(~linked):
+        velocities[i] = nusc.box_velocity(annotations[i]['token'], max_time_diff)
+
+    return velocities
+
+
+def get_annotation_masks(nusc):
+    """
+    Finds category and attribute membership for every annotation, aligned with nusc.sample_annotation.
+
+    The masks are computed on first use and stored on the NuScenes object, so they are found once per
+    loaded dataset rather than by string comparison for every annotation.
+
+    Args:
+        nusc: NuScenes object
+
+    Returns: dict of arrays with one entry per annotation
+        category: index of the annotation's category in nusc.category
+        is_vehicle: True if the annotation is of a vehicle
+        is_parked_or_riderless: True if the annotation has the vehicle.parked or cycle.without_rider attribute
+
+    """
+    if getattr(nusc, 'annotation_masks', None) is not None:
+        return nusc.annotation_masks
+
+    is_vehicle_category = np.array(['vehicle' in category['name'] for category in nusc.category], dtype=bool)
+    instance_category = np.array([nusc.getind('category', instance['category_token'])
+                                  for instance in nusc.instance], dtype=np.int64)
+    annotation_instance = np.array([nusc.getind('instance', annotation['instance_token'])
+                                    for annotation in nusc.sample_annotation], dtype=np.int64)
+    annotation_category = instance_category[annotation_instance]
+
+    excluded = {attribute['token'] for attribute in nusc.attribute
+                if attribute['name'] in ['vehicle.parked', 'cycle.without_rider']}
+    is_parked_or_riderless = np.array([not excluded.isdisjoint(annotation['attribute_tokens'])
+                                       for annotation in nusc.sample_annotation], dtype=bool)
+
+    nusc.annotation_masks = {
+        'category': annotation_category,
+        'is_vehicle': is_vehicle_category[annotation_category],
+        'is_parked_or_riderless': is_parked_or_riderless,
+    }
+    return nusc.annotation_masks
+
+
+def get_annotation_yaws(nusc):
+    """
+    Finds the yaw of every annotation, aligned with nusc.sample_annotation.
+
+    The yaws are found in one vectorised pass on first use and stored on the NuScenes object, in the same way
+    as get_annotation_masks()
+
+    Args:
+        nusc: NuScenes object
+
+    Returns: (N,) yaws in radians, anti-clockwise from the x-axis
+
+    """
+    if getattr(nusc, 'annotation_yaws', None) is None:
+        nusc.annotation_yaws = get_yaws([annotation['rotation'] for annotation in nusc.sample_annotation])
+    return nusc.annotation_yaws
+
+
+def get_annotation_footprints(nusc, indexes):
+    """
+    Finds the corners of annotations on the ground from their stored yaws, in the order of
+    Box.bottom_corners(), without building a Box for each. Annotation boxes are only rotated about the
+    z-axis, so this gives the same corners
+
+    Args:
+        nusc: NuScenes object
+        indexes: indexes of the annotations in nusc.sample_annotation, e.g. a track from build_instance_tracks()
+
+    Returns: (N, 4, 2) corners, front-right, front-left, back-left, back-right of each box
+
+    """
+    annotations = [nusc.sample_annotation[index] for index in indexes]
+    centres = np.array([annotation['translation'][0:2] for annotation in annotations], dtype=float).reshape(-1, 2)
+    sizes = np.array([annotation['size'] for annotation in annotations], dtype=float).reshape(-1, 3)
+    yaws = get_annotation_yaws(nusc)[np.asarray(indexes, dtype=np.int64)]
+
+    # nuScenes sizes are [width, length, height]
+    half_width = sizes[:, 0] / 2
+    half_length = sizes[:, 1] / 2
+    corners = np.stack([np.stack([half_length, -half_width], axis=-1),
+                        np.stack([half_length, half_width], axis=-1),
+                        np.stack([-half_length, half_width], axis=-1),
+                        np.stack([-half_length, -half_width], axis=-1)], axis=1)
+    return rotate_points(yaws[:, np.newaxis], corners) + centres[:, np.newaxis]
 
 
 def find_translation(ego_bb, ann_bb, heading_angle):
@@ -112,33 +354,56 @@ def find_translation(ego_bb, ann_bb, heading_angle):
 
     """
 
-    ego_bb = np.array(ego_bb)
-    ann_bb = np.array(ann_bb)
+    return find_translations(ego_bb, np.array(ann_bb)[np.newaxis], heading_angle)[0]
 
-    # rotate all points to be aligned with ego
-    for i in range(4):
-        ego_bb[i] = rotation(-heading_angle, ego_bb[i])
-        ann_bb[i] = rotation(-heading_angle, ann_bb[i])
 
-    # find the bounds of the ego
-    ego_left = min([point[0] for point in ego_bb])
-    ego_right = max([point[0] for point in ego_bb])
-    ego_front = max([point[1] for point in ego_bb])
-    ego_back = min([point[1] for point in ego_bb])
+def find_translations(ego_bb, ann_bbs, heading_angle):
+    """
+    Vectorised version of find_translation() which finds the translations for many annotations in one pass.
 
-    # find the bounds of the annotation
-    ann_left = min([point[0] for point in ann_bb])
-    ann_right = max([point[0] for point in ann_bb])
-    ann_front = max([point[1] for point in ann_bb])
-    ann_back = min([point[1] for point in ann_bb])
+    Args:
+        ego_bb: (4, 2) bounding box of ego, or (N, 4, 2) if each annotation has its own ego bounding box
+        ann_bbs: (N, 4, 2) bounding boxes of annotations
+        heading_angle: heading of the ego in radians, either a scalar or (N,) array
 
-    x = find_dist_between_ranges([ego_left, ego_right], [ann_left, ann_right])
-    y = find_dist_between_ranges([ego_back, ego_front], [ann_back, ann_front])
+    Returns: (N, 2) array of translations between the ego and each annotation
+
+    """
 
-    translation = [x, y]
-    translation = rotation(heading_angle, translation)
+    heading_angle = np.asarray(heading_angle, dtype=float)
+    translations = find_aligned_distances(ego_bb, ann_bbs, heading_angle)
 
-    return translation
+    # rotate back to the original frame
+    return rotate_points(heading_angle, translations)
+
+
+def find_aligned_distances(ego_bb, ann_bbs, heading_angle):
+    """
+    Finds the distances between the ego and many annotations in the ego's frame, as found by find_translations()
+    before they are rotated back. Boxes whose ranges overlap along an axis are exactly zero apart along it.
+
+    Args:
+        ego_bb: (4, 2) bounding box of ego, or (N, 4, 2) if each annotation has its own ego bounding box
+        ann_bbs: (N, 4, 2) bounding boxes of annotations
+        heading_angle: heading of the ego in radians, either a scalar or (N,) array
+
+    Returns: (N, 2) array of distances as [lateral, longitudinal]
+
+    """
+
+    ego_bb = np.asarray(ego_bb, dtype=float)
+    ann_bbs = np.asarray(ann_bbs, dtype=float)
+    heading_angle = np.asarray(heading_angle, dtype=float)
+
+    # rotate all points to be aligned with ego
+    ego_bb = rotate_points(-heading_angle[..., np.newaxis], ego_bb)
+    ann_bbs = rotate_points(-heading_angle[..., np.newaxis], ann_bbs)
+
+    # find the bounds of each box as [[left, right], [back, front]]
+    ego_ranges = np.stack([ego_bb.min(axis=-2), ego_bb.max(axis=-2)], axis=-1)
+    ann_ranges = np.stack([ann_bbs.min(axis=-2), ann_bbs.max(axis=-2)], axis=-1)
+
+    return find_dists_between_ranges(ego_ranges, ann_ranges)
 
 
 def find_dist_between_ranges(range_1, range_2):
@@ -156,17 +421,50 @@ def find_dist_between_ranges(range_1, range_2):
 
     """
 
+    return float(find_dists_between_ranges(range_1, range_2))
+
+
+def find_dists_between_ranges(range_1, range_2):
+    """
+    Vectorised version of find_dist_between_ranges(). The ranges are given along the last axis and
+    broadcast against each other.
+
+    Args:
+        range_1: array of first ranges with shape (..., 2)
+        range_2: array of second ranges with shape (..., 2)
+
+    Returns: array of distances between ranges
+
+    """
+
     # Sort the values in each range by size [small, big]
     # Then find the distance between the ranges
-    range_1.sort()
-    range_2.sort()
+    range_1 = np.sort(np.asarray(range_1, dtype=float), axis=-1)
+    range_2 = np.sort(np.asarray(range_2, dtype=float), axis=-1)
 
-    if range_1[1] < range_2[0]:
-        return range_2[0] - range_1[1]
-    elif range_1[0] > range_2[1]:
-        return range_2[1] - range_1[0]
-    else:
-        return 0
+    behind = range_1[..., 1] < range_2[..., 0]
+    ahead = range_1[..., 0] > range_2[..., 1]
+
+    return np.where(behind, range_2[..., 0] - range_1[..., 1],
+                    np.where(ahead, range_2[..., 1] - range_1[..., 0], 0.0))
+
+
+def rotate_points(a, p):
+    """
+    Vectorised version of rotation() which rotates an array of 2-dimensional points anti-clockwise
+    Args:
+        a: rotation angle, or array of angles which broadcasts against the points
+        p: array of points with shape (..., 2)
+
+    Returns: array of rotated points
+
+    """
+    a = np.asarray(a, dtype=float)
+    p = np.asarray(p, dtype=float)
+    cos = np.cos(a)
+    sin = np.sin(a)
+    return np.stack([cos * p[..., 0] + -sin * p[..., 1],
+                     sin * p[..., 0] + cos * p[..., 1]], axis=-1)
 
 
 def rotation(a, p):
@@ -184,24 +482,33 @@ def rotation(a, p):
     return matrix.dot(p)
 
 
+@timed('get_ego_heading')
 def get_ego_heading(nusc, sample_token):
     """
-    Finds the heading of the car at given sample
+    Finds the heading of the car at given sample, from the ego trajectory of its log at the sample's
+    timestamp
 
     Args:
         nusc: NuScenes object
         sample_token: token of sample
 
-    Returns: heading of car
+    Returns: heading of car anti-clockwise from the y-axis
 
     """
 
     sample = nusc.get('sample', sample_token)
-    sample_data = nusc.get('sample_data', sample['data']['RADAR_FRONT'])
-    ego_pose = nusc.get('ego_pose', sample_data['ego_pose_token'])
-    r = ego_pose['rotation']
-    r = [r[1], r[2], r[3], r[0]]  # convert to scalar last
-    r = Rotation.from_quat(r)
-    r = r.as_euler('xyz')[2] - (np.pi / 2)  # convert to from y-axis
-    r = r % (2 * np.pi)
-    return r
+    return float(get_sample_trajectory(nusc, sample).heading(sample['timestamp']))
+
+
+def get_yaw(quaternion):
+    """
+    Finds the rotation around the z-axis of a nuScenes rotation
+
+    Args:
+        quaternion: rotation quaternion in nuScenes order [w, x, y, z]
+
+    Returns: yaw in radians, anti-clockwise from the x-axis
+
+    """
+
+    return float(get_yaws([quaternion])[0])
@@ -0,0 +1,244 @@
+import numpy as np
+from numpy.linalg import norm
+
+from metrics import timed
+from my_nuscenes_functions import build_instance_tracks, find_aligned_distances, get_annotation_footprints, \
+    get_annotation_masks, get_annotation_yaws, get_scene_sample_tokens, get_track_velocities, rotate_points
+from score_cache import SCORE_KEYS, columns_to_scores
+from scoring import FEATURE_BOOL_KEYS, FEATURE_FLOAT_KEYS, find_certainly_safe, find_instance_minimums, \
+    get_params, get_track_starts, resolve_reason_codes, score_feature_columns
+
+# Order of keys in the score dictionaries produced by generate_pairwise_scores_for_scene(). The ego_ fields
+# are those of the first vehicle of the pair, which takes the place of the ego
+PAIR_SCORE_KEYS = SCORE_KEYS + ['other_annotation', 'other_instance']
+
+
+@timed('generate_pairwise_scores_for_scene')
+def generate_pairwise_scores_for_scene(nusc, scene_token, aggressive=True, params=None, prune=True):
+    """
+    Identifies dangerous interactions between any two vehicles in a scene, rather than between the ego and
+    each vehicle. Each vehicle is scored against every other vehicle in the same sample as if it were the ego,
+    using its own box, heading and velocity. Pairs are ordered, as the RSS rules give the vehicle behind the
+    responsibility for the longitudinal distance.
+
+    Every pair in a sample is evaluated at once with (N x N) arrays. Pairs too far apart to score below 1 are
+    found from the distances between the box centres first, and their box distances are not found.
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene to analyse
+        aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+        params: RSS parameter dictionary to use instead of the aggressive or conservative set
+        prune: If false, then the box distances of every pair are found. The scores are the same either way
+
+    Returns:
+        scores: list of score dictionaries with the keys of PAIR_SCORE_KEYS, one for each ordered pair of
+                instances whose minimum score is below 1, at the first minimum as in generate_scores_for_scene().
+                annotation and instance are of the vehicle in the place of the ego, other_annotation and
+                other_instance of the vehicle it is scored against
+
+    """
+
+    if params is None:
+        params = get_params(aggressive)
+
+    vehicles = find_scene_vehicles(nusc, scene_token)
+    pairs = generate_pair_columns(vehicles, params if prune else None)
+    if len(pairs['first']) == 0:
+        return []
+
+    # score the pairs whose distances were found, the others are certain to score 1 and have no reason
+    computed = np.flatnonzero(pairs['computed'])
+    columns = {
+        'annotation': vehicles['annotation'][pairs['first'][computed]],
+        'instance': vehicles['instance'][pairs['first'][computed]],
+    }
+    for key in FEATURE_FLOAT_KEYS + FEATURE_BOOL_KEYS:
+        columns[key] = pairs[key][computed]
+    # 'Too close' reasons are carried along each pair's track below, once the pruned pairs are filled in
+    scores = score_feature_columns(columns, params, carry_reasons=False)
+
+    n = len(pairs['first'])
+    score = np.ones(n)
+    score[computed] = scores['score']
+    reason = np.zeros(n, dtype=np.int8)
+    reason[computed] = scores['reason']
+
+    track_starts = get_track_starts(pairs['pair'])
+    reason = resolve_reason_codes(reason, track_starts)
+    minimums = find_instance_minimums(score, track_starts)
+    minimums = minimums[score[minimums] < 1]
+
+    # the minimums are all below 1, so they were all computed
+    positions = np.searchsorted(computed, minimums)
+    first = pairs['first'][minimums]
+    other = pairs['other'][minimums]
+    result = {field: scores[field][positions] for field in SCORE_KEYS}
+    result['reason'] = reason[minimums]
+
+    results = columns_to_scores(result)
+    for s, annotation, instance in zip(results, vehicles['annotation'][other], vehicles['instance'][other]):
+        s['other_annotation'] = str(annotation)
+        s['other_instance'] = str(instance)
+    return [{key: s[key] for key in PAIR_SCORE_KEYS} for s in results]
+
+
+@timed('find_scene_vehicles')
+def find_scene_vehicles(nusc, scene_token):
+    """
+    Finds the vehicle annotations of a scene which can be scored, with the values pairwise scoring needs
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene
+
+    Returns:
+        vehicles: dictionary of arrays with one entry per annotation, grouped by instance
+            annotation, instance: tokens
+            instance_id: index of the instance in the scene
+            sample: index of the annotation's sample in the scene
+            centre: (N, 2) centre of the box
+            size: (N, 3) size of the box as [width, length, height]
+            heading: (N,) heading anti-clockwise from the y-axis, as for the ego (see get_ego_heading())
+            velocity: (N, 2) velocity, NaN where it cannot be found
+            footprint: (N, 4, 2) corners of the box on the ground
+
+    """
+
+    sample_tokens = get_scene_sample_tokens(nusc, scene_token)
+    sample_rows = {token: i for i, token in enumerate(sample_tokens)}
+    tracks = build_instance_tracks(nusc, sample_tokens)
+    masks = get_annotation_masks(nusc)
+
+    indexes = []
+    velocities = []
+    instances = []
+    instance_ids = []
+    for instance_token, track in tracks.items():
+        if not masks['is_vehicle'][track[0]]:
+            continue
+        # velocities are found before filtering, as they depend on the neighbours
+        track = np.asarray(track)
+        track_velocities = get_track_velocities(nusc, track)
+        scored = ~masks['is_parked_or_riderless'][track]
+        indexes.append(track[scored])
+        velocities.append(track_velocities[scored, 0:2])
+        instances += [instance_token] * int(scored.sum())
+        instance_ids += [len(indexes) - 1] * int(scored.sum())
+
+    indexes = np.concatenate(indexes) if indexes else np.zeros(0, dtype=np.int64)
+    annotations = [nusc.sample_annotation[index] for index in indexes]
+    instances = np.array(instances, dtype=str)
+
+    return {
+        'annotation': np.array([annotation['token'] for annotation in annotations], dtype=str),
+        'instance': instances,
+        'instance_id': np.array(instance_ids, dtype=np.int64),
+        'sample': np.array([sample_rows[annotation['sample_token']] for annotation in annotations], dtype=np.int64),
+        'centre': np.array([annotation['translation'][0:2] for annotation in annotations],
+                           dtype=float).reshape(-1, 2),
+        'size': np.array([annotation['size'] for annotation in annotations], dtype=float).reshape(-1, 3),
+        'heading': (get_annotation_yaws(nusc)[indexes] - (np.pi / 2)) % (2 * np.pi),
+        'velocity': np.concatenate(velocities) if velocities else np.zeros((0, 2)),
+        'footprint': get_annotation_footprints(nusc, indexes),
+    }
+
+
+@timed('generate_pair_columns')
+def generate_pair_columns(vehicles, params=None):
+    """
+    Finds the parameter-independent features (see generate_features_for_annotation()) of every ordered pair
+    of vehicles in the same sample, the first of which is moving forwards
+
+    Args:
+        vehicles: dictionary of arrays, see find_scene_vehicles()
+        params: RSS parameter dictionary used to find pairs which are certain to score 1, whose box distances
+                are then not found. Every pair's distances are found if None
+
+    Returns:
+        pairs: dictionary of arrays with one entry per pair, in order of the first vehicle's instance, the
+               other vehicle's instance and then sample
+            first, other: indexes of the two vehicles in the vehicle arrays
+            pair: index identifying the pair of instances
+            computed: True where the features were found, the features of other pairs are zero
+            FEATURE_FLOAT_KEYS and FEATURE_BOOL_KEYS
+
+    """
+
+    heading = vehicles['heading']
+    velocity = vehicles['velocity']
+    has_velocity = ~np.isnan(velocity).any(axis=1)
+    velocity = np.where(has_velocity[:, None], velocity, 0)
+
+    # velocities of each vehicle aligned with its own heading, as [lateral, longitudinal]. As for the ego,
+    # vehicles without a velocity or reversing are not scored against others
+    own_velocity = rotate_points(-heading, velocity)
+    moving_forwards = has_velocity & (own_velocity[:, 1] >= 0)
+
+    rows = np.arange(len(heading))
+    columns = {key: [] for key in ['first', 'other', 'computed', 'ego_long_velocity', 'ego_lat_velocity',
+                                   'ann_long_velocity', 'ann_lat_velocity', 'long_distance', 'lat_distance',
+                                   'ego_is_behind', 'ego_is_right']}
+    for sample in np.unique(vehicles['sample']):
+        in_sample = rows[vehicles['sample'] == sample]
+        a = in_sample[:, None]  # first vehicle, in the place of the ego
+        b = in_sample[None, :]  # other vehicle
+        valid = moving_forwards[a] & has_velocity[b] & (a != b)
+
+        # velocity of the other vehicle aligned with the first vehicle's heading
+        other_velocity = rotate_points(-heading[a], velocity[b])
+
+        if params is None:
+            computed = valid
+        else:
+            # lower bounds on the box distances from the centres, the first box's extents and the other's half
+            # diagonal, see find_prunable_annotations()
+            offsets = np.abs(rotate_points(-heading[a], vehicles['centre'][b] - vehicles['centre'][a]))
+            radii = 0.5 * norm(vehicles['size'][b], axis=-1)
+            lat_gaps = offsets[..., 0] - vehicles['size'][a, 0] / 2 - radii
+            long_gaps = offsets[..., 1] - vehicles['size'][a, 1] / 2 - radii
+            safe = find_certainly_safe(lat_gaps, long_gaps, np.broadcast_to(own_velocity[a], other_velocity.shape),
+                                       other_velocity, params)
+            computed = valid & ~safe
+
+        first, other = np.nonzero(valid)
+        is_computed = computed[first, other]
+        first_rows = in_sample[first]
+        other_rows = in_sample[other]
+
+        distances = np.zeros((len(first), 2))
+        if is_computed.any():
+            f = first_rows[is_computed]
+            o = other_rows[is_computed]
+            distances[is_computed] = find_aligned_distances(vehicles['footprint'][f], vehicles['footprint'][o],
+                                                            heading[f])
+
+        columns['first'].append(first_rows)
+        columns['other'].append(other_rows)
+        columns['computed'].append(is_computed)
+        columns['ego_long_velocity'].append(own_velocity[first_rows, 1])
+        columns['ego_lat_velocity'].append(own_velocity[first_rows, 0])
+        columns['ann_long_velocity'].append(other_velocity[first, other, 1])
+        columns['ann_lat_velocity'].append(other_velocity[first, other, 0])
+        columns['long_distance'].append(distances[:, 1])
+        columns['lat_distance'].append(distances[:, 0])
+        # see is_right_of() in generate_features_for_annotation(). The distances are exactly zero where the boxes
+        # overlap along an axis, so vehicles alongside each other are both taken to be behind, and their score
+        # depends on the lateral distance alone
+        columns['ego_is_behind'].append(is_computed & (distances[:, 1] >= 0))
+        columns['ego_is_right'].append(is_computed & (distances[:, 0] < 0))
+
+    pairs = {key: np.concatenate(values) if values else np.zeros(0) for key, values in columns.items()}
+    for key in ['first', 'other']:
+        pairs[key] = pairs[key].astype(np.int64)
+    for key in ['computed'] + FEATURE_BOOL_KEYS:
+        pairs[key] = pairs[key].astype(bool)
+
+    # group each pair of instances' annotations together, in sample order
+    instance_id = vehicles['instance_id']
+    num_instances = int(instance_id.max()) + 1 if len(instance_id) else 0
+    pair = instance_id[pairs['first']] * num_instances + instance_id[pairs['other']]
+    order = np.lexsort((vehicles['sample'][pairs['other']], pair))
+    pairs = {key: values[order] for key, values in pairs.items()}
+    pairs['pair'] = pair[order]
+    return pairs
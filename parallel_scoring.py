@@ -0,0 +1,290 @@
+import functools
+import gc
+import multiprocessing
+import os
+import threading
+
+from tqdm import tqdm
+
+from ego_trajectory import get_ego_trajectories
+from metrics import enable_metrics, instrument_dataset, merge_metrics_state, metrics_enabled, reset_metrics, \
+    take_metrics_state
+from my_nuscenes_functions import get_annotation_masks, get_annotation_yaws
+from scoring import generate_scores_for_scene, get_params
+from score_cache import cached_generate_score_columns_for_scene
+from score_table import ScoreTable
+
+# Dataset of a worker process, set by _init_worker(). Only ever set in the workers
+_nusc = None
+
+# Held while a pool is forked, as freezing the garbage collector affects the whole process and pools can be
+# started from several threads at once, e.g. by background jobs in the UI
+_pool_lock = threading.Lock()
+
+
+def _init_worker(dataset, record_metrics=False):
+    """
+    Makes the dataset available to a worker process
+
+    Args:
+        dataset: the parent's dataset when the worker is forked, so that its tables are shared copy-on-write,
+                 otherwise (dataset class, version, dataroot) to load it, the class being NuScenes or
+                 MetadataStore
+        record_metrics: whether the worker records stage timings, see metrics.py
+
+    """
+
+    global _nusc
+    if isinstance(dataset, tuple):
+        dataset_class, version, dataroot = dataset
+        dataset = dataset_class(version=version, dataroot=dataroot, verbose=False)
+    _nusc = dataset
+
+    # forked workers start with a copy of the parent's records, which the parent already has
+    enable_metrics(record_metrics)
+    reset_metrics()
+    instrument_dataset(_nusc)
+
+
+def _run_scenes(task):
+    """
+    Runs a function on a group of scenes in a worker process
+
+    Args:
+        task: tuple of (scene function, scene tokens), see iter_scene_results()
+
+    Returns: list of (scene token, result) tuples, and the worker's metrics records for the group
+
+    """
+
+    scene_function, scene_tokens = task
+    results = [(scene_token, scene_function(_nusc, scene_token)) for scene_token in scene_tokens]
+    return results, take_metrics_state()
+
+
+def score_scene(nusc, scene_token, params, use_cache=True, cache_root=None):
+    """
+    Scores a single scene, optionally through the on-disk score cache
+
+    Args:
+        nusc: NuScenes object
+        scene_token: token of scene
+        params: RSS parameter dictionary
+        use_cache: if true then results are read from and written to the score cache
+        cache_root: directory of the score cache, see cached_generate_scores_for_scene()
+
+    Returns: ScoreTable of the scene's scores
+
+    """
+
+    if use_cache:
+        return ScoreTable.from_columns(cached_generate_score_columns_for_scene(nusc, scene_token, params=params,
+                                                                               cache_root=cache_root))
+    return ScoreTable.from_scores(generate_scores_for_scene(nusc, scene_token, params=params))
+
+
+def group_scenes_by_log(nusc, scene_tokens, max_group_size=4):
+    """
+    Splits scenes into groups which are scored together. Scenes from the same log are kept together
+    so that a worker reuses the same ego poses and annotations, and groups are limited in size so that
+    work is spread evenly over the workers.
+
+    Args:
+        nusc: NuScenes object
+        scene_tokens: tokens of scenes to group
+        max_group_size: maximum number of scenes in a group
+
+    Returns: list of lists of scene tokens
+
+    """
+
+    logs = {}
+    for scene_token in scene_tokens:
+        log_token = nusc.get('scene', scene_token)['log_token']
+        logs.setdefault(log_token, []).append(scene_token)
+
+    groups = []
+    for log_scene_tokens in logs.values():
+        for i in range(0, len(log_scene_tokens), max_group_size):
+            groups.append(log_scene_tokens[i:i + max_group_size])
+
+    # largest groups first, so that the slowest tasks are not left until the end
+    groups.sort(key=len, reverse=True)
+    return groups
+
+
+def generate_scores_for_scenes(nusc, scene_tokens=None, aggressive=True, params=None, workers=None,
+                               use_cache=True, cache_root=None, progress=True, progress_callback=None):
+    """
+    Identifies dangerous scenarios in many scenes, spreading the scenes over a pool of worker processes
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_tokens: tokens of scenes to analyse. Defaults to every scene in the dataset
+        aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+        params: RSS parameter dictionary to use instead of the aggressive or conservative set
+        workers: number of worker processes. Defaults to the number of CPUs, 1 scores in this process
+        use_cache: if true then results are read from and written to the score cache
+        cache_root: directory of the score cache, see cached_generate_scores_for_scene()
+        progress: if true then a progress bar is shown
+        progress_callback: function called with (scenes done, total scenes) as scenes finish
+
+    Returns:
+        scores: list with the list of score dictionaries for each scene, in the order of scene_tokens
+
+    """
+
+    return [scores for _, scores in iter_scores_for_scenes(nusc, scene_tokens, aggressive, params, workers,
+                                                           use_cache, cache_root, progress, progress_callback)]
+
+
+def iter_scores_for_scenes(nusc, scene_tokens=None, aggressive=True, params=None, workers=None,
+                           use_cache=True, cache_root=None, progress=True, progress_callback=None, ordered=True):
+    """
+    Identifies dangerous scenarios in many scenes, yielding each scene's scores as soon as it and all
+    scenes before it have finished. Arguments are as for generate_scores_for_scenes(), plus
+
+    Args:
+        ordered: if false then scenes are yielded as soon as they finish, so that no finished scenes are
+                 held back waiting for earlier ones
+
+    Yields: (scene token, list of score dictionaries) tuples, in the order of scene_tokens if ordered
+
+    """
+
+    for scene_token, table in iter_score_tables_for_scenes(nusc, scene_tokens, aggressive, params, workers,
+                                                           use_cache, cache_root, progress, progress_callback,
+                                                           ordered):
+        yield scene_token, table.to_scores()
+
+
+def iter_score_tables_for_scenes(nusc, scene_tokens=None, aggressive=True, params=None, workers=None,
+                                 use_cache=True, cache_root=None, progress=True, progress_callback=None,
+                                 ordered=True):
+    """
+    Identifies dangerous scenarios in many scenes as iter_scores_for_scenes() does, but yields each scene's
+    scores as a ScoreTable. Workers also send their results back in this form, which is much smaller to
+    pickle than the score dictionaries
+
+    Yields: (scene token, ScoreTable) tuples
+
+    """
+
+    if params is None:
+        params = get_params(aggressive)
+
+    scene_function = functools.partial(score_scene, params=params, use_cache=use_cache, cache_root=cache_root)
+    return iter_scene_results(nusc, scene_function, scene_tokens, workers, progress, progress_callback, ordered)
+
+
+def iter_scene_results(nusc, scene_function, scene_tokens=None, workers=None, progress=True,
+                       progress_callback=None, ordered=True):
+    """
+    Runs a function on many scenes, spreading the scenes over a pool of worker processes which share the
+    dataset, and yields each scene's result. See iter_scores_for_scenes() for how results are ordered
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_function: function called as scene_function(nusc, scene_token) in the workers. It must be
+                        picklable, e.g. a module level function or a functools.partial of one
+        scene_tokens: tokens of scenes to run on. Defaults to every scene in the dataset
+        workers: number of worker processes. Defaults to the number of CPUs, 1 runs in this process
+        progress: if true then a progress bar is shown
+        progress_callback: function called with (scenes done, total scenes) as scenes finish
+        ordered: if false then scenes are yielded as soon as they finish
+
+    Yields: (scene token, result) tuples
+
+    """
+
+    if scene_tokens is None:
+        scene_tokens = [scene['token'] for scene in nusc.scene]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # results which finished before an earlier scene, waiting to be yielded in order
+    pending = {}
+    next_index = 0
+    done = 0
+    progress_bar = tqdm(total=len(scene_tokens), disable=not progress)
+
+    groups = group_scenes_by_log(nusc, scene_tokens)
+    workers = min(workers, len(groups))
+
+    if workers <= 1:
+        finished = (([(scene_token, scene_function(nusc, scene_token))], None)
+                    for group in groups for scene_token in group)
+        pool = None
+    else:
+        # find the masks, yaws and ego trajectories before forking so that the workers share them too
+        get_annotation_masks(nusc)
+        get_annotation_yaws(nusc)
+        get_ego_trajectories(nusc)
+
+        with _pool_lock:
+            freeze = False
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+                # forked workers inherit the dataset rather than having it pickled
+                dataset = nusc
+                # move the dataset out of the garbage collector's view so that collections in the workers
+                # do not touch (and so copy) the shared pages. It is left alone if the caller has frozen it
+                # already, e.g. in a server process forked by serve.py, as unfreezing would undo that too
+                freeze = gc.get_freeze_count() == 0
+                if freeze:
+                    gc.freeze()
+            else:
+                context = multiprocessing.get_context()
+                dataset = (type(nusc), nusc.version, nusc.dataroot)
+
+            try:
+                pool = context.Pool(workers, initializer=_init_worker, initargs=(dataset, metrics_enabled()))
+            finally:
+                if freeze:
+                    gc.unfreeze()
+        finished = pool.imap_unordered(_run_scenes, [(scene_function, group) for group in groups])
+
+    completed = False
+    try:
+        for group_results, metrics_state in finished:
+            if metrics_state is not None:
+                merge_metrics_state(metrics_state)
+            for scene_token, result in group_results:
+                done += 1
+                progress_bar.update(1)
+                if progress_callback is not None:
+                    progress_callback(done, len(scene_tokens))
+                if ordered:
+                    pending[scene_token] = result
+                else:
+                    yield scene_token, result
+
+            while next_index < len(scene_tokens) and scene_tokens[next_index] in pending:
+                scene_token = scene_tokens[next_index]
+                next_index += 1
+                yield scene_token, pending.pop(scene_token)
+        completed = True
+    finally:
+        if pool is not None and completed:
+            pool.close()
+            pool.join()
+        elif pool is not None:
+            # a scene failed or the caller stopped early
+            pool.terminate()
+        progress_bar.close()
+
+
+def iter_dataset_scores(nusc, scene_tokens=None, aggressive=True, params=None, workers=None, use_cache=True,
+                        cache_root=None, progress=True, progress_callback=None):
+    """
+    Yields the scores of many scenes one at a time, in the order scenes finish, so that a consumer can
+    aggregate results over the whole dataset without holding them all. Arguments are as for
+    generate_scores_for_scenes().
+
+    Yields: score dictionaries
+
+    """
+
+    for _, scores in iter_scores_for_scenes(nusc, scene_tokens, aggressive, params, workers, use_cache, cache_root,
+                                            progress, progress_callback, ordered=False):
+        yield from scores
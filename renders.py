@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+from metrics import metrics_enabled, record
+
+RENDER_DIR = 'static/temp_renders'
+
+# Dataset used by the render processes. It is set before the pool is forked so that the processes
+# share the parent's tables rather than each loading their own copy
+_nusc = None
+_executor = None
+_workers = None
+_pending = {}
+_lock = threading.Lock()
+
+
+def init_renderer(nusc, workers=None):
+    """
+    Sets the dataset annotations are rendered from. The worker processes are started on the first render
+
+    Args:
+        nusc: NuScenes object
+        workers: number of render processes, defaults to the number of CPUs
+
+    """
+
+    global _nusc, _workers
+    _nusc = nusc
+    _workers = workers or os.cpu_count() or 1
+
+
+def _init_worker(version, dataroot):
+    """
+    Makes the dataset available to a render process. Only loads the dataset if it was not inherited
+    from the parent, i.e. when processes are spawned rather than forked.
+
+    Args:
+        version: dataset version
+        dataroot: dataset root directory
+
+    """
+
+    global _nusc
+    if _nusc is None:
+        from nuscenes.nuscenes import NuScenes
+        _nusc = NuScenes(version=version, dataroot=dataroot, verbose=False)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        _executor = ProcessPoolExecutor(_workers, mp_context=context, initializer=_init_worker,
+                                        initargs=(_nusc.version, _nusc.dataroot))
+    return _executor
+
+
+def get_render_path(annotation_token):
+    """
+    Finds where the render of an annotation is saved
+
+    Args:
+        annotation_token: token of annotation
+
+    Returns: path of the image file
+
+    """
+
+    return os.path.join(RENDER_DIR, annotation_token + '.jpg')
+
+
+def is_rendered(annotation_token):
+    """
+    Checks whether the render of an annotation has been saved
+
+    Args:
+        annotation_token: token of annotation
+
+    Returns: True if the image file exists
+
+    """
+
+    return os.path.exists(get_render_path(annotation_token))
+
+
+def request_render(annotation_token):
+    """
+    Starts rendering an annotation in the render processes, unless it has already been rendered or
+    is being rendered
+
+    Args:
+        annotation_token: token of annotation
+
+    Returns: True if the render is ready
+
+    """
+
+    if is_rendered(annotation_token):
+        return True
+
+    with _lock:
+        if annotation_token not in _pending:
+            _pending[annotation_token] = _get_executor().submit(render_annotation, annotation_token,
+                                                                get_render_path(annotation_token))
+            _pending[annotation_token].add_done_callback(lambda future: _render_done(annotation_token, future))
+    return False
+
+
+def _render_done(annotation_token, future):
+    _pending.pop(annotation_token, None)
+    # renders are timed in the render process, which cannot record metrics for this one
+    if metrics_enabled() and future.exception() is None:
+        record('render_annotation', future.result())
+
+
+def render_annotation(annotation_token, out_path):
+    """
+    Renders an annotation to an image file. If the NuScenes API cannot render the annotation then an
+    image saying so is saved instead. The image is written to a temporary file first, so that it is
+    never seen partially written.
+
+    Args:
+        annotation_token: token of annotation
+        out_path: path of the image file
+
+    Returns: time taken in seconds
+
+    """
+
+    start_time = time.perf_counter()
+    temp_path = out_path + '.%d.jpg' % os.getpid()
+    try:
+        _nusc.render_annotation(annotation_token, out_path=temp_path)
+    except:
+        fig = Figure(figsize=(18, 9))
+        ax = fig.add_subplot()
+        ax.text(0.1, 0.1, 'NuScenes API was unable to render annotation', fontsize=25, color='red')
+        fig.savefig(temp_path)
+    finally:
+        # the NuScenes API leaves its figures open
+        plt.close('all')
+    os.replace(temp_path, out_path)
+    return time.perf_counter() - start_time
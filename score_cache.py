@@ -0,0 +1,409 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import constants
+import ego_trajectory
+from metrics import timed
+import my_nuscenes_functions
+import scoring
+from scoring import FEATURE_BOOL_KEYS, FEATURE_FLOAT_KEYS, find_instance_minimums, \
+    generate_feature_columns_for_scene, get_params, get_track_starts, score_feature_columns
+
+
+def get_code_version():
+    """
+    Finds a hash of the source code which produces scores, so that cached results are invalidated
+    whenever the scoring code or parameters change. This module and score_table.py, which decide how
+    scores are stored and read back from the cache, are included
+
+    Returns: hex digest of the scoring source files
+
+    """
+
+    # score_table imports this module, so its file is found by path rather than imported
+    paths = [module.__file__ for module in [constants, ego_trajectory, my_nuscenes_functions, scoring]]
+    paths += [__file__, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'score_table.py')]
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+CODE_VERSION = get_code_version()
+
+# Columns stored for each score dictionary. None values are stored as NaN (floats) or -1 (integers)
+FLOAT_FIELDS = ['score', 'ego_long_velocity', 'ego_lat_velocity', 'ann_long_velocity', 'ann_lat_velocity',
+                'long_distance', 'lat_distance', 'min_long_distance', 'min_lat_distance']
+TOKEN_FIELDS = ['annotation', 'instance']
+
+# Order of keys in the score dictionaries produced by generate_scores_for_scene()
+SCORE_KEYS = ['annotation', 'reason', 'score', 'ego_long_velocity', 'ego_lat_velocity', 'ann_long_velocity',
+              'ann_lat_velocity', 'long_distance', 'lat_distance', 'min_long_distance', 'min_lat_distance',
+              'same_direction', 'instance']
+
+# Columns stored for the parameter-independent features of a scene, see generate_feature_columns_for_scene()
+FEATURE_KEYS = TOKEN_FIELDS + FEATURE_FLOAT_KEYS + FEATURE_BOOL_KEYS
+
+# Features of recently scored scenes are also kept in memory, so that scoring a scene again with another
+# parameter set only reruns the RSS formulas
+MAX_MEMORY_SCENES = 256
+_feature_memory = OrderedDict()
+_feature_lock = threading.Lock()
+
+
+def get_params_hash(params):
+    """
+    Finds a hash of the values in a parameter set
+
+    Args:
+        params: RSS parameter dictionary
+
+    Returns: hex digest of the parameter values
+
+    """
+
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def get_cache_key(version, scene_token, params):
+    """
+    Finds the key which identifies cached scores
+
+    Args:
+        version: dataset version, e.g. v1.0-mini
+        scene_token: token of scene
+        params: RSS parameter dictionary
+
+    Returns: key string
+
+    """
+
+    return '/'.join([version, scene_token, get_params_hash(params), CODE_VERSION])
+
+
+def get_cache_path(cache_root, version, scene_token, params):
+    """
+    Finds the file cached scores are stored in. Files are grouped by code version and parameter set so
+    that a change to either starts a new directory.
+
+    Args:
+        cache_root: root directory of the cache
+        version: dataset version, e.g. v1.0-mini
+        scene_token: token of scene
+        params: RSS parameter dictionary
+
+    Returns: path of the cache file
+
+    """
+
+    directory = CODE_VERSION[:16] + '-' + get_params_hash(params)[:16]
+    return os.path.join(cache_root, version, directory, scene_token + '.npz')
+
+
+def get_feature_cache_path(cache_root, version, scene_token):
+    """
+    Finds the file the cached features of a scene are stored in. Features do not depend on the parameter
+    set, so there is one directory for each code version.
+
+    Args:
+        cache_root: root directory of the cache
+        version: dataset version, e.g. v1.0-mini
+        scene_token: token of scene
+
+    Returns: path of the cache file
+
+    """
+
+    return os.path.join(cache_root, version, CODE_VERSION[:16] + '-features', scene_token + '.npz')
+
+
+def scores_to_columns(scores):
+    """
+    Converts a list of score dictionaries into a dictionary of column arrays
+
+    Args:
+        scores: list of score dictionaries as produced by generate_scores_for_scene()
+
+    Returns: dictionary of numpy arrays
+
+    """
+
+    columns = {}
+    for field in TOKEN_FIELDS:
+        columns[field] = np.array([s[field] for s in scores], dtype=str)
+    for field in FLOAT_FIELDS:
+        columns[field] = np.array([np.nan if s[field] is None else s[field] for s in scores], dtype=float)
+    columns['reason'] = np.array([constants.score_reasons.index(s['reason']) for s in scores], dtype=np.int8)
+    columns['same_direction'] = np.array([-1 if s['same_direction'] is None else int(s['same_direction'])
+                                          for s in scores], dtype=np.int8)
+    return columns
+
+
+def columns_to_scores(columns):
+    """
+    Converts a dictionary of column arrays back into a list of score dictionaries
+
+    Args:
+        columns: dictionary of numpy arrays as produced by scores_to_columns()
+
+    Returns: list of score dictionaries
+
+    """
+
+    values = {}
+    for field in TOKEN_FIELDS:
+        values[field] = [str(v) for v in columns[field]]
+    for field in FLOAT_FIELDS:
+        values[field] = [None if np.isnan(v) else float(v) for v in columns[field]]
+    values['reason'] = [constants.score_reasons[code] for code in columns['reason']]
+    values['same_direction'] = [None if v < 0 else bool(v) for v in columns['same_direction']]
+
+    return [{key: values[key][i] for key in SCORE_KEYS} for i in range(len(columns['score']))]
+
+
+@timed('save_cached_scores')
+def save_cached_scores(path, key, scores):
+    """
+    Writes scores to a cache file. The file is written to a temporary path first, so that readers
+    never see a partial file.
+
+    Args:
+        path: path of the cache file
+        key: cache key, see get_cache_key()
+        scores: list of score dictionaries
+
+    """
+
+    save_cached_columns(path, key, scores_to_columns(scores))
+
+
+@timed('load_cached_scores')
+def load_cached_scores(path, key):
+    """
+    Reads scores from a cache file
+
+    Args:
+        path: path of the cache file
+        key: cache key, see get_cache_key()
+
+    Returns: list of score dictionaries, or None if there is no valid cache entry
+
+    """
+
+    columns = load_cached_columns(path, key, SCORE_KEYS)
+    if columns is None:
+        return None
+    return columns_to_scores(columns)
+
+
+def save_cached_columns(path, key, columns):
+    """
+    Writes column arrays to a cache file, see save_cached_scores()
+
+    Args:
+        path: path of the cache file
+        key: cache key
+        columns: dictionary of numpy arrays
+
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'wb') as f:
+        np.savez_compressed(f, key=np.array(key), **columns)
+    os.replace(temp_path, path)
+
+
+def load_cached_columns(path, key, fields):
+    """
+    Reads column arrays from a cache file
+
+    Args:
+        path: path of the cache file
+        key: cache key
+        fields: names of the columns to read
+
+    Returns: dictionary of numpy arrays, or None if there is no valid cache entry
+
+    """
+
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['key']) != key:
+                return None
+            return {field: data[field] for field in fields}
+    except (OSError, ValueError, KeyError):
+        # unreadable or incomplete files are treated as missing
+        return None
+
+
+def remove_stale_entries(cache_root, version):
+    """
+    Deletes cached scores produced by other versions of the scoring code
+
+    Args:
+        cache_root: root directory of the cache
+        version: dataset version, e.g. v1.0-mini
+
+    """
+
+    version_root = os.path.join(cache_root, version)
+    if not os.path.isdir(version_root):
+        return
+    for directory in os.listdir(version_root):
+        if not directory.startswith(CODE_VERSION[:16]):
+            shutil.rmtree(os.path.join(version_root, directory), ignore_errors=True)
+
+
+def cached_generate_scores_for_scene(nusc, scene_token, aggressive=True, params=None, cache_root=None):
+    """
+    Identifies dangerous scenarios in a scene, reusing results stored on disk where possible. See
+    cached_generate_score_columns_for_scene()
+
+    Returns:
+        scores: list of score dictionaries, as from generate_scores_for_scene()
+
+    """
+
+    return columns_to_scores(cached_generate_score_columns_for_scene(nusc, scene_token, aggressive, params,
+                                                                     cache_root))
+
+
+def cached_generate_score_columns_for_scene(nusc, scene_token, aggressive=True, params=None, cache_root=None):
+    """
+    Identifies dangerous scenarios in a scene, reusing results stored on disk where possible.
+
+    Results are keyed by dataset version, scene token, parameter values and a hash of the scoring code,
+    so a change to any of these gives a cache miss.
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene to analyse
+        aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+        params: RSS parameter dictionary to use instead of the aggressive or conservative set
+        cache_root: directory to store results in. Defaults to score_cache in the dataset root
+
+    Returns:
+        columns: dictionary of numpy arrays in the form of scores_to_columns()
+
+    """
+
+    if params is None:
+        params = get_params(aggressive)
+    if cache_root is None:
+        cache_root = os.path.join(nusc.dataroot, 'score_cache')
+
+    key = get_cache_key(nusc.version, scene_token, params)
+    path = get_cache_path(cache_root, nusc.version, scene_token, params)
+
+    columns = load_cached_columns(path, key, SCORE_KEYS)
+    if columns is not None:
+        return columns
+
+    # the parameter-independent features are usually cached already if the scene has been scored before
+    features = cached_generate_feature_columns_for_scene(nusc, scene_token, cache_root)
+    columns = score_feature_columns_for_scene(features, params)
+    try:
+        save_cached_columns(path, key, columns)
+    except OSError:
+        # the cache is only an optimisation, e.g. the dataset may be on a read-only filesystem
+        pass
+
+    return columns
+
+
+def cached_generate_annotation_score_columns_for_scene(nusc, scene_token, aggressive=True, params=None,
+                                                       cache_root=None):
+    """
+    Scores every annotation of a scene which is scored, rather than only the first minimum of each instance,
+    from the scene's cached features. Only the features are cached, as scoring them is quick
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene to analyse
+        aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+        params: RSS parameter dictionary to use instead of the aggressive or conservative set
+        cache_root: directory to store results in. Defaults to score_cache in the dataset root
+
+    Returns:
+        columns: dictionary of numpy arrays in the form of scores_to_columns(), with one entry per annotation
+                 in the order of iter_scores_for_scene()
+
+    """
+
+    if params is None:
+        params = get_params(aggressive)
+
+    features = cached_generate_feature_columns_for_scene(nusc, scene_token, cache_root)
+    scores = score_feature_columns(features, params)
+    return {field: scores[field] for field in SCORE_KEYS}
+
+
+def cached_generate_feature_columns_for_scene(nusc, scene_token, cache_root=None):
+    """
+    Finds the parameter-independent features of a scene, reusing results kept in memory or stored on disk
+    where possible. Results are keyed by dataset version, scene token and a hash of the scoring code.
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene to analyse
+        cache_root: directory to store results in. Defaults to score_cache in the dataset root
+
+    Returns:
+        columns: feature column dictionary, see generate_feature_columns_for_scene()
+
+    """
+
+    if cache_root is None:
+        cache_root = os.path.join(nusc.dataroot, 'score_cache')
+
+    key = '/'.join([nusc.version, scene_token, 'features', CODE_VERSION])
+    with _feature_lock:
+        if key in _feature_memory:
+            _feature_memory.move_to_end(key)
+            return _feature_memory[key]
+
+    path = get_feature_cache_path(cache_root, nusc.version, scene_token)
+    columns = load_cached_columns(path, key, FEATURE_KEYS)
+    if columns is None:
+        columns = generate_feature_columns_for_scene(nusc, scene_token)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                remove_stale_entries(cache_root, nusc.version)
+            save_cached_columns(path, key, columns)
+        except OSError:
+            pass
+
+    with _feature_lock:
+        _feature_memory[key] = columns
+        while len(_feature_memory) > MAX_MEMORY_SCENES:
+            _feature_memory.popitem(last=False)
+    return columns
+
+
+def score_feature_columns_for_scene(features, params):
+    """
+    Scores the features of a scene, keeping the first minimum score of each instance as
+    generate_scores_for_scene() does
+
+    Args:
+        features: feature column dictionary, see generate_feature_columns_for_scene()
+        params: RSS parameter dictionary
+
+    Returns:
+        columns: dictionary of numpy arrays in the form of scores_to_columns()
+
+    """
+
+    scores = score_feature_columns(features, params)
+    indexes = find_instance_minimums(scores['score'], get_track_starts(features['instance']))
+    return {field: scores[field][indexes] for field in SCORE_KEYS}
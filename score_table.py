@@ -0,0 +1,318 @@
+from collections.abc import Mapping
+
+import numpy as np
+
+import constants
+from score_cache import FLOAT_FIELDS, SCORE_KEYS
+
+# Fields stored as small integer codes rather than tokens or floats
+CODE_FIELDS = ['reason', 'same_direction']
+
+
+class ScoreTable:
+    """
+    Scores of many annotations held as one array per field, rather than as one dictionary per score. Floats
+    are stored as float64 with NaN for None, reasons as indexes into constants.score_reasons, same_direction
+    as 1, 0 or -1 for None, and tokens as int32 indexes into a single array of token bytes shared by every
+    token field. This takes several times less memory than the dictionaries, and filters and aggregations
+    can be done on whole columns.
+
+    Indexing with a field name gives that field's column as stored, with an int gives a ScoreRow which reads
+    like a score dictionary, and with a slice, boolean mask or index array gives a new table.
+    """
+
+    def __init__(self, columns, tokens, keys=SCORE_KEYS):
+        """
+        Args:
+            columns: dictionary of arrays, one per key, in the stored form described above
+            tokens: (T,) array of token bytes which the token columns index
+            keys: fields of each score, in order. Fields which are neither floats nor codes are tokens
+        """
+        self.columns = columns
+        self.tokens = tokens
+        self.keys = list(keys)
+        self.token_fields = [key for key in self.keys if key not in FLOAT_FIELDS + CODE_FIELDS]
+
+    @classmethod
+    def from_columns(cls, columns, keys=SCORE_KEYS):
+        """
+        Creates a table from column arrays with tokens as strings, as produced by
+        score_cache.scores_to_columns()
+
+        Args:
+            columns: dictionary of numpy arrays
+            keys: fields of each score, in order
+
+        Returns: ScoreTable
+
+        """
+
+        table = cls({}, None, keys)
+        values = [np.asarray(columns[field], dtype=str) for field in table.token_fields]
+        tokens, inverse = np.unique(np.concatenate(values) if values else np.zeros(0, dtype=str),
+                                    return_inverse=True)
+        table.tokens = tokens.astype(bytes)
+
+        start = 0
+        for field, field_values in zip(table.token_fields, values):
+            table.columns[field] = inverse[start:start + len(field_values)].astype(np.int32)
+            start += len(field_values)
+        for field in table.keys:
+            if field in FLOAT_FIELDS:
+                table.columns[field] = np.asarray(columns[field], dtype=np.float64)
+            elif field in CODE_FIELDS:
+                table.columns[field] = np.asarray(columns[field], dtype=np.int8)
+        return table
+
+    @classmethod
+    def from_scores(cls, scores, keys=SCORE_KEYS):
+        """
+        Creates a table from a list of score dictionaries
+
+        Args:
+            scores: list of score dictionaries, as produced by generate_scores_for_scene()
+            keys: fields of each score, in order
+
+        Returns: ScoreTable
+
+        """
+
+        columns = {}
+        for field in keys:
+            if field in FLOAT_FIELDS:
+                columns[field] = np.array([np.nan if s[field] is None else s[field] for s in scores], dtype=float)
+            elif field == 'reason':
+                columns[field] = np.array([constants.score_reasons.index(s[field]) for s in scores], dtype=np.int8)
+            elif field == 'same_direction':
+                columns[field] = np.array([-1 if s[field] is None else int(s[field]) for s in scores],
+                                          dtype=np.int8)
+            else:
+                columns[field] = np.array([s[field] for s in scores], dtype=str)
+        return cls.from_columns(columns, keys)
+
+    @classmethod
+    def concatenate(cls, tables, keys=SCORE_KEYS):
+        """
+        Joins tables with the same keys into one. Their token arrays are joined, without removing tokens
+        which appear in more than one table
+
+        Args:
+            tables: list of ScoreTables
+            keys: fields of the tables, used when there are none
+
+        Returns: ScoreTable
+
+        """
+
+        tables = list(tables)
+        if not tables:
+            return cls.from_scores([], keys)
+
+        offsets = np.cumsum([0] + [len(table.tokens) for table in tables[:-1]])
+        columns = {}
+        for field in tables[0].keys:
+            if field in tables[0].token_fields:
+                columns[field] = np.concatenate([table.columns[field] + np.int32(offset)
+                                                 for table, offset in zip(tables, offsets)])
+            else:
+                columns[field] = np.concatenate([table.columns[field] for table in tables])
+        return cls(columns, np.concatenate([table.tokens for table in tables]), tables[0].keys)
+
+    @classmethod
+    def load_npz(cls, path):
+        """
+        Reads a table written by to_npz()
+
+        Args:
+            path: path of the NPZ file
+
+        Returns: ScoreTable
+
+        """
+
+        with np.load(path, allow_pickle=False) as data:
+            keys = [str(key) for key in data['keys']]
+            return cls({field: data[field] for field in keys}, data['tokens'], keys)
+
+    def __len__(self):
+        return len(self.columns[self.keys[0]]) if self.keys else 0
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ScoreRow(self, i)
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            return self.columns[item]
+        if isinstance(item, (int, np.integer)):
+            if not -len(self) <= item < len(self):
+                raise IndexError('Score index out of range')
+            return ScoreRow(self, int(item) % len(self))
+        return ScoreTable({field: values[item] for field, values in self.columns.items()}, self.tokens, self.keys)
+
+    def filter(self, score_below=None, reasons=None):
+        """
+        Finds the scores below a threshold and with any of the given reasons
+
+        Args:
+            score_below: only scores below this value are kept, all are kept if None
+            reasons: reasons of the scores kept, as in constants.score_reasons, all are kept if None
+
+        Returns: ScoreTable
+
+        """
+
+        keep = np.ones(len(self), dtype=bool)
+        if score_below is not None:
+            keep &= self.columns['score'] < score_below
+        if reasons is not None:
+            keep &= np.isin(self.columns['reason'], [constants.score_reasons.index(reason) for reason in reasons])
+        return self[keep]
+
+    def value(self, field, i):
+        """
+        Finds one field of one score, in the form of a score dictionary
+
+        Args:
+            field: name of the field
+            i: index of the score
+
+        Returns: str, float, bool or None
+
+        """
+
+        if field not in self.columns:
+            raise KeyError(field)
+        value = self.columns[field][i]
+        if field in FLOAT_FIELDS:
+            return None if np.isnan(value) else float(value)
+        if field == 'reason':
+            return constants.score_reasons[value]
+        if field == 'same_direction':
+            return None if value < 0 else bool(value)
+        return self.tokens[value].decode()
+
+    def get_tokens(self, field):
+        """
+        Finds the tokens of a token field
+
+        Args:
+            field: name of the token field, e.g. annotation
+
+        Returns: array of token strings
+
+        """
+
+        return self.tokens[self.columns[field]].astype(str)
+
+    def to_columns(self):
+        """
+        Converts the table into column arrays with tokens as strings, as produced by
+        score_cache.scores_to_columns()
+
+        Returns: dictionary of numpy arrays
+
+        """
+
+        return {field: self.get_tokens(field) if field in self.token_fields else values
+                for field, values in self.columns.items()}
+
+    def to_scores(self):
+        """
+        Converts the table into a list of score dictionaries
+
+        Returns: list of score dictionaries
+
+        """
+
+        values = {}
+        for field in self.keys:
+            if field in FLOAT_FIELDS:
+                values[field] = [None if np.isnan(v) else v for v in self.columns[field].tolist()]
+            elif field == 'reason':
+                values[field] = [constants.score_reasons[code] for code in self.columns[field].tolist()]
+            elif field == 'same_direction':
+                values[field] = [None if v < 0 else bool(v) for v in self.columns[field].tolist()]
+            else:
+                values[field] = self.get_tokens(field).tolist()
+
+        return [dict(zip(self.keys, row)) for row in zip(*(values[field] for field in self.keys))]
+
+    def to_npz(self, path, **extra):
+        """
+        Writes the table to a compressed NPZ file in its stored form, see load_npz()
+
+        Args:
+            path: path of the NPZ file
+            extra: further arrays to write to the file
+
+        """
+
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, keys=np.array(self.keys), tokens=self.tokens, **self.columns, **extra)
+
+    def to_arrow(self):
+        """
+        Converts the table into an Arrow table. Requires pyarrow. Floats and codes are passed to Arrow as
+        arrays rather than through Python objects, and tokens and reasons become dictionary arrays over the
+        stored indexes, so only the token strings themselves are converted
+
+        Returns: pyarrow.Table, with nulls in place of None
+
+        """
+
+        import pyarrow as pa
+
+        tokens = pa.array(self.tokens.astype(str), type=pa.string())
+        arrays = []
+        for field in self.keys:
+            values = self.columns[field]
+            if field in FLOAT_FIELDS:
+                arrays.append(pa.array(values, from_pandas=True))
+            elif field == 'reason':
+                # no reason (None, code 0) is masked, as Parquet cannot store nulls in dictionaries
+                reasons = pa.array([reason or '' for reason in constants.score_reasons], type=pa.string())
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, mask=values == 0), reasons))
+            elif field == 'same_direction':
+                arrays.append(pa.array(values == 1, mask=values < 0))
+            else:
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(values), tokens))
+        return pa.Table.from_arrays(arrays, names=self.keys)
+
+    def to_parquet(self, path):
+        """
+        Writes the table to a Parquet file. Requires pyarrow
+
+        Args:
+            path: path of the Parquet file
+
+        """
+
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(self.to_arrow(), path)
+
+
+class ScoreRow(Mapping):
+    """
+    Read-only view of one score of a ScoreTable, which behaves like the score's dictionary (e.g. in
+    templates) without creating it
+    """
+
+    __slots__ = ['table', 'index']
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        return self.table.value(field, self.index)
+
+    def __iter__(self):
+        return iter(self.table.keys)
+
+    def __len__(self):
+        return len(self.table.keys)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -1,62 +1,86 @@
 from numpy.linalg import norm
 from my_nuscenes_functions import *
 from constants import *
+from metrics import timed
 
 
-def generate_scores_for_scene(nusc, scene_token, aggressive=True):
+@timed('generate_scores_for_scene')
+def generate_scores_for_scene(nusc, scene_token, aggressive=True, params=None):
     """
     Identifies dangerous scenarios in a scene
     Args:
         nusc (NuScenes): a nuScenes object
         scene_token (str): the token of the scene to analyse
         aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+        params: RSS parameter dictionary to use instead of the aggressive or conservative set
 
     Returns:
         scores: list of score dictionaries
 
     """
 
-    scores = []
+    return list(iter_scores_for_scene(nusc, scene_token, aggressive=aggressive, params=params))
 
-    scene = nusc.get('scene', scene_token)
 
-    sample = nusc.get('sample', scene['first_sample_token'])
+def iter_scores_for_scene(nusc, scene_token, aggressive=True, params=None, per_annotation=False, prune=True):
+    """
+    Identifies dangerous scenarios in a scene, yielding scores as each instance is evaluated rather than
+    building a list, so that only one instance's scores are held at a time
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene to analyse
+        aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+        params: RSS parameter dictionary to use instead of the aggressive or conservative set
+        per_annotation: If true, then the score of every annotation is yielded, otherwise only the minimum
+                        score of each instance (as in generate_scores_for_scene())
+        prune: If true, then annotations too far from the ego to score below 1 are not scored unless needed,
+               see find_track_minimum_score(). The minimum scores are the same either way
+
+    Yields:
+        score: score dictionary, including the instance token
 
-    # set stores instances that have been processed
-    instances = set()
+    """
 
-    done = False
-    # loop through all samples in scenes
-    while not done:
-        # loop through all annotations in sample
-        for ann in sample['anns']:
-            instance_token = nusc.get('sample_annotation', ann)['instance_token']
-            instance = nusc.get('instance', instance_token)
-            category = nusc.get('category', instance['category_token'])['name']
-            if instance_token not in instances and 'vehicle' in category:
-                s = generate_scores_for_instance(nusc, instance_token, aggressive=aggressive)
-                if s:
-                    s = min(s, key=lambda score_dict: score_dict['score'])  # get minimum score
-                    s['instance'] = instance_token
-                    scores.append(s)
-                    instances.add(instance_token)
+    if params is None:
+        params = get_params(aggressive)
 
-        # check for next sample
-        if sample['next']:
-            sample = nusc.get('sample', sample['next'])
-        else:
-            done = True
+    sample_tokens = get_scene_sample_tokens(nusc, scene_token)
 
-    return scores
+    # the ego state is shared by every annotation in a sample, so find it once per sample
+    ego_states = build_ego_state_table(nusc, sample_tokens)
 
+    # each instance's track is found in one pass over the scene, so every track is evaluated once
+    tracks = build_instance_tracks(nusc, sample_tokens)
 
-def generate_scores_for_instance(nusc, instance_token, aggressive=True):
+    # only vehicles are scored. All annotations of an instance share a category, so check the first
+    is_vehicle = get_annotation_masks(nusc)['is_vehicle'][[track[0] for track in tracks.values()]]
+
+    for (instance_token, track), vehicle in zip(tracks.items(), is_vehicle):
+        if not vehicle:
+            continue
+
+        if per_annotation:
+            for s in iter_scores_for_track(nusc, track, params, ego_states):
+                s['instance'] = instance_token
+                yield s
+            continue
+
+        minimum = find_track_minimum_score(nusc, track, params, ego_states, prune=prune)
+        if minimum is not None:
+            minimum['instance'] = instance_token
+            yield minimum
+
+
+def generate_scores_for_instance(nusc, instance_token, aggressive=True, params=None, ego_states=None):
     """
     Returns a list of scores for an interaction with an instance
         Parameters:
             nusc (NuScenes): NuScenes object
             instance_token (str): Token of instance
             aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+            params: RSS parameter dictionary to use instead of the aggressive or conservative set
+            ego_states: ego state table covering the instance's scene (see build_ego_state_table()).
+                        Built for the instance's scene if not given
 
         Returns:
             scores: list of dict containing
@@ -65,46 +89,287 @@ def generate_scores_for_instance(nusc, instance_token, aggressive=True):
                 score: from 0 to 1 to describe safety across scene
     """
 
-    if aggressive:
-        params = rss_aggressive
-    else:
-        params = rss_conservative
+    if params is None:
+        params = get_params(aggressive)
 
     first_annotation_token = nusc.get('instance', instance_token)['first_annotation_token']
     annotation = nusc.get('sample_annotation', first_annotation_token)
-    scores = []
-    next_annotation = True
-    while next_annotation:
-        score = generate_score_for_annotation(annotation, nusc, params, scores)
 
-        if score:
-            scores.append(score)
+    if ego_states is None:
+        scene_token = nusc.get('sample', annotation['sample_token'])['scene_token']
+        ego_states = build_ego_state_table(nusc, get_scene_sample_tokens(nusc, scene_token))
 
-        # continue to the next annotation
-        if not annotation['next']:
-            next_annotation = False
-        else:
-            annotation = nusc.get('sample_annotation', annotation['next'])
-    return scores
+    track = [nusc.getind('sample_annotation', first_annotation_token)]
+    while annotation['next']:
+        track.append(nusc.getind('sample_annotation', annotation['next']))
+        annotation = nusc.sample_annotation[track[-1]]
+
+    return generate_scores_for_track(nusc, track, params, ego_states)
+
+
+def generate_scores_for_track(nusc, track, params, ego_states):
+    """
+    Returns a list of scores for the annotations of an instance
+        Parameters:
+            nusc (NuScenes): NuScenes object
+            track: indexes of the instance's annotations in nusc.sample_annotation, in order
+            params: RSS parameter dictionary to use
+            ego_states: ego state table covering the instance's scene (see build_ego_state_table())
+
+        Returns:
+            scores: list of score dictionaries, see generate_scores_for_instance()
+    """
+
+    return list(iter_scores_for_track(nusc, track, params, ego_states))
+
+
+def iter_scores_for_track(nusc, track, params, ego_states):
+    """
+    Yields the scores for the annotations of an instance one at a time, see generate_scores_for_track()
+    """
+
+    # only the previous score is needed when scoring the next annotation
+    previous = []
+    for features in iter_features_for_track(nusc, track, ego_states):
+        score = score_annotation_features(features, params, previous)
+        previous = [score]
+        yield score
+
+
+def iter_features_for_track(nusc, track, ego_states):
+    """
+    Yields the parameter-independent features of the annotations of an instance which can be scored, see
+    generate_features_for_annotation()
+    """
+
+    # velocities are found for the whole track at once, before filtering, as they depend on the neighbours
+    track = np.asarray(track)
+    velocities = get_track_velocities(nusc, track)
+
+    # parked vehicles and cycles without riders are not scored
+    scored = ~get_annotation_masks(nusc)['is_parked_or_riderless'][track]
+    track = track[scored]
+    velocities = velocities[scored]
+
+    # box corners are found from the stored yaws for the whole track at once
+    footprints = get_annotation_footprints(nusc, track)
+
+    for index, v_ann, ann_bb in zip(track, velocities, footprints):
+        features = generate_features_for_annotation(nusc.sample_annotation[index], nusc, ego_states, v_ann=v_ann,
+                                                    ann_bb=ann_bb)
+        if features:
+            yield features
+
+
+def find_track_minimum_score(nusc, track, params, ego_states, prune=True):
+    """
+    Finds the first minimum score of the annotations of an instance, as kept by iter_scores_for_scene().
+
+    With pruning, annotations which are certain to score 1 (see find_prunable_annotations()) are skipped
+    without finding their distances. The first of them is only scored if no annotation of the instance
+    scores below 1, in which case it may be the first minimum. A skipped annotation has no reason, so the
+    reason carried to the next annotation is reset just as if it had been scored.
+        Parameters:
+            nusc (NuScenes): NuScenes object
+            track: indexes of the instance's annotations in nusc.sample_annotation, in order
+            params: RSS parameter dictionary to use
+            ego_states: ego state table covering the instance's scene (see build_ego_state_table())
+            prune: If false, then every annotation is scored
+
+        Returns:
+            score: score dictionary, or None if no annotation can be scored
+    """
+
+    track = np.asarray(track)
+    velocities = get_track_velocities(nusc, track)
+
+    # parked vehicles and cycles without riders are not scored
+    scored = ~get_annotation_masks(nusc)['is_parked_or_riderless'][track]
+    track = track[scored]
+    velocities = velocities[scored]
+
+    if prune:
+        pruned = find_prunable_annotations(nusc, track, velocities, ego_states, params)
+    else:
+        pruned = np.zeros(len(track), dtype=bool)
+
+    footprints = np.zeros((len(track), 4, 2))
+    footprints[~pruned] = get_annotation_footprints(nusc, track[~pruned])
+
+    minimum = None
+    first_pruned = None
+    previous = []
+    for position, (index, v_ann) in enumerate(zip(track, velocities)):
+        if pruned[position]:
+            if first_pruned is None and minimum is None:
+                first_pruned = position
+            previous = [{'reason': None}]
+            continue
+
+        features = generate_features_for_annotation(nusc.sample_annotation[index], nusc, ego_states, v_ann=v_ann,
+                                                    ann_bb=footprints[position])
+        if features:
+            score = score_annotation_features(features, params, previous)
+            previous = [score]
+            if minimum is None or score['score'] < minimum['score']:
+                minimum = score  # keep the first minimum score
+
+    if first_pruned is not None and (minimum is None or minimum['score'] == 1):
+        # the skipped annotation came first and scores 1, so it is the first minimum
+        features = generate_features_for_annotation(nusc.sample_annotation[track[first_pruned]], nusc,
+                                                    ego_states, v_ann=velocities[first_pruned])
+        minimum = score_annotation_features(features, params, [])
+
+    return minimum
+
+
+# Extra distance, in metres, added to the envelope around the ego in which annotations are always scored, and
+# extra speed, in m/s, added to the velocities bounding the RSS minimum distances, so that rounding in the
+# distances and velocities found for scoring cannot make a pruned annotation score below 1
+PRUNE_MARGIN = 1.0
+PRUNE_SPEED_MARGIN = 1e-6
+
+
+@timed('find_prunable_annotations')
+def find_prunable_annotations(nusc, track, velocities, ego_states, params):
+    """
+    Finds the annotations of a track which are certain to score 1, from the velocities and the distance
+    between the centres of the annotations and the ego alone, without finding their bounding boxes.
+
+    The distances between the boxes are at least the distances between their centres less the ego's half
+    width or length and the annotation's half diagonal, see find_certainly_safe().
+        Parameters:
+            nusc (NuScenes): NuScenes object
+            track: indexes of the annotations in nusc.sample_annotation
+            velocities: (N, 3) velocities of the annotations, see get_track_velocities()
+            ego_states: ego state table containing the annotations' samples (see build_ego_state_table())
+            params: RSS parameter dictionary to use
+
+        Returns:
+            pruned: boolean array, true for annotations which would be scored and are certain to score 1
+    """
+
+    annotations = [nusc.sample_annotation[index] for index in track]
+    if not annotations:
+        return np.zeros(0, dtype=bool)
+    rows = np.array([ego_states['index'][annotation['sample_token']] for annotation in annotations])
+    centres = np.array([annotation['translation'][0:2] for annotation in annotations], dtype=float)
+    radii = 0.5 * norm(np.array([annotation['size'] for annotation in annotations], dtype=float), axis=1)
+    heading = ego_states['heading'][rows]
+
+    # only annotations which generate_features_for_annotation() would score
+    v_ego = ego_states['velocity'][rows]
+    valid = (~np.isnan(velocities).any(axis=1) & ~np.isnan(v_ego).any(axis=1)
+             & (ego_states['long_velocity'][rows] >= 0))
+
+    # velocities as [lateral, longitudinal], see generate_features_for_annotation()
+    v_ego_aligned = rotate_points(-heading, np.where(valid[:, None], v_ego, 0)[:, 0:2])
+    v_ann_aligned = rotate_points(-heading, np.where(valid[:, None], velocities, 0)[:, 0:2])
 
+    # distances between the centres in the ego's frame, as [lateral, longitudinal]
+    ego_centres = ego_states['bounding_box'][rows].mean(axis=1)
+    offsets = np.abs(rotate_points(-heading, centres - ego_centres))
+    lat_gap = offsets[:, 0] - renault_zoe_dims['width'] / 2 - radii
+    long_gap = offsets[:, 1] - renault_zoe_dims['length'] / 2 - radii
 
-def generate_score_for_annotation(annotation, nusc, params, scores):
-    # check vehicle is not parked
-    if any([nusc.get('attribute', t)['name'] == 'vehicle.parked'
-            or nusc.get('attribute', t)['name'] == 'cycle.without_rider'
-            for t in annotation['attribute_tokens']]):
+    return valid & find_certainly_safe(lat_gap, long_gap, v_ego_aligned, v_ann_aligned, params)
+
+
+def find_certainly_safe(lat_gaps, long_gaps, v_ego, v_other, params):
+    """
+    Finds where a vehicle is certain to score 1, given lower bounds on its distances from the ego. See
+    find_prunable_annotations(), the ego may be any vehicle (see pairwise.py).
+
+    An annotation scores 1 if either its lateral or its longitudinal distance from the ego is enough more than
+    the RSS minimum. The minimum distances are bounded by taking whichever vehicle is on the left or in front
+    gives the larger distance.
+        Parameters:
+            lat_gaps: lower bounds on the lateral distances between the boxes
+            long_gaps: lower bounds on the longitudinal distances between the boxes
+            v_ego: (..., 2) velocities of the ego as [lateral, longitudinal], aligned with its heading
+            v_other: (..., 2) velocities of the other vehicles, aligned with the ego's heading
+            params: RSS parameter dictionary to use
+
+        Returns:
+            safe: boolean array, true where the score is certain to be 1
+    """
+
+    e = PRUNE_SPEED_MARGIN
+
+    # the largest minimum distances the RSS rules could give, with either vehicle on the left and the other
+    # vehicle travelling either way, plus the margins which give a score of 1 (see score_annotation_features())
+    ego_lat = v_ego[..., 0]
+    other_lat = v_other[..., 0]
+    d_lat_max = np.maximum(find_min_lat_distances(ego_lat + e, other_lat - e, params),
+                           find_min_lat_distances(other_lat + e, ego_lat - e, params)) + 1
+
+    ego_long = np.abs(v_ego[..., 1]) + e
+    other_long = np.abs(v_other[..., 1])
+    d_long_max = np.maximum(find_min_long_distances(ego_long, np.maximum(other_long - e, 0), params),
+                            find_min_long_distances_opposite_direction(ego_long, -(other_long + e),
+                                                                       params)) + 1 / 0.4
+
+    return (lat_gaps >= d_lat_max + PRUNE_MARGIN) | (long_gaps >= d_long_max + PRUNE_MARGIN)
+
+
+@timed('generate_score_for_annotation')
+def generate_score_for_annotation(annotation, nusc, params, scores, ego_states=None, v_ann=None):
+    """
+    Scores the interaction between the ego and a single annotation. Annotations of parked vehicles and
+    cycles without riders are not scored and should be filtered out beforehand, see get_annotation_masks()
+        Parameters:
+            annotation: sample annotation dictionary
+            nusc (NuScenes): NuScenes object
+            params: RSS parameter dictionary to use
+            scores: scores already found for earlier annotations of the instance. Only the last is used
+            ego_states: ego state table containing the annotation's sample (see build_ego_state_table()).
+                        Built for the annotation's sample if not given
+            v_ann: velocity of the annotation, e.g. from get_track_velocities(). Found with
+                   NuScenes.box_velocity() if not given
+
+        Returns:
+            score: score dictionary, or None if the annotation cannot be scored
+    """
+
+    features = generate_features_for_annotation(annotation, nusc, ego_states, v_ann)
+    if features is None:
         return None
+    return score_annotation_features(features, params, scores)
+
+
+@timed('generate_features_for_annotation')
+def generate_features_for_annotation(annotation, nusc, ego_states=None, v_ann=None, ann_bb=None):
+    """
+    Finds the parts of an annotation's score which do not depend on the RSS parameters: the velocities and
+    distances aligned with the ego's heading, and the relative position of the vehicles. These can be
+    scored against any number of parameter sets, see score_annotation_features() and score_feature_columns()
+        Parameters:
+            annotation: sample annotation dictionary
+            nusc (NuScenes): NuScenes object
+            ego_states: ego state table containing the annotation's sample (see build_ego_state_table()).
+                        Built for the annotation's sample if not given
+            v_ann: velocity of the annotation, found with NuScenes.box_velocity() if not given
+            ann_bb: corners of the annotation on the ground, e.g. from get_annotation_footprints(). Found
+                    from the annotation's yaw if not given
+
+        Returns:
+            features: dictionary of FEATURE_KEYS, or None if the annotation cannot be scored
+    """
+    if ego_states is None:
+        ego_states = build_ego_state_table(nusc, [annotation['sample_token']])
+    ego_index = ego_states['index'][annotation['sample_token']]
 
     # find velocities of ego and annotated vehicle
-    v_ego = get_ego_velocity(nusc, annotation['sample_token'])
-    v_ann = nusc.box_velocity(annotation['token'])
+    v_ego = ego_states['velocity'][ego_index]
+    if v_ann is None:
+        v_ann = nusc.box_velocity(annotation['token'])
 
     # Check all velocities are valid
     if np.isnan(v_ego).any() or np.isnan(v_ann).any():
         return None
 
     # find the longitudinal and lateral velocities w.r.t the heading of the ego
-    heading_angle = get_ego_heading(nusc, annotation['sample_token'])
+    heading_angle = ego_states['heading'][ego_index]
 
     v_ego_aligned = rotation(-heading_angle, v_ego)
     v_ann_aligned = rotation(-heading_angle, v_ann)
@@ -113,30 +378,58 @@ def generate_score_for_annotation(annotation, nusc, params, scores):
     if v_ego_aligned[1] < 0:
         return None
 
-    translation = get_delta_translation(nusc, annotation, heading_angle)
+    translation = get_delta_translation(nusc, annotation, heading_angle,
+                                        ego_bb=ego_states['bounding_box'][ego_index], ann_bb=ann_bb)
 
     # check the relative positions of the vehicles
     ego_is_behind = is_right_of(-heading_angle + np.pi / 2, np.zeros(2), translation)
     ego_is_right = is_right_of(-heading_angle, np.zeros(2), translation)
 
+    translation_aligned = rotation(-heading_angle, translation)
+
+    return {
+        'annotation': annotation['token'],
+        'ego_long_velocity': v_ego_aligned[1],
+        'ego_lat_velocity': v_ego_aligned[0],
+        'ann_long_velocity': v_ann_aligned[1],
+        'ann_lat_velocity': v_ann_aligned[0],
+        'long_distance': translation_aligned[1],
+        'lat_distance': translation_aligned[0],
+        'ego_is_behind': bool(ego_is_behind),
+        'ego_is_right': bool(ego_is_right),
+    }
+
+
+def score_annotation_features(features, params, scores):
+    """
+    Scores the interaction between the ego and a single annotation from its parameter-independent features
+        Parameters:
+            features: features of the annotation, see generate_features_for_annotation()
+            params: RSS parameter dictionary to use
+            scores: scores already found for earlier annotations of the instance. Only the last is used
+
+        Returns:
+            score: score dictionary
+    """
+
     same_direction = None
 
-    if ego_is_behind:
+    if features['ego_is_behind']:
         # find the longitudinal distance between the vehicles w.r.t the
         # heading of the ego
-        d_long = np.abs(rotation(-heading_angle, translation)[1])
+        d_long = np.abs(features['long_distance'])
         # find the minimum longitudinal distance between the cars
-        if v_ann_aligned[1] >= 0:
+        if features['ann_long_velocity'] >= 0:
             # cars travelling in same direction
             same_direction = True
-            d_long_min = find_min_long_distance(norm(v_ego_aligned[1]),
-                                                norm(v_ann_aligned[1]),
+            d_long_min = find_min_long_distance(norm(features['ego_long_velocity']),
+                                                norm(features['ann_long_velocity']),
                                                 params)
         else:
             # cars travelling in opposite directions
             same_direction = False
-            d_long_min = find_min_long_distance_opposite_direction(norm(v_ego_aligned[1]),
-                                                                   -norm(v_ann_aligned[1]),
+            d_long_min = find_min_long_distance_opposite_direction(norm(features['ego_long_velocity']),
+                                                                   -norm(features['ann_long_velocity']),
                                                                    params)
         long_score = generate_individual_score(d_long_min, d_long, gradient=0.4)
     else:
@@ -146,16 +439,16 @@ def generate_score_for_annotation(annotation, nusc, params, scores):
         d_long_min = None
 
     # find the lateral distance between the vehicles w.r.t the heading of the ego
-    d_lat = np.abs(rotation(-heading_angle, translation)[0])
+    d_lat = np.abs(features['lat_distance'])
 
     # Assign velocities to input variables for RSS rule 2.
     # c1 is on the left, c2 is on the right, with velocities v1 and v2 respectively
-    if ego_is_right:
-        v1 = v_ann_aligned[0]
-        v2 = v_ego_aligned[0]
+    if features['ego_is_right']:
+        v1 = features['ann_lat_velocity']
+        v2 = features['ego_lat_velocity']
     else:
-        v1 = v_ego_aligned[0]
-        v2 = v_ann_aligned[0]
+        v1 = features['ego_lat_velocity']
+        v2 = features['ann_lat_velocity']
 
     # find the minimum lateral distances between the cars
     d_lat_min = find_min_lat_distance(v1,
@@ -185,21 +478,233 @@ def generate_score_for_annotation(annotation, nusc, params, scores):
             reason = scores[-1]['reason']
 
     return {
-        'annotation': annotation['token'],
+        'annotation': features['annotation'],
         'reason': reason,
         'score': max_score,
-        'ego_long_velocity': v_ego_aligned[1],
-        'ego_lat_velocity': v_ego_aligned[0],
-        'ann_long_velocity': v_ann_aligned[1],
-        'ann_lat_velocity': v_ann_aligned[0],
-        'long_distance': rotation(-heading_angle, translation)[1],
-        'lat_distance': rotation(-heading_angle, translation)[0],
+        'ego_long_velocity': features['ego_long_velocity'],
+        'ego_lat_velocity': features['ego_lat_velocity'],
+        'ann_long_velocity': features['ann_long_velocity'],
+        'ann_lat_velocity': features['ann_lat_velocity'],
+        'long_distance': features['long_distance'],
+        'lat_distance': features['lat_distance'],
         'min_long_distance': d_long_min,
         'min_lat_distance': d_lat_min,
         'same_direction': same_direction
     }
 
 
+# Parameter-independent features of each scored annotation, see generate_features_for_annotation()
+FEATURE_FLOAT_KEYS = ['ego_long_velocity', 'ego_lat_velocity', 'ann_long_velocity', 'ann_lat_velocity',
+                      'long_distance', 'lat_distance']
+FEATURE_BOOL_KEYS = ['ego_is_behind', 'ego_is_right']
+
+
+@timed('generate_feature_columns_for_scene')
+def generate_feature_columns_for_scene(nusc, scene_token):
+    """
+    Finds the parameter-independent features of every scored annotation in a scene, as column arrays which
+    can be scored against any parameter sets with score_feature_columns()
+    Args:
+        nusc (NuScenes): a nuScenes object
+        scene_token (str): the token of the scene to analyse
+
+    Returns:
+        columns: dictionary of arrays with one entry per annotation, grouped by instance in the order of
+                 iter_scores_for_scene(). annotation and instance tokens, FEATURE_FLOAT_KEYS and FEATURE_BOOL_KEYS
+
+    """
+
+    sample_tokens = get_scene_sample_tokens(nusc, scene_token)
+    ego_states = build_ego_state_table(nusc, sample_tokens)
+    tracks = build_instance_tracks(nusc, sample_tokens)
+    is_vehicle = get_annotation_masks(nusc)['is_vehicle'][[track[0] for track in tracks.values()]]
+
+    features = []
+    instances = []
+    for (instance_token, track), vehicle in zip(tracks.items(), is_vehicle):
+        if vehicle:
+            for f in iter_features_for_track(nusc, track, ego_states):
+                features.append(f)
+                instances.append(instance_token)
+
+    columns = {
+        'annotation': np.array([f['annotation'] for f in features], dtype=str),
+        'instance': np.array(instances, dtype=str),
+    }
+    for key in FEATURE_FLOAT_KEYS:
+        columns[key] = np.array([f[key] for f in features], dtype=float)
+    for key in FEATURE_BOOL_KEYS:
+        columns[key] = np.array([f[key] for f in features], dtype=bool)
+    return columns
+
+
+def concatenate_feature_columns(column_sets):
+    """
+    Joins the feature columns of several scenes
+
+        Parameters:
+            column_sets: list of feature column dictionaries, see generate_feature_columns_for_scene()
+
+        Returns:
+            columns: feature column dictionary
+    """
+
+    keys = ['annotation', 'instance'] + FEATURE_FLOAT_KEYS + FEATURE_BOOL_KEYS
+    if not column_sets:
+        return {key: np.array([], dtype=bool if key in FEATURE_BOOL_KEYS else float) for key in keys}
+    return {key: np.concatenate([columns[key] for columns in column_sets]) for key in keys}
+
+
+def get_track_starts(instances):
+    """
+    Finds where each instance's annotations start in feature columns
+
+        Parameters:
+            instances: array of instance tokens, with each instance's annotations next to each other
+
+        Returns:
+            starts: indexes of the first annotation of each instance
+    """
+
+    if len(instances) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate([[True], instances[1:] != instances[:-1]]))
+
+
+@timed('score_feature_columns')
+def score_feature_columns(columns, params, carry_reasons=True):
+    """
+    Vectorised version of score_annotation_features(), scoring every annotation of feature columns at once.
+    The parameter values may be arrays from stack_params() to score against many parameter sets at once
+
+        Parameters:
+            columns: feature column dictionary, see generate_feature_columns_for_scene()
+            params: parameter dictionary to use, values may be scalars or arrays of shape (P, 1)
+            carry_reasons: If false, then 'Too close' reasons are not replaced by the previous annotation's
+                           reason (see resolve_reason_codes()), e.g. when some annotations are missing
+
+        Returns:
+            scores: dictionary of arrays in the form of score_cache.scores_to_columns(), with shape (N,) for
+                    scalar parameters or (P, N) for score, reason, min_long_distance and min_lat_distance
+    """
+
+    ego_long = columns['ego_long_velocity']
+    ann_long = columns['ann_long_velocity']
+    behind = columns['ego_is_behind']
+    same = behind & (ann_long >= 0)
+    opposite = behind & ~(ann_long >= 0)
+    shape = np.broadcast(np.asarray(params['p']), ego_long).shape
+
+    # minimum longitudinal distances, only where the ego is behind
+    d_long_min = np.full(shape, np.nan)
+    d_long_min[..., same] = find_min_long_distances(np.abs(ego_long[same]), np.abs(ann_long[same]), params)
+    d_long_min[..., opposite] = find_min_long_distances_opposite_direction(np.abs(ego_long[opposite]),
+                                                                           -np.abs(ann_long[opposite]), params)
+    long_score = np.ones(shape)
+    long_score[..., behind] = generate_individual_scores(d_long_min[..., behind],
+                                                         np.abs(columns['long_distance'][behind]), gradient=0.4)
+
+    # c1 is on the left, c2 is on the right, see score_annotation_features()
+    right = columns['ego_is_right']
+    v1 = np.where(right, columns['ann_lat_velocity'], columns['ego_lat_velocity'])
+    v2 = np.where(right, columns['ego_lat_velocity'], columns['ann_lat_velocity'])
+    d_lat_min = np.broadcast_to(find_min_lat_distances(v1, v2, params), shape)
+    lat_score = generate_individual_scores(d_lat_min, np.abs(columns['lat_distance']), gradient=1)
+
+    score = np.maximum(long_score, lat_score)
+
+    reason = np.full(shape, score_reasons.index('Unknown'), dtype=np.int8)
+    reason[score == lat_score] = score_reasons.index('Laterally too close')
+    reason[score == long_score] = score_reasons.index('Longitudinally too close')
+    reason[score == 0] = score_reasons.index('Too close')
+    reason[score == 1] = score_reasons.index(None)
+    if carry_reasons:
+        reason = resolve_reason_codes(reason, get_track_starts(columns['instance']))
+
+    return {
+        'annotation': columns['annotation'],
+        'instance': columns['instance'],
+        'reason': reason,
+        'score': score,
+        'ego_long_velocity': columns['ego_long_velocity'],
+        'ego_lat_velocity': columns['ego_lat_velocity'],
+        'ann_long_velocity': columns['ann_long_velocity'],
+        'ann_lat_velocity': columns['ann_lat_velocity'],
+        'long_distance': columns['long_distance'],
+        'lat_distance': columns['lat_distance'],
+        'min_long_distance': d_long_min,
+        'min_lat_distance': np.array(d_lat_min),
+        'same_direction': np.where(behind, same.astype(np.int8), -1).astype(np.int8),
+    }
+
+
+def resolve_reason_codes(reason, track_starts):
+    """
+    Vectorised version of copying the previous reason in score_annotation_features(): a 'Too close' reason
+    takes the reason of the last annotation of the same instance with another reason, unless that
+    annotation had a perfect score
+
+        Parameters:
+            reason: array of reason codes (indexes into score_reasons), shape (N,) or (P, N)
+            track_starts: indexes of the first annotation of each instance, see get_track_starts()
+
+        Returns:
+            reason: array of reason codes
+    """
+
+    n = reason.shape[-1]
+    too_close = reason == score_reasons.index('Too close')
+    positions = np.arange(n)
+
+    # the last annotation before each one without a 'Too close' reason, and the start of its instance
+    last = np.maximum.accumulate(np.where(too_close, -1, positions), axis=-1)
+    start = np.zeros(n, dtype=np.int64)
+    start[track_starts] = track_starts
+    start = np.maximum.accumulate(start)
+
+    carried = np.take_along_axis(reason, np.maximum(last, 0), axis=-1)
+    copy = too_close & (last >= start) & (carried != score_reasons.index(None))
+    return np.where(copy, carried, reason).astype(np.int8)
+
+
+def find_instance_minimums(score, track_starts):
+    """
+    Finds the first minimum score of each instance, as kept by iter_scores_for_scene()
+
+        Parameters:
+            score: array of scores, shape (N,) or (P, N)
+            track_starts: indexes of the first annotation of each instance, see get_track_starts()
+
+        Returns:
+            indexes: array of the indexes of each instance's minimum score, shape (I,) or (P, I)
+    """
+
+    if len(track_starts) == 0:
+        return np.zeros(score.shape[:-1] + (0,), dtype=np.int64)
+
+    n = score.shape[-1]
+    minimum = np.minimum.reduceat(score, track_starts, axis=-1)
+    lengths = np.diff(np.append(track_starts, n))
+    is_minimum = score == np.repeat(minimum, lengths, axis=-1)
+    return np.minimum.reduceat(np.where(is_minimum, np.arange(n), n), track_starts, axis=-1)
+
+
+def get_params(aggressive=True):
+    """
+    Returns the RSS parameter set in use
+
+        Parameters:
+            aggressive: If true, then aggressive RSS parameters are used, otherwise conservative parameters are used
+
+        Returns:
+            params: parameter dictionary
+    """
+
+    if aggressive:
+        return rss_aggressive
+    return rss_conservative
+
+
 def find_min_long_distance(v_r, v_f, params):
     """
     Returns the minimum required longitudinal distance per Rule 1 of RSS
@@ -216,11 +721,35 @@ def find_min_long_distance(v_r, v_f, params):
     assert v_r >= 0
     assert v_f >= 0
 
+    return float(find_min_long_distances(v_r, v_f, params))
+
+
+@timed('find_min_long_distances')
+def find_min_long_distances(v_r, v_f, params):
+    """
+    Vectorised version of find_min_long_distance(). All inputs are broadcast against each other, so the
+    parameter values may also be arrays (see stack_params()).
+
+        Parameters:
+            v_r: Array of velocities of rear vehicles
+            v_f: Array of velocities of front vehicles
+            params: Parameter dictionary to use, values may be scalars or arrays
+
+        Returns:
+            d_min: Array of minimum required distances
+    """
+
+    v_r = np.asarray(v_r, dtype=float)
+    v_f = np.asarray(v_f, dtype=float)
+
+    assert np.all(v_r >= 0)
+    assert np.all(v_f >= 0)
+
     # find constant parameters
-    a_max_accel = params['a_long_max_accel']
-    a_min_brake = params['a_long_min_brake']
-    a_max_brake = params['a_long_max_brake']
-    p = params['p']
+    a_max_accel = np.asarray(params['a_long_max_accel'])
+    a_min_brake = np.asarray(params['a_long_min_brake'])
+    a_max_brake = np.asarray(params['a_long_max_brake'])
+    p = np.asarray(params['p'])
 
     d_min = (
             v_r * p
@@ -229,7 +758,7 @@ def find_min_long_distance(v_r, v_f, params):
             - (v_f ** 2) / (2 * a_max_brake)
     )
 
-    return max([0, d_min])
+    return np.maximum(0, d_min)
 
 
 def find_min_long_distance_opposite_direction(v_1, v_2, params):
@@ -249,19 +778,43 @@ def find_min_long_distance_opposite_direction(v_1, v_2, params):
     assert v_1 >= 0
     assert v_2 < 0
 
+    return float(find_min_long_distances_opposite_direction(v_1, v_2, params))
+
+
+@timed('find_min_long_distances_opposite_direction')
+def find_min_long_distances_opposite_direction(v_1, v_2, params):
+    """
+    Vectorised version of find_min_long_distance_opposite_direction(). All inputs are broadcast
+    against each other, so the parameter values may also be arrays (see stack_params()).
+
+    Args:
+        v_1: Array of velocities of cars with positive velocity
+        v_2: Array of velocities of cars with negative velocity
+        params: Parameter dictionary to use, values may be scalars or arrays
+
+    Returns: Array of minimum distances required
+
+    """
+
+    v_1 = np.asarray(v_1, dtype=float)
+    v_2 = np.asarray(v_2, dtype=float)
+
+    assert np.all(v_1 >= 0)
+    assert np.all(v_2 < 0)
+
     # find constant parameters
-    a_min_brake = params['a_long_min_brake']
-    a_min_brake_corr = params['a_long_min_brake_correct']
-    a_max_accel = params['a_long_max_accel']
-    p = params['p']
+    a_min_brake = np.asarray(params['a_long_min_brake'])
+    a_min_brake_corr = np.asarray(params['a_long_min_brake_correct'])
+    a_max_accel = np.asarray(params['a_long_max_accel'])
+    p = np.asarray(params['p'])
 
     v_1_p = v_1 + p * a_max_accel
-    v_2_p = abs(v_2) + p * a_max_accel
+    v_2_p = np.abs(v_2) + p * a_max_accel
 
     d_min = (
             (v_1 + v_1_p) * p / 2
             + (v_1_p ** 2) / (2 * a_min_brake_corr)
-            + (abs(v_2) + v_2_p) * p / 2
+            + (np.abs(v_2) + v_2_p) * p / 2
             + (v_2_p ** 2) / (2 * a_min_brake)
     )
 
@@ -282,15 +835,33 @@ def find_min_lat_distance(v_1, v_2, params):
 
     """
 
-    # find constant parameters
-    mu = params['mu']
-    a_lat_min_brake = params['a_lat_min_brake']
-    a_lat_max_accel = params['a_lat_max_accel']
-    p = params['p']
+    return float(find_min_lat_distances(v_1, v_2, params))
 
-    # if the cars are moving apart then situation is not dangerous
-    if v_1 < 0 or v_2 > 0:
-        return mu
+
+@timed('find_min_lat_distances')
+def find_min_lat_distances(v_1, v_2, params):
+    """
+    Vectorised version of find_min_lat_distance(). All inputs are broadcast against each other, so the
+    parameter values may also be arrays (see stack_params()).
+
+        Parameters:
+            v_1: Array of lateral velocities of left cars (positive to the right)
+            v_2: Array of lateral velocities of right cars (positive to the left)
+            params: Parameter dictionary to use, values may be scalars or arrays
+
+        Returns:
+            d_min: Array of minimum safe lateral distances
+
+    """
+
+    v_1 = np.asarray(v_1, dtype=float)
+    v_2 = np.asarray(v_2, dtype=float)
+
+    # find constant parameters
+    mu = np.asarray(params['mu'])
+    a_lat_min_brake = np.asarray(params['a_lat_min_brake'])
+    a_lat_max_accel = np.asarray(params['a_lat_max_accel'])
+    p = np.asarray(params['p'])
 
     v_1_p = v_1 + p * a_lat_max_accel
     v_2_p = v_2 - p * a_lat_max_accel
@@ -304,10 +875,13 @@ def find_min_lat_distance(v_1, v_2, params):
             )
     )
 
-    return max([mu, mu + d_min])
+    # if the cars are moving apart then situation is not dangerous
+    moving_apart = (v_1 < 0) | (v_2 > 0)
+
+    return np.where(moving_apart, mu, np.maximum(mu, mu + d_min))
 
 
-def generate_individual_score(minimum, actual, gradient):
+def generate_individual_score(minimum, actual, gradient=0.2):
     """
     Generates a score between 0 and 1 given minimum and actual values
 
@@ -320,14 +894,48 @@ def generate_individual_score(minimum, actual, gradient):
             score: the generated score
     """
 
-    margin = actual - minimum
+    return float(generate_individual_scores(minimum, actual, gradient))
+
+
+@timed('generate_individual_scores')
+def generate_individual_scores(minimum, actual, gradient=0.2):
+    """
+    Vectorised version of generate_individual_score(). All inputs are broadcast against each other.
+
+        Parameters:
+            minimum: array of minimum allowable values
+            actual: array of actual values
+            gradient: measure of how close the values can be. Higher value gives higher score when close
+
+        Returns:
+            scores: array of generated scores
+    """
+
+    with np.errstate(invalid='ignore'):
+        margin = np.asarray(actual, dtype=float) - np.asarray(minimum, dtype=float)
+
+    score = np.minimum(1, gradient * margin)  # score cannot be greater than 1
 
-    if margin <= 0:
-        return 0
+    # an undefined margin, e.g. from an infinite minimum and actual value, scores 1 as in the original
+    # scalar version, where min(1, nan) is 1
+    return np.where(np.isnan(margin), 1.0, np.where(margin <= 0, 0.0, score))
 
-    score = gradient * margin
 
-    return min(1, score)  # score cannot be greater than 1
+def stack_params(param_sets):
+    """
+    Combines several parameter dictionaries into one dictionary of column arrays so that many parameter
+    sets can be evaluated at once by the vectorised functions
+
+        Parameters:
+            param_sets: list of parameter dictionaries
+
+        Returns:
+            params: dictionary of arrays with shape (len(param_sets), 1), which broadcast against
+                    arrays of velocities/distances to give results with shape (len(param_sets), N)
+    """
+
+    return {key: np.array([params[key] for params in param_sets], dtype=float)[:, np.newaxis]
+            for key in param_sets[0]}
 
 
 def is_right_of(theta, p1, p2):
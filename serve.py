@@ -0,0 +1,175 @@
+import argparse
+import gc
+import os
+import signal
+import sys
+import time
+
+import ui
+
+
+def get_process_share(workers):
+    """
+    Finds how many render processes, and scoring processes for the whole dataset statistics, each server
+    process starts, so that together they use every CPU once
+
+    Args:
+        workers: number of server processes
+
+    Returns: number of processes of each kind per server process
+
+    """
+
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def run_gunicorn(app, args):
+    """
+    Serves the app with gunicorn. The app is already loaded, so the worker processes gunicorn forks share it
+
+    Args:
+        app: Flask app returned by ui.create_app()
+        args: command line arguments
+
+    """
+
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '%s:%d' % (args.host, args.port))
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('preload_app', True)
+            # scoring a large scene for the first time can take longer than gunicorn's default of 30 seconds
+            self.cfg.set('timeout', 300)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+def run_builtin(app, args):
+    """
+    Serves the app with a pre-forking server built on werkzeug, for when gunicorn is not installed. The
+    listening socket is opened before forking and every worker process accepts connections from it, each
+    serving requests on threads. Each worker is put in its own process group with the processes it starts to
+    render and score, so that they are stopped together. Worker processes which stop are replaced, and all
+    are stopped when the server is interrupted or terminated.
+
+    Args:
+        app: Flask app returned by ui.create_app()
+        args: command line arguments
+
+    """
+
+    from werkzeug.serving import make_server
+
+    server = make_server(args.host, args.port, app, threaded=True)
+    stopping = False
+    children = set()
+
+    def start_worker():
+        pid = os.fork()
+        if pid == 0:
+            os.setpgid(0, 0)
+            # the parent stops the workers
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        # also set here, in case the worker is stopped before it has set its own group
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        children.add(pid)
+
+    def stop_group(pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            stop_group(pid)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(args.workers):
+        start_worker()
+    print('Serving on http://%s:%d with %d worker processes' % (args.host, args.port, args.workers),
+          file=sys.stderr)
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        # stops any render or scoring processes left by the worker
+        stop_group(pid)
+        if not stopping:
+            print('Worker process %d stopped, starting another' % pid, file=sys.stderr)
+            # avoids restarting continuously if workers fail as soon as they start
+            time.sleep(1)
+            start_worker()
+    server.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serves the web UI from several worker processes, which share '
+                                                 'one copy of the dataset loaded before they are started.')
+    parser.add_argument('dataroot', help='root directory of the dataset, e.g. data/sets/nuscenes')
+    parser.add_argument('version', help='dataset version, e.g. v1.0-mini')
+    parser.add_argument('-w', '--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='number of worker processes, defaults to the number of CPUs up to 4')
+    parser.add_argument('-t', '--threads', type=int, default=4,
+                        help='number of requests each worker process serves at once (default 4)')
+    parser.add_argument('--host', default=ui.HOST,
+                        help='address to listen on (default %s), 0.0.0.0 for every interface' % ui.HOST)
+    parser.add_argument('--port', type=int, default=ui.PORT, help='port to listen on (default %d)' % ui.PORT)
+    parser.add_argument('--builtin', action='store_true',
+                        help='use the built-in server even if gunicorn is installed')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Loads the dataset and starts the worker processes
+
+    """
+
+    args = parse_args(argv)
+    if not hasattr(os, 'fork'):
+        raise SystemExit('serve.py requires a platform with fork, use python ui.py on Windows')
+
+    share = get_process_share(args.workers)
+    app = ui.create_app(args.dataroot, args.version, render_workers=share, dataset_stats_workers=share)
+    # moves everything loaded so far out of the garbage collector's reach, so that collections in the workers
+    # do not write to, and so copy, the pages the dataset is in
+    gc.freeze()
+
+    if args.builtin:
+        run_builtin(app, args)
+        return
+    try:
+        import gunicorn
+    except ImportError:
+        print('gunicorn is not installed, using the built-in server', file=sys.stderr)
+        run_builtin(app, args)
+        return
+    run_gunicorn(app, args)
+
+
+if __name__ == '__main__':
+    main()
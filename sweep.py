@@ -0,0 +1,223 @@
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+
+import numpy as np
+
+from batch_score import find_scene_tokens, load_params
+from constants import rss_aggressive, score_reasons
+from parallel_scoring import iter_scene_results
+from scoring import concatenate_feature_columns, find_instance_minimums, generate_feature_columns_for_scene, \
+    get_track_starts, score_feature_columns, stack_params
+
+# Parameter sets scored at once. Each chunk holds a few (P, N) arrays, so this bounds the memory used
+CHUNK_SIZE = 32
+
+
+def parse_range(text):
+    """
+    Parses the values of one parameter from the command line
+
+    Args:
+        text: key=start:stop:num for evenly spaced values (including stop), or key=v1,v2,... for a list
+
+    Returns: (key, list of values) tuple
+
+    """
+
+    key, _, values = text.partition('=')
+    if key not in rss_aggressive:
+        raise SystemExit('Unknown parameter %s, expected one of %s' % (key, ', '.join(rss_aggressive)))
+    try:
+        if ':' in values:
+            start, stop, num = values.split(':')
+            return key, [float(v) for v in np.linspace(float(start), float(stop), int(num))]
+        return key, [float(v) for v in values.split(',')]
+    except ValueError:
+        raise SystemExit('Cannot parse values of %s: %s' % (key, values))
+
+
+def make_param_grid(base, ranges):
+    """
+    Makes every combination of the given parameter values
+
+    Args:
+        base: parameter dictionary giving the values of parameters which are not varied
+        ranges: dictionary of parameter name to list of values
+
+    Returns: list of parameter dictionaries
+
+    """
+
+    keys = list(ranges)
+    return [dict(base, **dict(zip(keys, values))) for values in itertools.product(*[ranges[k] for k in keys])]
+
+
+def generate_sweep(nusc, param_sets, scene_tokens=None, workers=None, progress=True):
+    """
+    Scores every annotation against many parameter sets. The parameter-independent features are found once
+    per annotation, in a pool of worker processes, then every parameter set is scored against them at once
+
+    Args:
+        nusc (NuScenes): a nuScenes object
+        param_sets: list of parameter dictionaries
+        scene_tokens: tokens of scenes to score. Defaults to every scene in the dataset
+        workers: number of worker processes, see iter_scene_results()
+        progress: if true then a progress bar is shown
+
+    Returns: dictionary of arrays
+        scene, instance, annotation: (N,) tokens of each scored annotation
+        score: (N, P) score of each annotation against each parameter set
+        reason: (N, P) reason codes, indexes into constants.score_reasons
+        instance_index: (I, P) index of each instance's minimum score, as reported by generate_scores_for_scene()
+        params: (P, K) parameter values, in the order of param_keys
+        param_keys: names of the parameters
+
+    """
+
+    column_sets = []
+    scenes = []
+    for scene_token, columns in iter_scene_results(nusc, generate_feature_columns_for_scene, scene_tokens,
+                                                   workers, progress):
+        column_sets.append(columns)
+        scenes.append(np.full(len(columns['annotation']), scene_token))
+    columns = concatenate_feature_columns(column_sets)
+    track_starts = get_track_starts(columns['instance'])
+
+    n = len(columns['annotation'])
+    score = np.zeros((n, len(param_sets)))
+    reason = np.zeros((n, len(param_sets)), dtype=np.int8)
+    instance_index = np.zeros((len(track_starts), len(param_sets)), dtype=np.int64)
+    for start in range(0, len(param_sets), CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        scores = score_feature_columns(columns, stack_params(param_sets[chunk]))
+        score[:, chunk] = scores['score'].T
+        reason[:, chunk] = scores['reason'].T
+        instance_index[:, chunk] = find_instance_minimums(scores['score'], track_starts).T
+
+    param_keys = list(param_sets[0])
+    return {
+        'scene': np.concatenate(scenes) if scenes else np.array([], dtype=str),
+        'instance': columns['instance'],
+        'annotation': columns['annotation'],
+        'score': score,
+        'reason': reason,
+        'instance_index': instance_index,
+        'params': np.array([[params[key] for key in param_keys] for params in param_sets], dtype=float),
+        'param_keys': np.array(param_keys),
+    }
+
+
+def summarise_sweep(sweep):
+    """
+    Summarises the instance scores of each parameter set, as counted on the dataset statistics page
+
+    Args:
+        sweep: dictionary of arrays from generate_sweep()
+
+    Returns: list of dictionaries, one per parameter set, with the parameter values and
+        instances: number of vehicle instances scored
+        mean_score: mean of the instances' minimum scores
+        flagged: number of instances with a score below 1
+        too_close: number of instances with a score of 0
+        a count for each reason, e.g. 'Laterally too close'
+
+    """
+
+    instance_score = np.take_along_axis(sweep['score'], sweep['instance_index'], axis=0)
+    instance_reason = np.take_along_axis(sweep['reason'], sweep['instance_index'], axis=0)
+
+    summary = []
+    for i, values in enumerate(sweep['params']):
+        row = {str(key): float(value) for key, value in zip(sweep['param_keys'], values)}
+        scores = instance_score[:, i]
+        row['instances'] = len(scores)
+        row['mean_score'] = float(scores.mean()) if len(scores) else None
+        row['flagged'] = int(np.count_nonzero(scores < 1))
+        row['too_close'] = int(np.count_nonzero(scores == 0))
+        for code, name in enumerate(score_reasons):
+            if name is not None:
+                row[name] = int(np.count_nonzero(instance_reason[:, i] == code))
+        summary.append(row)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Scores a nuScenes dataset against many RSS parameter sets in '
+                                                 'one pass, for sensitivity analysis.')
+    parser.add_argument('dataroot', help='root directory of the dataset, e.g. data/sets/nuscenes')
+    parser.add_argument('version', help='dataset version, e.g. v1.0-mini')
+    parser.add_argument('-g', '--grid', nargs='*', default=[],
+                        help='parameter values to sweep, as key=start:stop:num or key=v1,v2,... Every combination '
+                             'is scored, e.g. -g p=0.5:2:16 mu=0.05,0.07')
+    parser.add_argument('-b', '--base', default='aggressive',
+                        help='values of the parameters not in the grid: aggressive (default), conservative or a '
+                             'JSON file with a parameter dictionary')
+    parser.add_argument('--param-sets', default=None,
+                        help='JSON file with a list of parameter dictionaries to score instead of a grid')
+    parser.add_argument('-o', '--output', default=None,
+                        help='NPZ file to save the score matrix (annotation x parameter set) to')
+    parser.add_argument('--summary', default='-', help='CSV file for the summary of each parameter set, '
+                                                       '- for standard output (default)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('-s', '--scenes', nargs='*', default=[],
+                        help='scene tokens or names to score, defaults to the whole dataset')
+    parser.add_argument('--store', action='store_true', help='read the dataset from its metadata store')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not show progress')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Runs a parameter sweep from the command line
+
+    """
+
+    args = parse_args(argv)
+    if args.param_sets:
+        with open(args.param_sets) as f:
+            param_sets = json.load(f)
+    else:
+        param_sets = make_param_grid(load_params(args.base), dict(parse_range(r) for r in args.grid))
+    if not param_sets:
+        raise SystemExit('No parameter sets to score')
+    for params in param_sets:
+        missing = set(rss_aggressive) - set(params)
+        if missing:
+            raise SystemExit('Parameter set %s is missing %s' % (params, ', '.join(sorted(missing))))
+
+    start_time = time.time()
+    if args.store:
+        from metadata_store import open_metadata_store
+        nusc = open_metadata_store(args.dataroot, args.version, verbose=not args.quiet)
+    else:
+        from nuscenes.nuscenes import NuScenes
+        nusc = NuScenes(version=args.version, dataroot=args.dataroot, verbose=not args.quiet)
+
+    sweep = generate_sweep(nusc, param_sets, find_scene_tokens(nusc, args.scenes), args.workers,
+                           progress=not args.quiet)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            np.savez_compressed(f, **sweep)
+
+    summary = summarise_sweep(sweep)
+    f = sys.stdout if args.summary == '-' else open(args.summary, 'w', newline='')
+    try:
+        writer = csv.DictWriter(f, fieldnames=list(summary[0]))
+        writer.writeheader()
+        writer.writerows(summary)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    if not args.quiet:
+        print('Scored %d annotations against %d parameter sets in %.1f seconds'
+              % (len(sweep['annotation']), len(param_sets), time.time() - start_time), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import argparse
+import json
+import os
+import struct
+import uuid
+import zlib
+
+import numpy as np
+
+# nuScenes-style sensor calibration for the two channels the scorer reads
+CAM_FRONT_TRANSLATION = [1.70, 0.0, 1.51]
+RADAR_FRONT_TRANSLATION = [3.41, 0.0, 0.50]
+
+SAMPLE_PERIOD_US = 500000  # keyframes are at 2Hz in nuScenes
+RADAR_OFFSET_US = 12000  # radar keyframes are not exactly aligned with the camera
+
+VEHICLE_CATEGORIES = ['vehicle.car', 'vehicle.truck', 'vehicle.bus.rigid', 'vehicle.motorcycle']
+OTHER_CATEGORIES = ['human.pedestrian.adult', 'movable_object.barrier']
+ATTRIBUTES = ['vehicle.moving', 'vehicle.stopped', 'vehicle.parked',
+              'cycle.with_rider', 'cycle.without_rider', 'pedestrian.moving']
+SIZES = {
+    'vehicle.car': [1.9, 4.6, 1.7],
+    'vehicle.truck': [2.5, 7.5, 3.2],
+    'vehicle.bus.rigid': [2.9, 11.0, 3.5],
+    'vehicle.motorcycle': [0.8, 2.1, 1.4],
+    'human.pedestrian.adult': [0.6, 0.7, 1.8],
+    'movable_object.barrier': [2.5, 0.5, 1.0],
+}
+
+
+def _token(rng):
+    return uuid.UUID(int=int(rng.integers(0, 2 ** 63)) << 64 | int(rng.integers(0, 2 ** 63))).hex
+
+
+def _yaw_to_quaternion(yaw):
+    return [float(np.cos(yaw / 2)), 0.0, 0.0, float(np.sin(yaw / 2))]
+
+
+def _write_png(path, width=8, height=8):
+    """
+    Writes a small blank greyscale PNG, used as the map mask the devkit expects to exist
+    """
+    raw = b''.join(b'\x00' + b'\xff' * width for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw)))
+        f.write(chunk(b'IEND', b''))
+
+
+def generate_synthetic_dataset(dataroot, version='v1.0-synthetic', num_scenes=4, samples_per_scene=40,
+                               vehicles_per_sample=20, scenes_per_log=2, seed=0):
+    """
+    Writes a synthetic dataset in the nuScenes table format which can be loaded by NuScenes().
+
+    The ego drives along a gently curving road while other vehicles travel in neighbouring lanes in both
+    directions, some parked, some appearing part way through the scene. No sensor data is written so
+    renders are not available.
+
+    Args:
+        dataroot: directory to write the dataset to
+        version: name of the dataset version (the table directory)
+        num_scenes: number of scenes to generate
+        samples_per_scene: number of keyframe samples in each scene
+        vehicles_per_sample: approximate number of vehicles annotated in each sample
+        scenes_per_log: number of scenes recorded in each log
+        seed: seed for the random number generator
+
+    Returns: path to the directory containing the tables
+
+    """
+
+    rng = np.random.default_rng(seed)
+    tables = {name: [] for name in ['category', 'attribute', 'visibility', 'instance', 'sensor',
+                                    'calibrated_sensor', 'ego_pose', 'log', 'scene', 'sample',
+                                    'sample_data', 'sample_annotation', 'map']}
+
+    category_tokens = {}
+    for name in VEHICLE_CATEGORIES + OTHER_CATEGORIES:
+        category_tokens[name] = _token(rng)
+        tables['category'].append({'token': category_tokens[name], 'name': name, 'description': ''})
+
+    attribute_tokens = {}
+    for name in ATTRIBUTES:
+        attribute_tokens[name] = _token(rng)
+        tables['attribute'].append({'token': attribute_tokens[name], 'name': name, 'description': ''})
+
+    visibility_token = '4'
+    tables['visibility'].append({'token': visibility_token, 'level': 'v80-100', 'description': ''})
+
+    sensor_tokens = {}
+    for channel, modality in [('CAM_FRONT', 'camera'), ('RADAR_FRONT', 'radar')]:
+        sensor_tokens[channel] = _token(rng)
+        tables['sensor'].append({'token': sensor_tokens[channel], 'channel': channel, 'modality': modality})
+
+    os.makedirs(os.path.join(dataroot, 'maps'), exist_ok=True)
+    map_filename = 'maps/synthetic.png'
+    _write_png(os.path.join(dataroot, map_filename))
+    map_record = {'token': _token(rng), 'category': 'semantic_prior', 'filename': map_filename,
+                  'log_tokens': []}
+    tables['map'].append(map_record)
+
+    timestamp = 1532402927000000
+    num_logs = int(np.ceil(num_scenes / scenes_per_log))
+    scene_index = 0
+    for log_index in range(num_logs):
+        log_token = _token(rng)
+        map_record['log_tokens'].append(log_token)
+        tables['log'].append({'token': log_token, 'logfile': 'synthetic-log-%04d' % log_index,
+                              'vehicle': 'synthetic', 'date_captured': '2018-07-24',
+                              'location': 'synthetic-city'})
+
+        calibrated = {}
+        for channel, translation in [('CAM_FRONT', CAM_FRONT_TRANSLATION),
+                                     ('RADAR_FRONT', RADAR_FRONT_TRANSLATION)]:
+            calibrated[channel] = _token(rng)
+            tables['calibrated_sensor'].append({'token': calibrated[channel],
+                                                'sensor_token': sensor_tokens[channel],
+                                                'translation': translation,
+                                                'rotation': [1.0, 0.0, 0.0, 0.0],
+                                                'camera_intrinsic': []})
+
+        # each log follows one continuous ego drive
+        position = rng.uniform(-1000, 1000, size=2)
+        yaw = rng.uniform(-np.pi, np.pi)
+
+        for _ in range(min(scenes_per_log, num_scenes - scene_index)):
+            timestamp += 20 * SAMPLE_PERIOD_US
+            timestamp, position, yaw = _generate_scene(rng, tables, log_token, calibrated, category_tokens,
+                                                       attribute_tokens, visibility_token, scene_index,
+                                                       samples_per_scene, vehicles_per_sample,
+                                                       timestamp, position, yaw)
+            scene_index += 1
+
+    table_root = os.path.join(dataroot, version)
+    os.makedirs(table_root, exist_ok=True)
+    for name, records in tables.items():
+        with open(os.path.join(table_root, name + '.json'), 'w') as f:
+            json.dump(records, f)
+
+    return table_root
+
+
+def _generate_scene(rng, tables, log_token, calibrated, category_tokens, attribute_tokens, visibility_token,
+                    scene_index, num_samples, vehicles_per_sample, timestamp, position, yaw):
+    """
+    Generates one scene, appending its records to the tables
+
+    Returns: timestamp, position and yaw of the ego at the end of the scene
+
+    """
+
+    scene_token = _token(rng)
+    sample_tokens = [_token(rng) for _ in range(num_samples)]
+
+    # ego kinematics: mostly driving, sometimes stationary (e.g. waiting at lights)
+    ego_speed = 0.0 if rng.random() < 0.15 else rng.uniform(3, 14)
+    yaw_rate = rng.uniform(-0.04, 0.04)
+
+    # ego path sampled at camera and radar timestamps
+    ego_states = []
+    for i in range(num_samples):
+        t = timestamp + i * SAMPLE_PERIOD_US
+        ego_states.append((t, position.copy(), yaw))
+        dt = SAMPLE_PERIOD_US * 1e-6
+        position = position + ego_speed * dt * np.array([np.cos(yaw), np.sin(yaw)])
+        yaw = yaw + yaw_rate * dt
+
+    # other agents are defined in a road frame that moves with the ego's start pose
+    agents = []
+    for _ in range(int(vehicles_per_sample * 1.3)):
+        category = (VEHICLE_CATEGORIES[rng.integers(len(VEHICLE_CATEGORIES))] if rng.random() < 0.85
+                    else OTHER_CATEGORIES[rng.integers(len(OTHER_CATEGORIES))])
+        lane = rng.choice([-10.5, -7.0, -3.5, 0.0, 3.5, 7.0, 10.5])
+        opposite = lane > 1 and rng.random() < 0.7
+        parked = rng.random() < 0.2
+        if parked or 'vehicle' not in category:
+            speed = 0.0
+        else:
+            speed = max(0.0, ego_speed + rng.normal(0, 3)) if not opposite else rng.uniform(3, 14)
+        start = int(rng.integers(0, num_samples // 2)) if rng.random() < 0.3 else 0
+        length = int(rng.integers(1, num_samples - start + 1)) if rng.random() < 0.3 else num_samples - start
+        agents.append({
+            'category': category,
+            'lateral': lane + rng.normal(0, 0.2),
+            'longitudinal': rng.uniform(-30, 60),
+            'speed': -speed if opposite else speed,
+            'parked': parked,
+            'samples': range(start, start + length),
+            'instance_token': _token(rng),
+            'ann_tokens': [_token(rng) for _ in range(length)],
+        })
+
+    # samples and their keyframe sample_data
+    prev_sd = {'CAM_FRONT': '', 'RADAR_FRONT': ''}
+    sd_records = {'CAM_FRONT': [], 'RADAR_FRONT': []}
+    for i, (t, pos, heading) in enumerate(ego_states):
+        tables['sample'].append({'token': sample_tokens[i], 'timestamp': t,
+                                 'prev': sample_tokens[i - 1] if i > 0 else '',
+                                 'next': sample_tokens[i + 1] if i < num_samples - 1 else '',
+                                 'scene_token': scene_token})
+        for channel in ['CAM_FRONT', 'RADAR_FRONT']:
+            sd_time = t + (RADAR_OFFSET_US if channel == 'RADAR_FRONT' else 0)
+            sd_heading = heading + yaw_rate * (sd_time - t) * 1e-6
+            sd_pos = pos + ego_speed * (sd_time - t) * 1e-6 * np.array([np.cos(heading), np.sin(heading)])
+            ego_pose_token = _token(rng)
+            tables['ego_pose'].append({'token': ego_pose_token, 'timestamp': sd_time,
+                                       'rotation': _yaw_to_quaternion(sd_heading),
+                                       'translation': [float(sd_pos[0]), float(sd_pos[1]), 0.0]})
+            record = {'token': _token(rng), 'sample_token': sample_tokens[i],
+                      'ego_pose_token': ego_pose_token, 'calibrated_sensor_token': calibrated[channel],
+                      'timestamp': sd_time, 'fileformat': 'jpg' if channel == 'CAM_FRONT' else 'pcd',
+                      'is_key_frame': True, 'height': 0, 'width': 0,
+                      'filename': 'samples/%s/synthetic_%d.%s' % (channel, sd_time,
+                                                                  'jpg' if channel == 'CAM_FRONT' else 'pcd'),
+                      'prev': prev_sd[channel], 'next': ''}
+            if sd_records[channel]:
+                sd_records[channel][-1]['next'] = record['token']
+            sd_records[channel].append(record)
+            prev_sd[channel] = record['token']
+    for channel in sd_records:
+        tables['sample_data'] += sd_records[channel]
+
+    # annotations for each agent track
+    for agent in agents:
+        tokens = agent['ann_tokens']
+        _, origin, origin_yaw = ego_states[0]
+        forward = np.array([np.cos(origin_yaw), np.sin(origin_yaw)])
+        left = np.array([-np.sin(origin_yaw), np.cos(origin_yaw)])
+        if agent['parked']:
+            attributes = [attribute_tokens['vehicle.parked']]
+        elif agent['category'] == 'vehicle.motorcycle':
+            attributes = [attribute_tokens['cycle.with_rider']]
+        elif 'vehicle' in agent['category']:
+            attributes = [attribute_tokens['vehicle.moving'] if agent['speed'] else attribute_tokens['vehicle.stopped']]
+        elif 'pedestrian' in agent['category']:
+            attributes = [attribute_tokens['pedestrian.moving']]
+        else:
+            attributes = []
+        agent_yaw = origin_yaw + (np.pi if agent['speed'] < 0 else 0.0) + rng.normal(0, 0.03)
+        for j, sample_index in enumerate(agent['samples']):
+            t = ego_states[sample_index][0]
+            elapsed = (t - ego_states[0][0]) * 1e-6
+            along = agent['longitudinal'] + agent['speed'] * elapsed
+            centre = origin + along * forward - agent['lateral'] * left + rng.normal(0, 0.05, size=2)
+            tables['sample_annotation'].append({
+                'token': tokens[j],
+                'sample_token': sample_tokens[sample_index],
+                'instance_token': agent['instance_token'],
+                'visibility_token': visibility_token,
+                'attribute_tokens': attributes,
+                'translation': [float(centre[0]), float(centre[1]), 1.0],
+                'size': SIZES[agent['category']],
+                'rotation': _yaw_to_quaternion(agent_yaw),
+                'prev': tokens[j - 1] if j > 0 else '',
+                'next': tokens[j + 1] if j < len(tokens) - 1 else '',
+                'num_lidar_pts': 10,
+                'num_radar_pts': 1,
+            })
+        tables['instance'].append({'token': agent['instance_token'],
+                                   'category_token': category_tokens[agent['category']],
+                                   'nbr_annotations': len(tokens),
+                                   'first_annotation_token': tokens[0],
+                                   'last_annotation_token': tokens[-1]})
+
+    tables['scene'].append({'token': scene_token, 'log_token': log_token, 'nbr_samples': num_samples,
+                            'first_sample_token': sample_tokens[0], 'last_sample_token': sample_tokens[-1],
+                            'name': 'scene-%04d' % scene_index, 'description': 'Synthetic scene'})
+
+    return ego_states[-1][0] + SAMPLE_PERIOD_US, position, yaw
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Writes a synthetic dataset in the nuScenes format, e.g. for '
+                                                 'benchmarks and tests where the real dataset is not available.')
+    parser.add_argument('dataroot', help='directory to write the dataset to')
+    parser.add_argument('--version', default='v1.0-synthetic', help='dataset version (default v1.0-synthetic)')
+    parser.add_argument('--scenes', type=int, default=4, help='number of scenes (default 4)')
+    parser.add_argument('--samples', type=int, default=40, help='samples per scene (default 40)')
+    parser.add_argument('--vehicles', type=int, default=20, help='approximate vehicles per sample (default 20)')
+    parser.add_argument('--scenes-per-log', type=int, default=2, help='scenes in each log (default 2)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    args = parser.parse_args(argv)
+
+    generate_synthetic_dataset(args.dataroot, args.version, args.scenes, args.samples, args.vehicles,
+                               args.scenes_per_log, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+import numpy as np
+
+from dataset_stats import DatasetStats, claim_stats_job, load_dataset_stats, read_stats_progress, \
+    release_stats_job, save_dataset_figures, write_stats_progress
+from score_table import ScoreTable
+from test_score_cache import make_score
+
+
+class TestDatasetStats(TestCase):
+    scores = [make_score('a', None, 1.0, None, None),
+              make_score('b', 'Longitudinally too close', 0.4, True, 10.0),
+              make_score('c', 'Laterally too close', 0.0, False, 25.0),
+              make_score('d', 'Longitudinally too close', 0.45, False, 10.0)]
+
+    def setUp(self):
+        self.table = ScoreTable.from_scores(self.scores)
+        self.stats = DatasetStats()
+        self.stats.add(self.table)
+
+    def test_counts(self):
+        values = self.stats.to_dict()
+        self.assertEqual(4, values['count'])
+        self.assertEqual(3, values['flagged'])
+        self.assertEqual([1, 0, 0, 0, 2, 0, 0, 0, 0, 1], values['score_histogram'])
+        self.assertEqual([1, 0, 0, 0, 2, 0, 0, 0, 0, 0], values['flagged_histogram'])
+        self.assertEqual(2, values['reasons']['Longitudinally too close'])
+        self.assertEqual(1, values['longitudinal_same_direction'])
+        self.assertEqual(1, values['longitudinal_opposite_direction'])
+        # every flagged score is 12.5m ahead and 1.5m to the right
+        self.assertEqual(3, np.sum(values['heatmap']))
+
+    def test_incremental(self):
+        stats = DatasetStats()
+        stats.add(self.table[:2])
+        stats.add(self.table[2:])
+        self.assertEqual(self.stats.digest(), stats.digest())
+        self.assertEqual(2, stats.scenes)
+
+    def test_round_trip(self):
+        self.assertEqual(self.stats.to_dict(), DatasetStats.from_dict(self.stats.to_dict()).to_dict())
+
+    def test_figures_saved_once(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            self.assertIsNone(load_dataset_stats(out_dir))
+            self.assertTrue(save_dataset_figures(self.stats, out_dir))
+            self.assertTrue(os.path.exists(os.path.join(out_dir, 'dataset_heatmap.svg')))
+            self.assertEqual(self.stats.digest(), load_dataset_stats(out_dir).digest())
+            self.assertFalse(save_dataset_figures(self.stats, out_dir))
+
+            self.stats.add(self.table)
+            self.assertTrue(save_dataset_figures(self.stats, out_dir))
+
+
+class TestStatsJobClaim(TestCase):
+    def test_claim(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            self.assertTrue(claim_stats_job(out_dir))
+            self.assertTrue(claim_stats_job(out_dir))
+            write_stats_progress(out_dir, {'state': 'running', 'done': 1, 'total': 2})
+            self.assertEqual(1, read_stats_progress(out_dir)['done'])
+
+            # claims of other running processes are respected
+            with open(os.path.join(out_dir, 'job.pid'), 'w') as f:
+                f.write(str(os.getppid()))
+            self.assertFalse(claim_stats_job(out_dir))
+
+            release_stats_job(out_dir)
+            self.assertIsNone(read_stats_progress(out_dir))
+            self.assertTrue(claim_stats_job(out_dir))
+
+    @skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_stale_claim(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            os.waitpid(pid, 0)
+            with open(os.path.join(out_dir, 'job.pid'), 'w') as f:
+                f.write(str(pid))
+            self.assertTrue(claim_stats_job(out_dir))
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from ego_trajectory import EgoTrajectory, get_yaws
+
+
+class TestEgoTrajectory(TestCase):
+
+    def setUp(self):
+        # driving along the x-axis at 10m/s, turning through +-pi, with a 5 second gap after 1 second
+        self.timestamps = np.array([0, 500000, 1000000, 6000000, 6500000])
+        self.translations = np.array([[0, 0, 0], [5, 0, 0], [10, 0, 0], [60, 0, 0], [65, 0, 0]], dtype=float)
+        self.yaws = np.array([3.0, 3.1, -3.1, 0, 0])
+        self.trajectory = EgoTrajectory(self.timestamps[::-1], self.translations[::-1], self.yaws[::-1])
+
+    def test_poses(self):
+        np.testing.assert_array_equal(self.translations, self.trajectory.position(self.timestamps))
+        np.testing.assert_array_equal(self.translations[1], self.trajectory.position(500000))
+
+    def test_interpolation(self):
+        np.testing.assert_allclose([2.5, 0, 0], self.trajectory.position(250000))
+        np.testing.assert_allclose([0, 0, 0], self.trajectory.position(-100))
+        np.testing.assert_allclose([65, 0, 0], self.trajectory.position(7000000))
+
+    def test_yaw_wraps(self):
+        yaw = self.trajectory.yaw(750000)
+        self.assertAlmostEqual(np.pi, yaw % (2 * np.pi))
+        self.assertAlmostEqual((np.pi - np.pi / 2) % (2 * np.pi), self.trajectory.heading(750000))
+
+    def test_velocity(self):
+        velocities = self.trajectory.velocity([250000, 0, 1000000, 6000000])
+        np.testing.assert_allclose([[10, 0, 0]] * 4, velocities)
+
+    def test_stopped_velocity_is_zero(self):
+        # positions which differ only by rounding, as when interpolating while stopped
+        trajectory = EgoTrajectory([0, 100000, 200000], [[500.3, 20.1, 0], [500.3 + 1e-12, 20.1, 0],
+                                                         [500.3, 20.1 - 1e-12, 0]], [0, 0, 0])
+        np.testing.assert_array_equal([[0, 0, 0]] * 3, trajectory.velocity([0, 50000, 200000]))
+
+    def test_batched_matches_single(self):
+        timestamps = np.linspace(-1e5, 7e6, 50).astype(np.int64)
+        batched = self.trajectory.velocity(timestamps)
+        for t, velocity in zip(timestamps, batched):
+            np.testing.assert_array_equal(self.trajectory.velocity(t), velocity)
+
+    def test_single_pose(self):
+        trajectory = EgoTrajectory([100], [[1, 2, 3]], [0.5])
+        np.testing.assert_array_equal([1, 2, 3], trajectory.position(0))
+        self.assertTrue(np.isnan(trajectory.velocity(100)).all())
+
+
+class TestGetYaws(TestCase):
+    def test_matches_scipy(self):
+        rotations = np.random.default_rng(0).normal(size=(20, 4))
+        rotations /= np.linalg.norm(rotations, axis=1, keepdims=True)
+        expected = Rotation.from_quat(rotations[:, [1, 2, 3, 0]]).as_euler('xyz')[:, 2]
+        np.testing.assert_allclose(expected, get_yaws(rotations))
+        np.testing.assert_allclose(expected, get_yaws(rotations * 3))
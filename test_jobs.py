@@ -0,0 +1,26 @@
+import threading
+import time
+from unittest import TestCase
+
+from jobs import start_job
+
+
+class TestJobs(TestCase):
+    def test_queued_jobs_run_one_at_a_time(self):
+        queue = threading.Lock()
+        release = threading.Event()
+        first = start_job(('test_queue', 1), lambda job: release.wait(5), queue=queue)
+        for _ in range(100):
+            if first.state == 'running':
+                break
+            time.sleep(0.01)
+        self.assertEqual('running', first.state)
+
+        second = start_job(('test_queue', 2), lambda job: 'second', queue=queue)
+        self.assertEqual('queued', second.status()['state'])
+        self.assertIs(second, start_job(('test_queue', 2), lambda job: None, queue=queue))
+
+        release.set()
+        second.thread.join(5)
+        self.assertEqual('done', first.state)
+        self.assertEqual('second', second.result)
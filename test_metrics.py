@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+import metrics
+from metrics import enable_metrics, get_metrics, merge_metrics_state, record, reset_metrics, take_metrics_state, \
+    timed
+
+
+@timed('double')
+def double(x):
+    return 2 * x
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.was_enabled = metrics.metrics_enabled()
+        reset_metrics()
+
+    def tearDown(self):
+        enable_metrics(self.was_enabled)
+        reset_metrics()
+
+    def test_disabled(self):
+        enable_metrics(False)
+        self.assertEqual(4, double(2))
+        self.assertEqual({}, get_metrics()['stages'])
+
+    def test_enabled(self):
+        enable_metrics(True)
+        for i in range(10):
+            self.assertEqual(2 * i, double(i))
+        stage = get_metrics()['stages']['double']
+        self.assertEqual(10, stage['count'])
+        self.assertLessEqual(stage['p50_ms'], stage['max_ms'])
+
+    def test_percentiles(self):
+        for i in range(1, 101):
+            record('stage', i / 1000)
+        stage = get_metrics()['stages']['stage']
+        self.assertAlmostEqual(50.5, stage['p50_ms'])
+        self.assertAlmostEqual(50.5, stage['mean_ms'])
+        self.assertAlmostEqual(100, stage['max_ms'])
+
+    def test_merge(self):
+        record('stage', 0.001)
+        metrics.count_lookup('sample')
+        state = take_metrics_state()
+        self.assertEqual({}, get_metrics()['stages'])
+
+        record('stage', 0.003)
+        merge_metrics_state(state)
+        merge_metrics_state(({}, {'sample': 2}))
+        summary = get_metrics()
+        self.assertEqual(2, summary['stages']['stage']['count'])
+        self.assertAlmostEqual(0.004, summary['stages']['stage']['total_seconds'])
+        self.assertEqual({'sample': 3}, summary['lookups'])
+
+    def test_sample_limit(self):
+        for i in range(metrics.MAX_SAMPLES * 2):
+            record('stage', 0.001)
+        stage = take_metrics_state()[0]['stage']
+        self.assertEqual(metrics.MAX_SAMPLES * 2, stage.count)
+        self.assertEqual(metrics.MAX_SAMPLES, len(stage.samples))
@@ -2,7 +2,10 @@ import math
 from unittest import TestCase
 import numpy as np
 
-from my_nuscenes_functions import find_translation, rotation, find_dist_between_ranges
+from nuscenes.nuscenes import NuScenes
+
+from my_nuscenes_functions import find_translation, rotation, find_dist_between_ranges, find_translations, \
+    find_dists_between_ranges, get_track_velocities, find_aligned_distances, rotate_points
 
 
 class TestFindTranslation(TestCase):
@@ -50,6 +53,54 @@ class TestFindTranslation(TestCase):
         self.helper_test_with_rotation(ego_bb, ann_bb, expected)
 
 
+class TestFindTranslations(TestCase):
+    """
+    Checks the vectorised version with the boxes of the cases in TestFindTranslation.
+    """
+
+    cases = [
+        ([[1, 1], [0, 1], [0, 0], [1, 0]], [[3, 1], [2, 1], [2, 0], [3, 0]]),
+        ([[3, 3], [2, 3], [2, 1], [3, 1]], [[4, 3], [6, 4], [5, 6], [3, 5]]),
+        ([[6, 3], [6, 4], [4, 4], [4, 3]], [[2, 4], [1, 4], [1, 2], [2, 2]]),
+        ([[5, 6], [4, 6], [4, 4], [5, 4]], [[2, 1], [1, 2], [0, 1], [1, 0]]),
+    ]
+
+    def test_shared_ego(self):
+        # every annotation against the unit square. The boxes are square to the axes, so turning the ego
+        # through a right angle gives the same translations
+        ego_bb = np.array(self.cases[0][0])
+        ann_bbs = np.array([ann_bb for _, ann_bb in self.cases])
+        expected = [[1, 0], [2, 2], [0, 1], [0, 0]]
+
+        for heading in [0, np.pi / 2]:
+            actual = find_translations(ego_bb, ann_bbs, heading)
+
+            self.assertEqual((4, 2), actual.shape)
+            np.testing.assert_allclose(expected, actual, atol=0.00001)
+
+    def test_ego_per_annotation(self):
+        ego_bbs = np.array([ego_bb for ego_bb, _ in self.cases])
+        ann_bbs = np.array([ann_bb for _, ann_bb in self.cases])
+        headings = np.array([0, 0, np.pi / 2, 0])
+
+        actual = find_translations(ego_bbs, ann_bbs, headings)
+        expected = [[1, 0], [0, 0], [-2, 0], [-2, -2]]
+
+        np.testing.assert_allclose(expected, actual, atol=0.00001)
+
+    def test_aligned_overlap_is_zero(self):
+        # alongside each other at an angle, so rotating the distances back and forth would leave rounding errors
+        ego_bbs = np.array([ego_bb for ego_bb, _ in self.cases])
+        ann_bbs = np.array([ann_bb for _, ann_bb in self.cases])
+        headings = np.array([0.3, 0.3, np.pi / 2 + 0.3, 0.3])
+
+        actual = find_aligned_distances(ego_bbs, ann_bbs, headings)
+
+        np.testing.assert_allclose(rotate_points(-headings, find_translations(ego_bbs, ann_bbs, headings)), actual,
+                                   atol=0.00001)
+        self.assertTrue((actual == 0).any())
+
+
 class TestFindDistBetweenRanges(TestCase):
     def test_behind(self):
         range_1 = [0, 5]
@@ -106,6 +157,17 @@ class TestFindDistBetweenRanges(TestCase):
         self.assertAlmostEqual(actual, expected)
 
 
+class TestFindDistsBetweenRanges(TestCase):
+    def test_matches_scalar(self):
+        ranges_1 = [[0, 5], [0, 5], [5, 0], [0, 5], [10, 15], [18, 21]]
+        ranges_2 = [[10, 15], [1, 4], [0, 5], [5, 15], [5, 10], [10, 15]]
+
+        actual = find_dists_between_ranges(ranges_1, ranges_2)
+        expected = [5, 0, 0, 0, 0, -3]
+
+        np.testing.assert_allclose(expected, actual)
+
+
 class TestRotation(TestCase):
     def test_90_degree_1(self):
         angle = np.pi / 2
@@ -148,3 +210,60 @@ class TestRotation(TestCase):
         expected = np.array([1 / math.sqrt(2), 1 / math.sqrt(2)])
         actual = rotation(angle, vector)
         np.testing.assert_allclose(expected, actual, atol=0.00001)
+
+
+class TrackDataset:
+    """
+    Just enough of a NuScenes object for velocities: one instance per track, one sample per timestamp
+    """
+
+    def __init__(self, tracks):
+        self.sample_annotation = []
+        self.sample = {}
+        for i, track in enumerate(tracks):
+            tokens = ['%d-%d' % (i, j) for j in range(len(track))]
+            for j, (timestamp, translation) in enumerate(track):
+                self.sample[tokens[j]] = {'token': tokens[j], 'timestamp': timestamp}
+                self.sample_annotation.append({'token': tokens[j], 'sample_token': tokens[j],
+                                               'translation': translation,
+                                               'prev': tokens[j - 1] if j > 0 else '',
+                                               'next': tokens[j + 1] if j < len(track) - 1 else ''})
+        self.index = {annotation['token']: i for i, annotation in enumerate(self.sample_annotation)}
+
+    def get(self, table, token):
+        if table == 'sample':
+            return self.sample[token]
+        return self.sample_annotation[self.index[token]]
+
+    def box_velocity(self, token, max_time_diff=1.5):
+        return NuScenes.box_velocity(self, token, max_time_diff)
+
+
+class TestGetTrackVelocities(TestCase):
+
+    def helper_test_matches_devkit(self, nusc, track):
+        expected = np.array([nusc.box_velocity(nusc.sample_annotation[i]['token']) for i in track])
+        actual = get_track_velocities(nusc, track)
+        np.testing.assert_array_equal(expected, actual)
+
+    def test_centred_and_one_sided(self):
+        nusc = TrackDataset([[(0, [0, 0, 0]), (500000, [1, 2, 0]), (1000000, [3, 3, 1]), (1500000, [4, 5, 1])]])
+        self.helper_test_matches_devkit(nusc, [0, 1, 2, 3])
+        np.testing.assert_allclose(get_track_velocities(nusc, [0, 1, 2, 3])[1], [3, 3, 1])
+
+    def test_time_cutoff(self):
+        nusc = TrackDataset([[(0, [0, 0, 0]), (1000000, [1, 0, 0]), (3500000, [2, 0, 0]), (7000000, [3, 0, 0])]])
+        velocities = get_track_velocities(nusc, [0, 1, 2, 3])
+        self.assertFalse(np.isnan(velocities[0]).any())
+        self.assertTrue(np.isnan(velocities[1:]).all())
+        self.helper_test_matches_devkit(nusc, [0, 1, 2, 3])
+
+    def test_single_annotation(self):
+        nusc = TrackDataset([[(0, [0, 0, 0])]])
+        self.assertTrue(np.isnan(get_track_velocities(nusc, [0])).all())
+
+    def test_partial_track(self):
+        nusc = TrackDataset([[(0, [0, 0, 0]), (500000, [1, 2, 0]), (1000000, [3, 3, 1])],
+                             [(0, [5, 5, 5]), (500000, [6, 5, 5])]])
+        self.helper_test_matches_devkit(nusc, [1, 2])
+        self.helper_test_matches_devkit(nusc, [3, 4])
@@ -0,0 +1,76 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from score_cache import scores_to_columns, columns_to_scores, save_cached_scores, load_cached_scores, \
+    get_cache_key, get_cache_path, get_code_version
+from constants import *
+
+
+def make_score(annotation, reason, score, same_direction, min_long_distance):
+    return {
+        'annotation': annotation,
+        'reason': reason,
+        'score': score,
+        'ego_long_velocity': 5.0,
+        'ego_lat_velocity': 0.1,
+        'ann_long_velocity': 3.0,
+        'ann_lat_velocity': -0.2,
+        'long_distance': 12.5,
+        'lat_distance': -1.5,
+        'min_long_distance': min_long_distance,
+        'min_lat_distance': 0.07,
+        'same_direction': same_direction,
+        'instance': 'instance-' + annotation,
+    }
+
+
+class TestColumns(TestCase):
+    scores = [make_score('a', None, 1.0, None, None),
+              make_score('b', 'Longitudinally too close', 0.4, True, 10.0),
+              make_score('c', 'Laterally too close', 0.0, False, 25.0)]
+
+    def test_round_trip(self):
+        self.assertEqual(self.scores, columns_to_scores(scores_to_columns(self.scores)))
+
+    def test_empty(self):
+        self.assertEqual([], columns_to_scores(scores_to_columns([])))
+
+    def test_reason_codes(self):
+        columns = scores_to_columns(self.scores)
+        self.assertEqual([None, 'Longitudinally too close', 'Laterally too close'],
+                         [score_reasons[code] for code in columns['reason']])
+
+
+class TestCacheFiles(TestCase):
+    scores = [make_score('a', 'Too close', 0.0, True, 3.0)]
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            key = get_cache_key('v1.0-mini', 'scene', rss_aggressive)
+            path = get_cache_path(cache_root, 'v1.0-mini', 'scene', rss_aggressive)
+            save_cached_scores(path, key, self.scores)
+
+            self.assertEqual(self.scores, load_cached_scores(path, key))
+
+    def test_missing(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            self.assertIsNone(load_cached_scores(os.path.join(cache_root, 'missing.npz'), 'key'))
+
+    def test_key_mismatch(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, 'scene.npz')
+            save_cached_scores(path, get_cache_key('v1.0-mini', 'scene', rss_aggressive), self.scores)
+
+            self.assertIsNone(load_cached_scores(path, get_cache_key('v1.0-mini', 'scene', rss_conservative)))
+
+    def test_parameter_sets_stored_separately(self):
+        self.assertNotEqual(get_cache_path('cache', 'v1.0-mini', 'scene', rss_aggressive),
+                            get_cache_path('cache', 'v1.0-mini', 'scene', rss_conservative))
+
+    def test_code_version_covers_storage(self):
+        # changing how scores are stored must also invalidate the cache
+        with mock.patch('builtins.open', wraps=open) as opened:
+            get_code_version()
+        hashed = {os.path.basename(call.args[0]) for call in opened.call_args_list}
+        self.assertLessEqual({'scoring.py', 'score_cache.py', 'score_table.py'}, hashed)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+import numpy as np
+
+from score_table import ScoreTable
+from test_score_cache import make_score
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestScoreTable(TestCase):
+    scores = [make_score('a', None, 1.0, None, None),
+              make_score('b', 'Longitudinally too close', 0.4, True, 10.0),
+              make_score('c', 'Laterally too close', 0.0, False, 25.0)]
+
+    def setUp(self):
+        self.table = ScoreTable.from_scores(self.scores)
+
+    def test_round_trip(self):
+        self.assertEqual(self.scores, self.table.to_scores())
+
+    def test_empty(self):
+        table = ScoreTable.from_scores([])
+        self.assertEqual(0, len(table))
+        self.assertEqual([], table.to_scores())
+        self.assertEqual([], ScoreTable.concatenate([]).to_scores())
+
+    def test_rows(self):
+        self.assertEqual(self.scores, list(self.table))
+        self.assertEqual(self.scores[2], self.table[-1])
+        self.assertEqual('instance-b', self.table[1]['instance'])
+        self.assertIsNone(self.table[0]['min_long_distance'])
+        with self.assertRaises(KeyError):
+            self.table[0]['missing']
+        with self.assertRaises(IndexError):
+            self.table[3]
+
+    def test_filter(self):
+        flagged = self.table[self.table['score'] < 1]
+        self.assertEqual(self.scores[1:], flagged.to_scores())
+        self.assertEqual(['b', 'c'], list(flagged.get_tokens('annotation')))
+
+    def test_filter_by_score_and_reason(self):
+        self.assertEqual(self.scores[1:], self.table.filter(score_below=1).to_scores())
+        self.assertEqual(self.scores[2:], self.table.filter(reasons=['Laterally too close', 'Too close']).to_scores())
+        self.assertEqual([], self.table.filter(score_below=0.3, reasons=['Longitudinally too close']).to_scores())
+
+    def test_concatenate(self):
+        table = ScoreTable.concatenate([self.table[:1], self.table[1:]])
+        self.assertEqual(self.scores, table.to_scores())
+
+    def test_extra_token_fields(self):
+        keys = list(self.scores[0]) + ['other_annotation']
+        scores = [dict(score, other_annotation='a') for score in self.scores]
+        table = ScoreTable.from_scores(scores, keys)
+        self.assertEqual(scores, table.to_scores())
+        self.assertEqual(keys, list(table[0]))
+
+    def test_npz(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'scores.npz')
+            self.table.to_npz(path, scene=np.zeros(3))
+            self.assertEqual(self.scores, ScoreTable.load_npz(path).to_scores())
+
+    @skipUnless(pyarrow, 'requires pyarrow')
+    def test_arrow(self):
+        self.assertEqual(self.scores, self.table.to_arrow().to_pylist())
@@ -2,7 +2,9 @@ from unittest import TestCase
 import numpy as np
 
 from scoring import find_min_long_distance, find_min_long_distance_opposite_direction, \
-    find_min_lat_distance, generate_individual_score, is_right_of
+    find_min_lat_distance, generate_individual_score, is_right_of, find_min_long_distances, \
+    find_min_long_distances_opposite_direction, find_min_lat_distances, generate_individual_scores, stack_params, \
+    score_annotation_features, score_feature_columns, resolve_reason_codes, find_instance_minimums, get_track_starts
 from constants import *
 
 
@@ -183,6 +185,47 @@ class TestGenerateIndividualScore(TestCase):
         self.assertAlmostEqual(expected, result)
 
 
+class TestVectorisedScoring(TestCase):
+    """
+    Checks the vectorised functions agree with the hand calculated results used for the scalar functions.
+    """
+
+    def test_min_long_distances(self):
+        actual = find_min_long_distances([5, 0], [3, 5], rss_aggressive)
+        np.testing.assert_allclose([8.2098, 0], actual, atol=0.001)
+
+    def test_min_long_distances_negative_velocity(self):
+        with self.assertRaises(AssertionError):
+            find_min_long_distances([3, -1], [5, 5], rss_conservative)
+
+    def test_min_long_distances_opposite_direction(self):
+        actual = find_min_long_distances_opposite_direction([3, 2], [-2, -3], rss_conservative)
+        np.testing.assert_allclose([110.1434, find_min_long_distance_opposite_direction(2, -3, rss_conservative)],
+                                   actual, atol=0.001)
+
+    def test_min_lat_distances(self):
+        actual = find_min_lat_distances([2.5, -0.1, 0.01], [-1, -0.1, 0.01], rss_conservative)
+        np.testing.assert_allclose([17.2078, rss_conservative['mu'], rss_conservative['mu']], actual, atol=0.001)
+
+    def test_individual_scores(self):
+        actual = generate_individual_scores([5, 1, 50, 10], [5, 6, 5, 12])
+        np.testing.assert_allclose([0, 1, 0, 0.4], actual)
+
+    def test_individual_scores_not_finite(self):
+        # matches the scalar version, where a NaN margin gave min(1, nan) == 1
+        actual = generate_individual_scores([np.inf, np.nan, 5, np.inf, 5], [np.inf, 5, np.nan, 5, np.inf])
+        np.testing.assert_array_equal([1, 1, 1, 0, 1], actual)
+        self.assertEqual(1, generate_individual_score(np.inf, np.inf))
+
+    def test_stacked_params(self):
+        params = stack_params([rss_conservative, rss_aggressive])
+        actual = find_min_long_distances([3, 5], [5, 3], params)
+
+        self.assertEqual((2, 2), actual.shape)
+        self.assertAlmostEqual(40.9583, actual[0, 0], places=3)
+        self.assertAlmostEqual(8.2098, actual[1, 1], places=3)
+
+
 class TestIsRightOf(TestCase):
     def test_0_degree_true(self):
         theta = 0
@@ -240,3 +283,61 @@ class TestIsRightOf(TestCase):
         p2 = [0, 1]
 
         self.assertFalse(is_right_of(theta, p1, p2))
+
+
+class TestScoreFeatureColumns(TestCase):
+    features = [
+        {'annotation': 'a', 'ego_long_velocity': 10.0, 'ego_lat_velocity': 0.1, 'ann_long_velocity': 8.0,
+         'ann_lat_velocity': -0.2, 'long_distance': 12.0, 'lat_distance': 0.5, 'ego_is_behind': True,
+         'ego_is_right': False},
+        {'annotation': 'b', 'ego_long_velocity': 10.0, 'ego_lat_velocity': 0.0, 'ann_long_velocity': -9.0,
+         'ann_lat_velocity': 0.0, 'long_distance': 30.0, 'lat_distance': -4.0, 'ego_is_behind': True,
+         'ego_is_right': True},
+        {'annotation': 'c', 'ego_long_velocity': 5.0, 'ego_lat_velocity': 0.5, 'ann_long_velocity': 5.0,
+         'ann_lat_velocity': -0.5, 'long_distance': -3.0, 'lat_distance': 0.2, 'ego_is_behind': False,
+         'ego_is_right': False},
+    ]
+
+    def columns(self):
+        columns = {key: np.array([f[key] for f in self.features]) for key in self.features[0]}
+        columns['instance'] = np.array(['i', 'i', 'j'])
+        return columns
+
+    def test_matches_scalar(self):
+        for params in [rss_aggressive, rss_conservative]:
+            columns = score_feature_columns(self.columns(), params)
+            previous = []
+            for i, features in enumerate(self.features):
+                if i == 2:
+                    previous = []
+                expected = score_annotation_features(features, params, previous)
+                previous = [expected]
+                self.assertEqual(expected['score'], columns['score'][i])
+                self.assertEqual(score_reasons.index(expected['reason']), columns['reason'][i])
+                self.assertEqual(expected['min_lat_distance'], columns['min_lat_distance'][i])
+
+    def test_stacked_params(self):
+        columns = score_feature_columns(self.columns(), stack_params([rss_aggressive, rss_conservative]))
+        self.assertEqual((2, 3), columns['score'].shape)
+        np.testing.assert_array_equal(score_feature_columns(self.columns(), rss_conservative)['score'],
+                                      columns['score'][1])
+
+
+class TestResolveReasonCodes(TestCase):
+    too_close = score_reasons.index('Too close')
+    lat = score_reasons.index('Laterally too close')
+
+    def test_carried_within_instance(self):
+        reason = np.array([self.lat, self.too_close, self.too_close, self.too_close])
+        starts = get_track_starts(np.array(['i', 'i', 'i', 'j']))
+        np.testing.assert_array_equal([self.lat, self.lat, self.lat, self.too_close],
+                                      resolve_reason_codes(reason, starts))
+
+    def test_not_carried_after_perfect_score(self):
+        reason = np.array([self.lat, 0, self.too_close])
+        np.testing.assert_array_equal(reason, resolve_reason_codes(reason, np.array([0])))
+
+    def test_instance_minimums(self):
+        score = np.array([[1.0, 0.5, 0.5, 0.2], [0.1, 0.5, 1.0, 1.0]])
+        starts = np.array([0, 3])
+        np.testing.assert_array_equal([[1, 3], [0, 3]], find_instance_minimums(score, starts))
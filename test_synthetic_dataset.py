@@ -0,0 +1,173 @@
+import gc
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, skipUnless
+
+import numpy as np
+from nuscenes.nuscenes import NuScenes
+
+from batch_score import find_scene_tokens
+from constants import rss_aggressive, rss_conservative
+from metadata_store import open_metadata_store
+from my_nuscenes_functions import build_ego_state_table, get_annotation_footprints
+from pairwise import PAIR_SCORE_KEYS, generate_pairwise_scores_for_scene
+from parallel_scoring import iter_score_tables_for_scenes
+from score_cache import cached_generate_annotation_score_columns_for_scene, cached_generate_scores_for_scene, \
+    columns_to_scores, scores_to_columns
+from scoring import generate_scores_for_scene, iter_scores_for_scene
+from sweep import generate_sweep, summarise_sweep
+from synthetic_dataset import generate_synthetic_dataset
+
+
+class TestSyntheticDataset(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dataroot = tempfile.mkdtemp()
+        generate_synthetic_dataset(cls.dataroot, num_scenes=3, samples_per_scene=10, vehicles_per_sample=5,
+                                   seed=3)
+        cls.nusc = NuScenes(version='v1.0-synthetic', dataroot=cls.dataroot, verbose=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dataroot)
+
+    def test_sizes(self):
+        self.assertEqual(3, len(self.nusc.scene))
+        self.assertEqual(2, len(self.nusc.log))
+        self.assertEqual(30, len(self.nusc.sample))
+        for scene in self.nusc.scene:
+            self.assertEqual(10, scene['nbr_samples'])
+
+    def test_ego_states(self):
+        # the ego is found from its trajectory at each sample's timestamp, pinned here so that any change to
+        # the ego kinematics, which scores are sensitive to, is noticed
+        sample_tokens = [sample['token'] for sample in self.nusc.sample]
+        ego_states = build_ego_state_table(self.nusc, [sample_tokens[i] for i in [0, 10, 20]])
+        np.testing.assert_allclose([[-403.6738186852, 483.5133601387], [-394.5350721128, 539.1382645738],
+                                    [965.8122678509, -992.176783288]], ego_states['translation'], rtol=1e-10)
+        np.testing.assert_allclose([1.3959026583, 1.4226938081, -2.3958501236], ego_states['yaw'], rtol=1e-9)
+        np.testing.assert_allclose([[1.9617942847, 11.1024662758, 0], [1.5456247722, 10.3597660894, 0],
+                                    [-9.7098029829, -8.9687063483, 0]], ego_states['velocity'], rtol=1e-9)
+
+    def test_tracks_are_linked(self):
+        for instance in self.nusc.instance:
+            count = 0
+            token = instance['first_annotation_token']
+            while token:
+                count += 1
+                last = token
+                token = self.nusc.get('sample_annotation', token)['next']
+            self.assertEqual(instance['nbr_annotations'], count)
+            self.assertEqual(instance['last_annotation_token'], last)
+
+    def test_annotation_footprints(self):
+        footprints = get_annotation_footprints(self.nusc, range(len(self.nusc.sample_annotation)))
+        for annotation, footprint in zip(self.nusc.sample_annotation, footprints):
+            np.testing.assert_allclose(self.nusc.get_box(annotation['token']).bottom_corners()[0:2].T, footprint,
+                                       atol=1e-9)
+
+    def test_scores(self):
+        scores = [score for scene in self.nusc.scene for score in generate_scores_for_scene(self.nusc, scene['token'])]
+        self.assertTrue(scores)
+        for score in scores:
+            self.assertTrue(0 <= score['score'] <= 1)
+
+    def test_pruning_keeps_scores(self):
+        for params in [rss_aggressive, rss_conservative]:
+            for scene in self.nusc.scene:
+                self.assertEqual(list(iter_scores_for_scene(self.nusc, scene['token'], params=params, prune=False)),
+                                 list(iter_scores_for_scene(self.nusc, scene['token'], params=params, prune=True)))
+
+    def test_pairwise_scores(self):
+        for params in [rss_aggressive, rss_conservative]:
+            for scene in self.nusc.scene:
+                scores = generate_pairwise_scores_for_scene(self.nusc, scene['token'], params=params)
+                self.assertEqual(generate_pairwise_scores_for_scene(self.nusc, scene['token'], params=params,
+                                                                   prune=False), scores)
+                for score in scores:
+                    self.assertEqual(PAIR_SCORE_KEYS, list(score))
+                    self.assertTrue(0 <= score['score'] < 1)
+                    self.assertNotEqual(score['instance'], score['other_instance'])
+
+    def test_metadata_store_scores(self):
+        store = open_metadata_store(self.dataroot, 'v1.0-synthetic', verbose=False)
+        for scene in self.nusc.scene:
+            self.assertEqual(generate_scores_for_scene(self.nusc, scene['token']),
+                             generate_scores_for_scene(store, scene['token']))
+
+    def test_find_scene_tokens(self):
+        first, second = self.nusc.scene[:2]
+        self.assertEqual([second['token'], first['token']],
+                         find_scene_tokens(self.nusc, [second['name'], first['token'], second['token']]))
+        self.assertEqual([scene['token'] for scene in self.nusc.scene], find_scene_tokens(self.nusc, []))
+
+    def test_sweep_matches_scoring(self):
+        sweep = generate_sweep(self.nusc, [rss_aggressive, rss_conservative], workers=1, progress=False)
+        for i, params in enumerate([rss_aggressive, rss_conservative]):
+            scores = [score for scene in self.nusc.scene
+                      for score in generate_scores_for_scene(self.nusc, scene['token'], params=params)]
+            indexes = sweep['instance_index'][:, i]
+            self.assertEqual([s['annotation'] for s in scores], list(sweep['annotation'][indexes]))
+            self.assertEqual([s['score'] for s in scores], list(sweep['score'][indexes, i]))
+            self.assertEqual(len([s for s in scores if s['score'] < 1]), summarise_sweep(sweep)[i]['flagged'])
+
+    def test_cached_annotation_scores(self):
+        cache_root = tempfile.mkdtemp()
+        try:
+            scene_token = self.nusc.scene[0]['token']
+            expected = list(iter_scores_for_scene(self.nusc, scene_token, params=rss_conservative,
+                                                  per_annotation=True))
+            columns = cached_generate_annotation_score_columns_for_scene(self.nusc, scene_token,
+                                                                         params=rss_conservative,
+                                                                         cache_root=cache_root)
+            self.assertEqual([s['annotation'] for s in expected], list(columns['annotation']))
+            self.assertEqual([s['reason'] for s in expected],
+                             [s['reason'] for s in columns_to_scores(columns)])
+            np.testing.assert_allclose([s['score'] for s in expected], columns['score'])
+        finally:
+            shutil.rmtree(cache_root)
+
+    def test_cached_scores_from_features(self):
+        cache_root = tempfile.mkdtemp()
+        try:
+            scene_token = self.nusc.scene[0]['token']
+            for params in [rss_aggressive, rss_conservative, dict(rss_aggressive, p=1.5)]:
+                expected = columns_to_scores(scores_to_columns(generate_scores_for_scene(self.nusc, scene_token,
+                                                                                         params=params)))
+                self.assertEqual(expected, cached_generate_scores_for_scene(self.nusc, scene_token, params=params,
+                                                                            cache_root=cache_root))
+        finally:
+            shutil.rmtree(cache_root)
+
+    @skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_workers_keep_caller_freeze(self):
+        gc.freeze()
+        try:
+            frozen = gc.get_freeze_count()
+            tables = dict(iter_score_tables_for_scenes(self.nusc, params=rss_aggressive, workers=2,
+                                                       use_cache=False, progress=False))
+            self.assertEqual(len(self.nusc.scene), len(tables))
+            self.assertGreaterEqual(gc.get_freeze_count(), frozen)
+        finally:
+            gc.unfreeze()
+
+    def test_concurrent_pools(self):
+        # pools started from several threads at once, as by background jobs in the UI
+        results = {}
+
+        def score(params):
+            tables = iter_score_tables_for_scenes(self.nusc, params=params, workers=2, use_cache=False,
+                                                  progress=False)
+            results[params['p']] = [table.to_scores() for _, table in tables]
+
+        threads = [threading.Thread(target=score, args=(params,)) for params in [rss_aggressive, rss_conservative]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for params in [rss_aggressive, rss_conservative]:
+            self.assertEqual([generate_scores_for_scene(self.nusc, scene['token'], params=params)
+                              for scene in self.nusc.scene], results[params['p']])
@@ -1,12 +1,17 @@
 import webbrowser
+import hashlib
+import json
+import math
 import os
+import re
 import sys
 import shutil
+import threading
 from threading import Timer
-from flask import Flask, render_template, redirect
+import time
+from time import perf_counter
+from flask import Flask, render_template, redirect, jsonify, abort, request, g, url_for, make_response
 import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import patches
 
 import constants
 
@@ -16,17 +21,182 @@ import constants
 matplotlib.use('SVG')
 
 from nuscenes.nuscenes import NuScenes
+from ego_trajectory import get_ego_trajectories
 from scoring import *
+from dataset_stats import FIGURE_NAMES, DatasetStats, claim_stats_job, get_stats_dir, load_dataset_stats, \
+    read_stats_progress, release_stats_job, save_dataset_figures, write_stats_progress
+from score_cache import CODE_VERSION, cached_generate_annotation_score_columns_for_scene, get_cache_key, \
+    get_params_hash
+from score_table import ScoreTable
+from parallel_scoring import iter_score_tables_for_scenes, score_scene
+from jobs import find_job, start_job, get_job
+from renders import init_renderer, request_render
+from metrics import get_metrics, instrument_dataset, metrics_enabled, record
 
 app = Flask(__name__)
 HOST = '127.0.0.1'  # only visible to local machine
 PORT = 8080
 
-dataroot = sys.argv[1]
-version = sys.argv[2]
-nusc = NuScenes(version=version, dataroot=dataroot, verbose=True)
+# Dataset the pages are drawn from, loaded by create_app()
+nusc = None
+version = None
+# Number of processes scoring the dataset for the whole dataset statistics, None for the number of CPUs
+stats_workers = None
 
-aggressive = True
+# Parameter sets which can always be selected. Custom sets are added through the home page and saved in the
+# score cache, so that every server process sees them, see get_param_sets()
+BUILT_IN_PARAM_SETS = {'aggressive': constants.rss_aggressive, 'conservative': constants.rss_conservative}
+DEFAULT_PARAMS = 'aggressive'
+
+# Cookie holding the name of the parameter set each browser has selected
+PARAMS_COOKIE = 'params'
+
+# Names which custom parameter sets can be given, so that they can be selected through /params/<name>
+PARAM_SET_NAME = re.compile(r'[A-Za-z0-9_.\- ]{1,64}')
+
+# Largest number of annotations whose renders can be requested at once, see renders()
+MAX_RENDER_TOKENS = 200
+
+# Number of results in each page of the JSON API, unless a limit is given, and the largest limit allowed
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Aggregates being collected by the dataset statistics jobs, by job key
+running_stats = {}
+
+# Held by the whole dataset statistics job which is running, as each scores the dataset with its own pool of
+# processes. Jobs for other parameter sets are queued until it finishes
+stats_queue = threading.Lock()
+
+
+def create_app(dataroot, dataset_version, render_workers=None, dataset_stats_workers=None):
+    """
+    Loads the dataset and the tables derived from it which scoring uses, so that server processes forked
+    afterwards share them rather than each building their own. Any earlier renders are removed
+
+    Args:
+        dataroot: root directory of the dataset, e.g. data/sets/nuscenes
+        dataset_version: dataset version, e.g. v1.0-mini
+        render_workers: number of processes rendering annotations, defaults to the number of CPUs
+        dataset_stats_workers: number of processes scoring the dataset for the whole dataset statistics,
+                               defaults to the number of CPUs
+
+    Returns: the Flask app
+
+    """
+
+    global nusc, version, stats_workers
+    version = dataset_version
+    stats_workers = dataset_stats_workers
+    nusc = NuScenes(version=version, dataroot=dataroot, verbose=True)
+    get_annotation_masks(nusc)
+    get_annotation_yaws(nusc)
+    get_ego_trajectories(nusc)
+    instrument_dataset(nusc)
+    init_renderer(nusc, render_workers)
+    clear_renders()
+    return app
+
+
+def clear_renders():
+    """
+    Removes any existing rendered images
+
+    """
+
+    temp_render_dir = 'static/temp_renders'
+    if os.path.exists(temp_render_dir):
+        shutil.rmtree(temp_render_dir)
+    os.makedirs(temp_render_dir)
+
+
+def get_param_sets_dir():
+    """
+    Finds the directory custom parameter sets are saved in, see save_param_set()
+
+    Returns: path of the directory, in the score cache of the dataset
+
+    """
+
+    return os.path.join(nusc.dataroot, 'score_cache', 'param_sets')
+
+
+def get_param_sets():
+    """
+    Finds the parameter sets which can be selected, the built-in sets and the custom sets saved by
+    save_param_set() in any server process
+
+    Returns: dictionary mapping name to RSS parameter dictionary, in the order the sets were added
+
+    """
+
+    param_sets = dict(BUILT_IN_PARAM_SETS)
+    directory = get_param_sets_dir()
+    if not os.path.isdir(directory):
+        return param_sets
+
+    saved = []
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.json'):
+            try:
+                with open(os.path.join(directory, file_name)) as f:
+                    saved.append(json.load(f))
+            except (OSError, ValueError):
+                # unreadable files are skipped, as in the score cache
+                continue
+    for param_set in sorted(saved, key=lambda p: p['added']):
+        param_sets[param_set['name']] = param_set['params']
+    return param_sets
+
+
+def save_param_set(name, params):
+    """
+    Saves a custom parameter set, replacing any set of the same name
+
+    Args:
+        name: name of the parameter set
+        params: RSS parameter dictionary
+
+    """
+
+    directory = get_param_sets_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, hashlib.sha1(name.encode()).hexdigest() + '.json')
+    temp_path = path + '.%d.tmp' % os.getpid()
+    with open(temp_path, 'w') as f:
+        json.dump({'name': name, 'params': params, 'added': time.time()}, f)
+    os.replace(temp_path, path)
+
+
+def get_selected_params():
+    """
+    Finds the parameter set selected by the browser making the request
+
+    Returns: name of the parameter set, RSS parameter dictionary and every parameter set, see get_param_sets()
+
+    """
+
+    param_sets = get_param_sets()
+    name = request.cookies.get(PARAMS_COOKIE, DEFAULT_PARAMS)
+    if name not in param_sets:
+        name = DEFAULT_PARAMS
+    return name, param_sets[name], param_sets
+
+
+def select_params_response(name):
+    """
+    Redirects back to the home page, selecting a parameter set for the browser
+
+    Args:
+        name: name of the parameter set
+
+    Returns: response
+
+    """
+
+    response = redirect('/')
+    response.set_cookie(PARAMS_COOKIE, name, samesite='Lax')
+    return response
 
 
 def start_browser():
@@ -38,6 +208,23 @@ def start_browser():
         webbrowser.open('http://' + HOST + ':' + str(PORT) + '/')
 
 
+@app.before_request
+def start_request_timer():
+    if metrics_enabled():
+        g.start_time = perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    """
+    Records the time taken by each endpoint as a stage when metrics are enabled, see metrics.py
+
+    """
+    if 'start_time' in g and request.endpoint:
+        record('endpoint.' + request.endpoint, perf_counter() - g.start_time)
+    return response
+
+
 @app.route('/')
 def index():
     """
@@ -46,22 +233,71 @@ def index():
     Returns: the html file for the home page
 
     """
-    return render_template('index.html', nusc=nusc, aggressive=aggressive)
+    params_name, _, param_sets = get_selected_params()
+    return render_template('index.html', nusc=nusc, param_sets=param_sets, params_name=params_name)
 
 
 @app.route('/trigger_aggressive')
 def trigger_aggressive():
     """
-    Switches between parameter sets then redirects back to home page
+    Switches between the aggressive and conservative parameter sets then redirects back to home page
+
+    Returns: home page
+
+    """
+    params_name, _, _ = get_selected_params()
+    return select_params_response('conservative' if params_name == 'aggressive' else 'aggressive')
+
+
+@app.route('/params/<string:name>')
+def select_params(name):
+    """
+    Selects a parameter set for the browser then redirects back to home page. Scenes which have already been
+    viewed only need their scores recalculated from cached features, see cached_generate_scores_for_scene()
+
+    Args:
+        name: name of the parameter set
 
     Returns: home page
 
     """
-    global aggressive
-    aggressive = not aggressive
-    return redirect('/')
+    if name not in get_param_sets():
+        abort(404)
+    return select_params_response(name)
 
 
+@app.route('/params', methods=['POST'])
+def add_params():
+    """
+    Adds a custom parameter set from the home page form and selects it. Every parameter must be a finite
+    number greater than zero, except mu which may be zero, as the accelerations and response time divide
+    the RSS distances
+
+    Returns: home page, or 400 if the name or a parameter is invalid
+
+    """
+    name = request.form.get('name', '').strip()
+    if not name:
+        abort(400, 'The parameter set needs a name')
+    if not PARAM_SET_NAME.fullmatch(name):
+        abort(400, 'Parameter set names can only contain letters, digits, spaces, _, . and -, up to 64 '
+                   'characters')
+    if name.lower() in BUILT_IN_PARAM_SETS:
+        abort(400, 'The built-in parameter sets cannot be replaced')
+    try:
+        params = {key: float(request.form[key]) for key in constants.rss_aggressive}
+    except (KeyError, ValueError):
+        abort(400, 'Every parameter needs a number')
+    for key, value in params.items():
+        if key == 'mu':
+            if not math.isfinite(value) or value < 0:
+                abort(400, 'mu must be a number of at least zero')
+        elif not math.isfinite(value) or value <= 0:
+            abort(400, '%s must be a number greater than zero' % key)
+
+    save_param_set(name, params)
+    return select_params_response(name)
+
 
 @app.route('/scene/<string:token>')
 def scene(token):
@@ -75,96 +311,436 @@ def scene(token):
 
     """
 
-    scores = [score for score in generate_scores_for_scene(nusc, token, aggressive) if score['score'] < 1]
+    _, params, _ = get_selected_params()
+    table = score_scene(nusc, token, params)
+    scores = table[table['score'] < 1]
 
-    for score in scores:
-        out_path = 'static/temp_renders/' + score['annotation'] + '.jpg'
+    # renders are drawn in the background, the page fills them in as they become ready
+    rendered = {annotation: request_render(annotation) for annotation in scores.get_tokens('annotation')}
+
+    return render_template('scene.html', nusc=nusc, token=token, scores=scores, rendered=rendered,
+                           max_render_tokens=MAX_RENDER_TOKENS)
+
+
+@app.route('/renders')
+def renders():
+    """
+    Reports which annotation renders are ready, starting any which have not been requested yet
+
+    Query parameters:
+        annotations: comma separated annotation tokens, at most MAX_RENDER_TOKENS
+
+    Returns: JSON object mapping each annotation token to whether its render is ready, or 400 if there are
+             too many tokens or any is not an annotation of the dataset
+
+    """
+
+    tokens = [t for t in request.args.get('annotations', '').split(',') if t]
+    if len(tokens) > MAX_RENDER_TOKENS:
+        abort(400, 'At most %d annotations can be requested at once' % MAX_RENDER_TOKENS)
+    for t in tokens:
+        # tokens name the render files, so only annotations of the dataset are accepted
         try:
-            nusc.render_annotation(score['annotation'], out_path=out_path)
-        except:
-            fig = plt.figure(figsize=(18,9))
-            ax = fig.add_subplot()
-            ax.text(0.1, 0.1, 'NuScenes API was unable to render annotation', fontsize=25, color='red')
-            plt.savefig(out_path)
+            nusc.getind('sample_annotation', t)
+        except KeyError:
+            abort(400, 'Unknown annotation: %s' % t)
+    return jsonify({t: request_render(t) for t in tokens})
 
-    return render_template('scene.html', nusc=nusc, token=token, scores=scores)
 
 @app.route('/dataset_stats')
 def dataset_stats():
     """
-    Runs the tools analyses over the entire dataset and then returns results as graphs
+    Starts the tools analyses over the entire dataset as a background job, or reuses the job already started
+    or the results already saved for the parameter set in use. The page shows the job's progress, then the
+    results as graphs once it has finished
 
     Returns: results page
 
     """
 
-    scores_raw = []
-    for scene in nusc.scene:
-        scores_raw += generate_scores_for_scene(nusc, scene['token'], aggressive=aggressive)
-    scores = [score['score'] for score in scores_raw]
-
-    fig, ax = plt.subplots()
-    ax.hist(scores)
-    ax.set_title('Distribution of scores over entire dataset')
-    ax.set_xlabel('Score')
-    ax.set_ylabel('Number of occurrences')
-    fig.savefig('static/temp_renders/dataset.svg')
-    fig.savefig('static/temp_renders/dataset.pdf')
-
-    fig, ax = plt.subplots(figsize=(6.4, 3))
-    labels = ['Perfect score', 'Non-perfect score']
-    values = [len([s for s in scores if s >= 1]), len([s for s in scores if s < 1])]
-    ax.pie(values, autopct=lambda x: int(x*len(scores)/100), labels=labels)
-    ax.set_title('Proportion of perfect to non-perfect scores')
-    fig.subplots_adjust(bottom=0.0)
-    fig.savefig('static/temp_renders/dataset_pie.svg')
-    fig.savefig('static/temp_renders/dataset_pie.pdf')
-
-    fig, ax = plt.subplots()
-    ax.hist([s for s in scores if s < 1])
-    ax.set_title('Distribution of non-perfect scores over entire dataset')
-    ax.set_xlabel('Score')
-    ax.set_ylabel('Number of occurrences')
-    fig.savefig('static/temp_renders/dataset_danger.svg')
-    fig.savefig('static/temp_renders/dataset_danger.pdf')
-
-    fig, ax = plt.subplots()
-    long_same_dir = len([0 for s in scores_raw if s['reason'] == 'Longitudinally too close' and s['same_direction'] == True])
-    long_opposite_dir = len([0 for s in scores_raw if s['reason'] == 'Longitudinally too close' and s['same_direction'] == False])
-    lat = len([0 for s in scores_raw if s['reason'] == 'Laterally too close'])
-    other = len([0 for s in scores_raw if s['reason'] == 'Too close'])
-    reasons = ['Longitudinally\ntoo close\n(same\ndirection)',
-               'Longitudinally\ntoo close\n(opposite\ndirection)',
-               'Laterally\ntoo close', 'Too close']
-    values = [long_same_dir, long_opposite_dir, lat, other]
-    ax.bar(reasons, values)
-    ax.set_title('Reasons given for non-perfect scores')
-    ax.set_xlabel('Reason for score')
-    ax.set_ylabel('Number of occurrences')
-    fig.subplots_adjust(bottom=0.2)
-    fig.savefig('static/temp_renders/dataset_reasons.svg')
-    fig.savefig('static/temp_renders/dataset_reasons.pdf')
-
-    # Create another graph. A heatmap. It will show the locations of other vehicles in relation to the ego
-    # where an unsafe score has been given
-
-    fig, ax = plt.subplots(figsize=(6.4, 3))
-    x = [s['lat_distance'] for s in scores_raw if s['score'] < 1]
-    y = [s['long_distance'] for s in scores_raw if s['score'] < 1]
-    ax.hist2d(y, x, [25,10], range=[[-5,50],[-10,10]])
-    l = constants.renault_zoe_dims['length']
-    w = constants.renault_zoe_dims['width']
-    rect = patches.Rectangle((-l, -w/2), l, w, linewidth=1, edgecolor='r', facecolor='w', label='Ego')
-    ax.add_patch(rect)
-    ax.set_aspect('equal')
-    ax.set_xlabel('Longitudinal distance (m)')
-    ax.set_ylabel('Lateral distance (m)')
-    ax.set_title('Relative translations of other vehicles in unsafe situations')
-    ax.legend()
-    fig.savefig('static/temp_renders/dataset_heatmap.svg')
-    fig.savefig('static/temp_renders/dataset_heatmap.pdf')
-
-    return render_template('dataset_stats.html')
+    _, params, _ = get_selected_params()
+    job, _, figure_dir = find_dataset_stats(params)
+    return render_template('dataset_stats.html', job=job, figure_dir=figure_dir)
+
+
+@app.route('/dataset_stats.json')
+def dataset_stats_json():
+    """
+    Reports the aggregates the whole dataset graphs are drawn from for the parameter set in use, starting the
+    analyses as /dataset_stats does if they have not been run. While they are running the aggregates cover
+    the scenes analysed so far
+
+    Returns: JSON object with the job status, the aggregates (see DatasetStats.to_dict()) and, once the
+             analyses have finished, the paths of the graphs
+
+    """
+
+    params_name, params, _ = get_selected_params()
+    job, stats, figure_dir = find_dataset_stats(params)
+    figures = None
+    if job['state'] == 'done':
+        figures = {name: url_for('static', filename=figure_dir + '/' + name + '.svg') for name in FIGURE_NAMES}
+    return jsonify({'params': params_name, 'job': job, 'stats': stats.to_dict() if stats is not None else None,
+                    'figures': figures})
+
+
+@app.route('/jobs/<string:job_id>')
+def job_status(job_id):
+    """
+    Reports the progress of a background job
+
+    Args:
+        job_id: id of the job
+
+    Returns: job status as JSON
+
+    """
+
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.status())
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Reports the call counts and latencies of each stage recorded by this server. Stages are only recorded
+    when the server is started with the RSS_METRICS environment variable set
+
+    Returns: metrics as JSON, see metrics.get_metrics()
+
+    """
+
+    return jsonify(get_metrics())
+
+
+@app.route('/api/scenes')
+def api_scenes():
+    """
+    Lists the scenes of the dataset
+
+    Query parameters:
+        offset, limit: see paginate()
+
+    Returns: JSON page of scenes, with their token, name, description, location and number of samples
+
+    """
+
+    def build():
+        return paginate([{'token': scene['token'], 'name': scene['name'], 'description': scene['description'],
+                          'location': nusc.get('log', scene['log_token'])['location'],
+                          'samples': scene['nbr_samples']} for scene in nusc.scene], 'scenes')
+
+    return conditional_json_response([version], build)
+
+
+@app.route('/api/scenes/<string:token>/instances')
+def api_scene_instances(token):
+    """
+    Reports the score of each instance in a scene, at its first minimum as on the scene page
+
+    Args:
+        token: scene token
+
+    Query parameters:
+        params, score_below, reason: see get_api_filters()
+        offset, limit: see paginate()
+
+    Returns: JSON page of score dictionaries
+
+    """
+
+    find_scene(token)
+    name, params, score_below, reasons = get_api_filters()
+
+    def build():
+        table = score_scene(nusc, token, params).filter(score_below, reasons)
+        return dict(scene=token, params=name, **paginate(table, 'scores'))
+
+    return conditional_json_response([get_cache_key(version, token, params), name, 'instances'], build)
+
+
+@app.route('/api/scenes/<string:token>/annotations')
+def api_scene_annotations(token):
+    """
+    Reports the score of every scored annotation in a scene, grouped by instance in time order
+
+    Args:
+        token: scene token
+
+    Query parameters:
+        params, score_below, reason: see get_api_filters()
+        offset, limit: see paginate()
+
+    Returns: JSON page of score dictionaries
+
+    """
+
+    find_scene(token)
+    name, params, score_below, reasons = get_api_filters()
+
+    def build():
+        table = ScoreTable.from_columns(cached_generate_annotation_score_columns_for_scene(nusc, token,
+                                                                                          params=params))
+        return dict(scene=token, params=name, **paginate(table.filter(score_below, reasons), 'scores'))
+
+    return conditional_json_response([get_cache_key(version, token, params), name, 'annotations'], build)
+
+
+@app.route('/api/instances/<string:token>')
+def api_instance(token):
+    """
+    Reports the score of an instance, at its first minimum, and the scores of each of its annotations
+
+    Args:
+        token: instance token
+
+    Query parameters:
+        params: see get_api_filters()
+
+    Returns: JSON object with the instance's scene, score and annotation scores. The score is null if the
+             instance is not scored, e.g. if it is not a vehicle
+
+    """
+
+    try:
+        instance = nusc.get('instance', token)
+    except KeyError:
+        api_abort(404, 'Unknown instance: %s' % token)
+    annotation = nusc.get('sample_annotation', instance['first_annotation_token'])
+    scene_token = nusc.get('sample', annotation['sample_token'])['scene_token']
+    name, params, _, _ = get_api_filters()
+
+    def build():
+        instances = score_scene(nusc, scene_token, params)
+        instances = instances[instances.get_tokens('instance') == token]
+        annotations = ScoreTable.from_columns(cached_generate_annotation_score_columns_for_scene(
+            nusc, scene_token, params=params))
+        annotations = annotations[annotations.get_tokens('instance') == token]
+        return {'instance': token, 'scene': scene_token, 'params': name,
+                'score': dict(instances[0]) if len(instances) else None, 'annotations': annotations.to_scores()}
+
+    return conditional_json_response([get_cache_key(version, scene_token, params), name, 'instance', token], build)
+
+
+@app.route('/api/annotations/<string:token>')
+def api_annotation(token):
+    """
+    Reports the score of an annotation
+
+    Args:
+        token: annotation token
+
+    Query parameters:
+        params: see get_api_filters()
+
+    Returns: JSON object with the annotation's scene and score. The score is null if the annotation is not
+             scored, e.g. if it is not a moving vehicle
+
+    """
+
+    try:
+        annotation = nusc.get('sample_annotation', token)
+    except KeyError:
+        api_abort(404, 'Unknown annotation: %s' % token)
+    scene_token = nusc.get('sample', annotation['sample_token'])['scene_token']
+    name, params, _, _ = get_api_filters()
+
+    def build():
+        annotations = ScoreTable.from_columns(cached_generate_annotation_score_columns_for_scene(
+            nusc, scene_token, params=params))
+        annotations = annotations[annotations.get_tokens('annotation') == token]
+        return {'annotation': token, 'scene': scene_token, 'params': name,
+                'score': dict(annotations[0]) if len(annotations) else None}
+
+    return conditional_json_response([get_cache_key(version, scene_token, params), name, 'annotation', token], build)
+
+
+def api_abort(status, message):
+    """
+    Stops handling an API request with an error
+
+    Args:
+        status: HTTP status code
+        message: description of the error, returned as JSON
+
+    """
+
+    abort(make_response(jsonify({'error': message}), status))
+
+
+def find_scene(token):
+    """
+    Finds a scene for an API request, stopping with a 404 error if there is no such scene
+
+    Args:
+        token: scene token
+
+    Returns: scene record
+
+    """
+
+    try:
+        return nusc.get('scene', token)
+    except KeyError:
+        api_abort(404, 'Unknown scene: %s' % token)
+
+
+def get_api_filters():
+    """
+    Reads the filters of an API request from its query parameters
+
+    Query parameters:
+        params: name of the parameter set to score with, defaults to the one selected on the home page
+        score_below: only scores below this value are returned, e.g. 1 for the non-perfect scores
+        reason: only scores with this reason are returned, can be given more than once
+
+    Returns: parameter set name, parameter dictionary, score threshold or None and list of reasons or None
+
+    """
+
+    selected, _, param_sets = get_selected_params()
+    name = request.args.get('params', selected)
+    if name not in param_sets:
+        api_abort(400, 'Unknown parameter set: %s' % name)
+
+    score_below = request.args.get('score_below', type=float)
+    if 'score_below' in request.args and score_below is None:
+        api_abort(400, 'score_below must be a number')
+
+    reasons = request.args.getlist('reason') or None
+    for reason in reasons or []:
+        if reason not in constants.score_reasons:
+            api_abort(400, 'Unknown reason: %s' % reason)
+
+    return name, param_sets[name], score_below, reasons
+
+
+def paginate(items, name):
+    """
+    Takes the page of results asked for by an API request
+
+    Query parameters:
+        offset: index of the first result, defaults to 0
+        limit: number of results, defaults to API_PAGE_SIZE and at most API_MAX_PAGE_SIZE
+
+    Args:
+        items: list of dictionaries or ScoreTable
+        name: key of the results in the page
+
+    Returns: dictionary with the page of results, the total number of results, the offset and limit, and the
+             URL of the next page, which is null on the last page
+
+    """
+
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    if offset < 0 or not 0 < limit <= API_MAX_PAGE_SIZE:
+        api_abort(400, 'offset must be at least 0 and limit between 1 and %d' % API_MAX_PAGE_SIZE)
+
+    page = items[offset:offset + limit]
+    next_url = None
+    if offset + limit < len(items):
+        args = request.args.to_dict(flat=False)
+        args.update(offset=offset + limit, limit=limit)
+        next_url = url_for(request.endpoint, **request.view_args, **args)
+    return {'total': len(items), 'offset': offset, 'limit': limit, 'next': next_url,
+            name: page.to_scores() if isinstance(page, ScoreTable) else page}
+
+
+def conditional_json_response(key, build):
+    """
+    Creates an API response with an ETag, which is found from what the results depend on rather than from
+    the results, so that a request whose ETag still matches is answered with 304 Not Modified without
+    scoring anything
+
+    Args:
+        key: list of strings identifying the results, e.g. the score cache key, which changes whenever the
+             dataset version, scene, parameter values or scoring code do, and the parameter set's name
+        build: function returning the JSON results
+
+    Returns: response
+
+    """
+
+    etag = hashlib.sha1('\n'.join(key + [request.full_path]).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    # clients may keep responses but should check they are still current
+    response.cache_control.no_cache = True
+    return response
+
+
+def find_dataset_stats(params):
+    """
+    Finds the aggregates the dataset graphs are drawn from for a parameter set. They are read from disk if
+    an earlier analysis saved them, even from before the server was restarted, and otherwise come from the
+    background job which analyses the dataset, which is started if needed. Each process runs one of these
+    jobs at a time, and queues the rest. When the UI is served by several processes only one of them runs the
+    job for a parameter set, and the others report the progress it saves
+
+    Args:
+        params: RSS parameter dictionary
+
+    Returns: job status, DatasetStats (covering the scenes analysed so far while the job is running, None
+             while it is queued) and the directory of the graphs relative to the static directory
+
+    """
+
+    params_hash = get_params_hash(params)
+    stats_dir = get_stats_dir(version, params_hash, CODE_VERSION)
+    figure_dir = os.path.relpath(stats_dir, 'static')
+
+    stats = load_dataset_stats(stats_dir)
+    if stats is not None:
+        return {'state': 'done'}, stats, figure_dir
+
+    key = ('dataset_stats', version, params_hash)
+    job = find_job(key)
+    if job is None or job.state == 'failed':
+        if not claim_stats_job(stats_dir):
+            status = read_stats_progress(stats_dir) or {'state': 'running', 'done': 0, 'total': None, 'eta': None}
+            return status, None, figure_dir
+        job = start_job(key, lambda j: run_dataset_stats(j, params, key, stats_dir), queue=stats_queue)
+        if job.state == 'queued':
+            # other processes report the job as queued until it starts
+            write_stats_progress(stats_dir, job.status())
+    return job.status(), running_stats.get(key), figure_dir
+
+
+def run_dataset_stats(job, params, key, stats_dir):
+    """
+    Runs the tools analyses over the entire dataset, aggregating each scene's scores as it finishes, and then
+    saves the results as graphs
+
+    Args:
+        job: the background job running the analyses
+        params: RSS parameter dictionary to use
+        key: key of the job, under which the aggregates are kept in running_stats
+        stats_dir: directory to save the aggregates and graphs to, see dataset_stats.get_stats_dir(). The
+                   job must have been claimed with dataset_stats.claim_stats_job(), and the claim is released
+                   when it finishes
+
+    """
+
+    def set_progress(done, total):
+        job.set_progress(done, total)
+        write_stats_progress(stats_dir, job.status())
+
+    try:
+        stats = DatasetStats()
+        running_stats[key] = stats
+        for _, table in iter_score_tables_for_scenes(nusc, params=params, workers=stats_workers, progress=False,
+                                                     progress_callback=set_progress, ordered=False):
+            stats.add(table)
+
+        save_dataset_figures(stats, stats_dir)
+    finally:
+        release_stats_job(stats_dir)
 
 
 def main():
@@ -173,11 +749,9 @@ def main():
 
     """
 
-    # removes any existing rendered images
-    temp_render_dir = 'static/temp_renders'
-    if os.path.exists(temp_render_dir):
-        shutil.rmtree(temp_render_dir)
-    os.makedirs(temp_render_dir)
+    if len(sys.argv) != 3:
+        raise SystemExit('Usage: python ui.py [dataset root] [dataset version]')
+    create_app(sys.argv[1], sys.argv[2])
 
     Timer(1, start_browser).start()
     app.run(host=HOST, port=PORT, debug=True)